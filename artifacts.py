@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Union
+
+import ascii85
+
+Chunk = Union[bytes, bytearray, memoryview]
+Transform = Callable[[Iterable[Chunk]], Iterator[bytes]]
+
+# number of writes that may wait for the background thread
+MAX_PENDING = 16
+# number of bytes of a mapped file passed on at once
+READ_SIZE = 1 << 20
+
+class ArtifactFile:
+    """
+    A single artifact (e.g. the "layer2" file) that is being written.
+    The data goes to a temporary file in the directory of the writer which
+    is only renamed to the name of the artifact once it is closed, so
+    nobody ever sees a partially written layer.
+    """
+    def __init__(self, writer: 'ArtifactWriter', name: str):
+        self.writer = writer
+        self.name = name
+        self._file: Optional[BinaryIO] = None
+        self._tmp_path: Optional[str] = None
+        writer._submit(self._open)
+
+    def write(self, chunk: Chunk):
+        self.writer._submit(self._write, chunk)
+
+    def close(self):
+        self.writer._submit(self._commit)
+
+    def abort(self):
+        self.writer._submit(self._abort)
+
+    def __enter__(self) -> 'ArtifactFile':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # the methods below run in the background thread of the writer (if any)
+
+    def _open(self):
+        os.makedirs(self.writer.directory, exist_ok=True)
+        self._tmp_path = self.writer.path(f".{self.name}.{os.urandom(8).hex()}.tmp")
+        # unlike `tempfile.mkstemp`, this leaves the permissions to the umask
+        fd = os.open(self._tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        self._file = os.fdopen(fd, 'wb')
+
+    def _write(self, chunk: Chunk):
+        if self._file is None:
+            return
+        try:
+            self._file.write(chunk)
+        except BaseException:
+            self._abort()
+            raise
+
+    def _commit(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.writer.path(self.name))
+
+    def _abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._tmp_path)
+
+class ArtifactWriter:
+    """
+    Writes the intermediate results of the layers (the "layerN" files) to
+    `directory`. If it isn't `enabled`, nothing is written at all.
+    With `background` all files are written by a background thread, so the
+    disk I/O overlaps with decoding the next layer; at most `max_pending`
+    writes wait for it before the layers have to wait as well. `flush` (or
+    `close`, or leaving the `with` statement) waits until everything has
+    been written and raises the first error that happened on the way.
+    """
+    def __init__(self, directory: str = '.', enabled: bool = True, background: bool = False,
+                 max_pending: int = MAX_PENDING):
+        self.directory = directory
+        self.enabled = enabled
+        self.background = background
+        self._queue: queue.Queue = queue.Queue(max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._errors: List[BaseException] = []
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def open(self, name: str) -> ArtifactFile:
+        """
+        Start writing the artifact `name` in chunks
+        """
+        return ArtifactFile(self, name)
+
+    def write(self, name: str, data: Chunk):
+        """
+        Write the artifact `name` at once
+        """
+        with self.open(name) as artifact:
+            artifact.write(data)
+
+    def copy(self, name: str, source: str):
+        """
+        Write the artifact `name` with the contents of the file `source`
+        """
+        self._submit(self._copy, name, source)
+
+    def _copy(self, name: str, source: str):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path(f".{name}.{os.urandom(8).hex()}.tmp")
+        # a copy rather than a link: the artifact gets the permissions of a new file
+        try:
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, self.path(name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _submit(self, task: Callable, *args):
+        if not self.enabled:
+            return
+        if not self.background:
+            task(*args)
+            return
+        # the caller may reuse its buffer once the call returns
+        args = tuple(bytes(arg) if isinstance(arg, (bytearray, memoryview)) else arg for arg in args)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="artifacts", daemon=True)
+                self._thread.start()
+        self._queue.put((task, args))
+
+    def _run(self):
+        while True:
+            task, args = self._queue.get()
+            if task is None:
+                # sent by `close`
+                self._queue.task_done()
+                return
+            try:
+                task(*args)
+            except BaseException as error:
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait until all artifacts have been written
+        """
+        if self._thread is not None:
+            self._queue.join()
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def close(self):
+        """
+        Wait until all artifacts have been written and stop the background
+        thread (a new one is started if anything is written afterwards)
+        """
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put((None, ()))
+                thread.join()
+
+    def __enter__(self) -> 'ArtifactWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# writes the layer files synchronously into the current directory
+DEFAULT = ArtifactWriter()
+# writes nothing
+DISABLED = ArtifactWriter(enabled=False)
+
+@contextmanager
+def map_file(path: str) -> Iterator[memoryview]:
+    """
+    Map the file `path` into memory and provide its bytes as a read-only
+    memoryview, without reading (or copying) them upfront.
+    All views derived from it have to be released before the end of the
+    `with` statement.
+    """
+    with open(path, 'rb') as mapped_file:
+        if os.fstat(mapped_file.fileno()).st_size == 0:
+            # empty files can't be mapped
+            yield memoryview(b'')
+            return
+        with mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+def map_chunks(path: str, size: int = READ_SIZE) -> Iterator[memoryview]:
+    """
+    The bytes of the file `path` as views of `size` bytes into its memory
+    mapping (see `map_file`). Every view is only valid until the next one
+    is requested.
+    """
+    with map_file(path) as view:
+        for start in range(0, len(view), size):
+            chunk = view[start:start + size]
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+
+def run_standalone(layer: int, decode_stream: Transform):
+    """
+    Decode the file "layerN" of `layer` into the file "layer{N+1}" with the
+    `decode_stream` of the layer, as the layers do when they are run as a
+    script. The input is mapped instead of read and the output is written
+    in the background.
+    """
+    print(f"Decoding Layer {layer}...")
+    with ArtifactWriter(background=True) as writer, writer.open(f"layer{layer + 1}") as layer_file:
+        for chunk in decode_stream(ascii85.iter_decode(map_chunks(f"layer{layer}"))):
+            layer_file.write(chunk)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import struct
+from typing import BinaryIO, Iterable, Iterator, Union
+
+import optional
+
+Buffer = Union[bytes, bytearray, memoryview]
+Chunk = Union[bytes, bytearray, memoryview, str]
+
+WHITESPACE = b' \t\n\r\x0b\x0c'
+# all characters that may appear in a group: '!' (0) .. 'u' (84)
+GROUP_CHARS = bytes(range(ord('!'), ord('u') + 1))
+# character -> its digit in base 85
+DIGITS = bytes((char - ord('!')) % 256 for char in range(256))
+# number of characters from which on groups are decoded with NumPy
+NUMPY_THRESHOLD = 1 << 16
+# number of groups NumPy decodes at once (bounds its temporary arrays)
+NUMPY_BLOCK_GROUPS = 1 << 18
+# number of bytes read from a file at once
+READ_SIZE = 1 << 20
+# number of characters per line of encoded text
+WRAP_COLUMNS = 60
+
+# digit -> character, for encoding: one digit and pairs of two digits
+DIGIT_CHARS = [bytes([ord('!') + digit]) for digit in range(85)]
+DIGIT_PAIRS = [DIGIT_CHARS[pair // 85] + DIGIT_CHARS[pair % 85] for pair in range(85 * 85)]
+
+def _to_bytes(chunk: Chunk) -> bytes:
+    if isinstance(chunk, str):
+        return chunk.encode('ascii')
+    return bytes(chunk)
+
+def decode_groups(data: bytes) -> bytes:
+    """
+    Decode `data`, which must consist of complete 5-character groups only
+    (no whitespace, no 'z'), all groups at once
+    """
+    if data.translate(None, GROUP_CHARS):
+        raise ValueError(f"Non-Ascii85 digit found: {data.translate(None, GROUP_CHARS)[:1]!r}")
+    num_groups = len(data) // 5
+    numpy = optional.numpy() if len(data) >= NUMPY_THRESHOLD else None
+    if numpy is not None:
+        return b''.join(_decode_groups_numpy(numpy, data[start:start + 5 * NUMPY_BLOCK_GROUPS])
+                        for start in range(0, len(data), 5 * NUMPY_BLOCK_GROUPS))
+    digits = data.translate(DIGITS)
+    words = [(((d0 * 85 + d1) * 85 + d2) * 85 + d3) * 85 + d4
+             for d0, d1, d2, d3, d4 in zip(digits[0::5], digits[1::5], digits[2::5], digits[3::5], digits[4::5])]
+    try:
+        return struct.pack(f'>{num_groups}I', *words)
+    except struct.error:
+        raise ValueError("Ascii85 overflow") from None
+
+def _decode_groups_numpy(numpy, data: bytes) -> bytes:
+    """
+    `decode_groups` with NumPy, one column of digits after the other
+    """
+    columns = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 5)
+    words = columns[:, 0].astype(numpy.uint64)
+    words -= 33
+    for column in range(1, 5):
+        words *= 85
+        words += columns[:, column]
+        words -= 33
+    if (words >> numpy.uint64(32)).any():
+        raise ValueError("Ascii85 overflow")
+    return words.astype('>u4').tobytes()
+
+def decode_final(data: bytes) -> bytes:
+    """
+    Decode `data` whose last group may be incomplete
+    """
+    partial = len(data) % 5
+    if partial == 0:
+        return decode_groups(data)
+    if partial == 1:
+        raise ValueError("Ascii85 data ends with an incomplete group of a single character")
+    padding = 5 - partial
+    # only the last group is padded, so the rest isn't copied
+    return decode_groups(data[:-partial]) + decode_groups(data[-partial:] + b'u' * padding)[:-padding]
+
+class Ascii85Decoder:
+    """
+    Incremental Ascii85 decoder.
+    Feed it the encoded data in chunks of any size; every call to `feed`
+    returns the bytes of all groups that are complete so far.
+    With `adobe` set, everything before the '<~' and after the '~>'
+    delimiters is skipped, so the decoder can be fed a whole layer of the
+    onion (description and payload).
+    Whitespace may appear anywhere but inside the '~>', and the 'z'
+    shortcut anywhere between two groups, including across chunk
+    boundaries.
+    """
+    def __init__(self, adobe: bool = True):
+        self.adobe = adobe
+        self.started = not adobe # seen '<~' yet?
+        self.finished = False    # seen '~>' yet?
+        # characters that could not be handled yet: the undecoded characters
+        # of an incomplete group, or a '<'/'~' that may start a delimiter
+        self._pending = b''
+
+    def feed(self, chunk: Chunk) -> bytes:
+        if self.finished:
+            return b''
+        data = self._pending + _to_bytes(chunk)
+        self._pending = b''
+        if not self.started:
+            start = data.find(b'<~')
+            if start < 0:
+                self._pending = b'<' if data.endswith(b'<') else b''
+                return b''
+            data = data[start + 2:]
+            self.started = True
+
+        tail = b''
+        if self.adobe:
+            end = data.find(b'~>')
+            if end >= 0:
+                self.finished = True
+                return decode_final(self._clean(data[:end]))
+            if data.endswith(b'~'):
+                data, tail = data[:-1], b'~'
+
+        data = self._clean(data)
+        if self.adobe and b'~' in data:
+            # whatever follows it, it isn't the '>' of the end delimiter
+            raise ValueError("Ascii85 encoded byte sequences must end with b'~>'")
+        complete = len(data) - len(data) % 5
+        self._pending = data[complete:] + tail
+        return decode_groups(data[:complete])
+
+    def close(self) -> bytes:
+        """
+        Decode whatever is left at the end of the input
+        """
+        if self.finished:
+            return b''
+        if self.adobe:
+            if not self.started:
+                raise ValueError("Ascii85 encoded byte sequences must start with b'<~'")
+            raise ValueError("Ascii85 encoded byte sequences must end with b'~>'")
+        self.finished = True
+        return decode_final(self._pending)
+
+    @staticmethod
+    def _clean(data: bytes) -> bytes:
+        """
+        Drop the whitespace of `data`, which starts with a new group, and
+        expand its 'z' shortcuts
+        """
+        data = data.translate(None, WHITESPACE)
+        if b'z' in data:
+            groups = data.split(b'z')
+            # like `base64.a85decode`, only between two groups
+            if any(len(group) % 5 for group in groups[:-1]):
+                raise ValueError("z inside Ascii85 5-tuple")
+            data = b'!!!!!'.join(groups)
+        return data
+
+def iter_decode(chunks: Iterable[Chunk], adobe: bool = True) -> Iterator[bytes]:
+    """
+    Decode the Ascii85 data given as a stream of `chunks` into a stream of
+    decoded chunks
+    """
+    decoder = Ascii85Decoder(adobe)
+    for chunk in chunks:
+        decoded = decoder.feed(chunk)
+        if decoded:
+            yield decoded
+        if decoder.finished:
+            return
+    decoded = decoder.close()
+    if decoded:
+        yield decoded
+
+def decode(data: Chunk, adobe: bool = True) -> bytes:
+    """
+    Drop-in replacement for `base64.a85decode(data, adobe=adobe)`.
+    In contrast to `base64.a85decode`, text around the `<~ ... ~>` payload is
+    ignored.
+    """
+    data = _to_bytes(data)
+    # like `base64.a85decode`, accept data without the leading '<~'
+    if adobe and b'<~' not in data:
+        data = b'<~' + data.lstrip(WHITESPACE)
+    decoder = Ascii85Decoder(adobe)
+    return decoder.feed(data) + decoder.close()
+
+def encode_groups(data: Buffer) -> bytes:
+    """
+    Encode `data`, whose length must be a multiple of 4, all groups at once
+    (without the 'z' shortcut)
+    """
+    num_groups = len(data) // 4
+    numpy = optional.numpy() if len(data) >= NUMPY_THRESHOLD else None
+    if numpy is not None:
+        words = numpy.frombuffer(data, dtype='>u4').astype(numpy.uint32)
+        digits = numpy.empty((num_groups, 5), dtype=numpy.uint8)
+        for column in range(4, -1, -1):
+            digits[:, column] = words % 85 + 33
+            words //= 85
+        return digits.tobytes()
+    words = struct.unpack(f'>{num_groups}I', data)
+    return b''.join([DIGIT_CHARS[word // 52200625] + DIGIT_PAIRS[word // 7225 % 7225] + DIGIT_PAIRS[word % 7225]
+                     for word in words])
+
+def encode_final(data: Buffer) -> bytes:
+    """
+    Encode `data` whose last group may be incomplete
+    """
+    partial = len(data) % 4
+    if partial == 0:
+        return encode_groups(data)
+    padding = 4 - partial
+    return encode_groups(bytes(data) + b'\0' * padding)[:-padding]
+
+def iter_encode(chunks: Iterable[Buffer], wrapcol: int = WRAP_COLUMNS) -> Iterator[bytes]:
+    """
+    Encode the data given as a stream of `chunks` as Adobe Ascii85
+    (`<~ ... ~>`) with lines of `wrapcol` characters
+    """
+    pending = b''   # bytes of an incomplete group
+    line = b'<~'    # characters of the current line
+    for chunk in chunks:
+        data = pending + bytes(chunk)
+        complete = len(data) - len(data) % 4
+        pending = data[complete:]
+        text = line + encode_groups(data[:complete])
+        full = len(text) - len(text) % wrapcol
+        if full:
+            yield b'\n'.join(text[i:i + wrapcol] for i in range(0, full, wrapcol)) + b'\n'
+        line = text[full:]
+    text = line + encode_final(pending)
+    lines = [text[i:i + wrapcol] for i in range(0, len(text), wrapcol)] or [b'']
+    # like `base64.a85encode`, never split the '~>' across two lines
+    if len(lines[-1]) + 2 > wrapcol:
+        lines.append(b'')
+    lines[-1] += b'~>'
+    yield b'\n'.join(lines)
+
+def encode(data: Buffer, wrapcol: int = WRAP_COLUMNS) -> bytes:
+    """
+    Encode `data` as Adobe Ascii85 (`<~ ... ~>`) with lines of `wrapcol` characters
+    """
+    return b''.join(iter_encode([data], wrapcol))
+
+def read_chunks(file: BinaryIO, size: int = READ_SIZE) -> Iterator[bytes]:
+    """
+    Read the file object `file` in chunks of `size` bytes
+    """
+    return iter(lambda: file.read(size), b'')
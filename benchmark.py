@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Sequence
+
+import artifacts as layer_artifacts
+import ascii85
+import generate
+import layer6
+import metrics as layer_metrics
+import pipeline
+
+# name -> size of the decoded output of a layer
+SIZES = {'1K': 1 << 10, '1M': 1 << 20, '100M': 100 << 20}
+DEFAULT_SIZES = ('1K', '1M', '100M')
+# the VM runs about 12 instructions per output byte: larger layer 6 inputs
+# would take minutes without telling more about its speed
+DEFAULT_VM_MAX_SIZE = '1M'
+# default regression threshold in percent
+DEFAULT_THRESHOLD = 10.0
+DEFAULT_BASELINE = 'benchmark.json'
+
+# result value -> whether larger values are better
+RESULT_VALUES = {
+    'mb_per_second': True,
+    'instructions_per_second': True,
+    'peak_memory_bytes': False,
+}
+
+Results = Dict[str, Dict[str, float]]
+
+def quiet():
+    """
+    Silence the "Decoding Layer N..." of the layers
+    """
+    return contextlib.redirect_stdout(io.StringIO())
+
+def bench_layer(layer: int, payload: bytes, repeat: int, trace_memory: bool) -> Dict[str, float]:
+    """
+    Run `layerN.decode` on `payload` (without writing its artifact)
+    `repeat` times and return the best throughput and, with `trace_memory`,
+    its peak of the traced memory
+    """
+    module = importlib.import_module(pipeline.LAYERS[layer])
+    timing = layer_metrics.Metrics()
+    with quiet():
+        for _ in range(repeat):
+            timing.call(layer, module.decode, payload, artifacts=layer_artifacts.DISABLED)
+    result = {'mb_per_second': max(metrics.throughput for metrics in timing.layers)}
+    if trace_memory:
+        # a separate run: tracing slows everything down
+        memory = layer_metrics.Metrics(trace_memory=True)
+        try:
+            with quiet():
+                memory.call(layer, module.decode, payload, artifacts=layer_artifacts.DISABLED)
+        finally:
+            tracemalloc.stop()
+        result['peak_memory_bytes'] = memory.layers[0].peak_memory
+    return result
+
+def bench_vm(code: bytes, engine: str, repeat: int) -> Dict[str, float]:
+    """
+    Run the i69 program `code` on `TomtelCorei69` `repeat` times and return
+    the best number of instructions per second
+    """
+    best = 0.0
+    for _ in range(repeat):
+        VM = layer6.TomtelCorei69(code, engine, bytearray().extend)
+        start = time.perf_counter()
+        VM.run()
+        best = max(best, VM.steps / (time.perf_counter() - start))
+    return {'instructions_per_second': best}
+
+def run(sizes: Sequence[str] = DEFAULT_SIZES, layers: Sequence[int] = range(len(pipeline.LAYERS)),
+        seed: int = 0, repeat: int = 3, trace_memory: bool = True,
+        vm_max_size: str = DEFAULT_VM_MAX_SIZE) -> Results:
+    """
+    Benchmark the `layers` with fixed-seed inputs (see `generate.layer_text`)
+    that decode to each of `sizes`, and the VM with every engine.
+    Layer 6 and the VM only run with sizes up to `vm_max_size`.
+    Returns "layerN/size" or "vm-engine/size" -> the measured values.
+    """
+    results: Results = {}
+    for size_name in sizes:
+        size = SIZES[size_name]
+        for layer in layers:
+            if layer == 6 and size > SIZES[vm_max_size]:
+                print(f"layer{layer}/{size_name}: skipped (larger than {vm_max_size})")
+                continue
+            payload = generate.layer_text(layer, size, seed)
+            name = f"layer{layer}/{size_name}"
+            results[name] = bench_layer(layer, payload, repeat, trace_memory)
+            print(f"{name}: {format_result(results[name])}")
+            if layer == 6:
+                code = ascii85.decode(payload)
+                for engine in layer6.ENGINES:
+                    name = f"vm-{engine}/{size_name}"
+                    results[name] = bench_vm(code, engine, repeat)
+                    print(f"{name}: {format_result(results[name])}")
+            del payload
+    return results
+
+def format_result(result: Dict[str, float]) -> str:
+    parts = []
+    if 'mb_per_second' in result:
+        parts.append(f"{result['mb_per_second']:.2f} MB/s")
+    if 'instructions_per_second' in result:
+        parts.append(f"{result['instructions_per_second'] / 1e6:.2f} M instructions/s")
+    if result.get('peak_memory_bytes') is not None:
+        parts.append(f"peak {result['peak_memory_bytes'] / (1 << 20):.1f} MiB")
+    return ', '.join(parts)
+
+def compare(results: Results, baseline: Results, threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """
+    All values of `results` that are more than `threshold` percent worse
+    than the same values of the `baseline`, as messages
+    """
+    regressions = []
+    for name, result in results.items():
+        for value_name, higher_is_better in RESULT_VALUES.items():
+            value = result.get(value_name)
+            base = baseline.get(name, {}).get(value_name)
+            if value is None or not base:
+                continue
+            change = (value - base) / base * 100
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{name} {value_name}: {base:.6g} -> {value:.6g} ({change:+.1f}%)")
+    return regressions
+
+def load_baseline(path: str) -> Results:
+    with open(path, 'r') as baseline_file:
+        return json.load(baseline_file)['results']
+
+def save_baseline(path: str, results: Results):
+    with open(path, 'w') as baseline_file:
+        json.dump({'python': sys.version.split()[0], 'results': results}, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Benchmark the layers offline and compare the results with a baseline.
+    Returns 1 if anything regressed beyond the threshold.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the layers of Tom's Data Onion")
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=list(DEFAULT_SIZES),
+                        help="sizes of the decoded output of every layer")
+    parser.add_argument('--layers', type=int, nargs='+', choices=range(len(pipeline.LAYERS)),
+                        default=list(range(len(pipeline.LAYERS))), metavar='N', help="layers to benchmark")
+    parser.add_argument('--vm-max-size', choices=SIZES, default=DEFAULT_VM_MAX_SIZE,
+                        help="largest size that layer 6 and the VM are benchmarked with")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated inputs")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs of which the best one counts")
+    parser.add_argument('--no-memory', action='store_true', help="don't measure the peak memory")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, metavar='FILE',
+                        help="JSON file with the results to compare with")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline instead of comparing them")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, metavar='PERCENT',
+                        help="fail if a value is more than this much worse than the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.layers, args.seed, args.repeat, not args.no_memory, args.vm_max_size)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+    try:
+        baseline = load_baseline(args.baseline)
+    except FileNotFoundError:
+        print(f"No baseline in {args.baseline} to compare with (create one with --save-baseline)")
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.threshold}%")
+    return 0
+
+#%%
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+Chunk = Union[bytes, bytearray, memoryview]
+
+# default upper limit of the size of all cached layer texts
+DEFAULT_MAX_SIZE = 1 << 30
+# number of bytes read from a cached file at once
+READ_SIZE = 1 << 20
+
+@lru_cache(maxsize=None)
+def code_version(layer: int) -> str:
+    """
+    Hash of the code that decodes `layer`: the module of the layer and the
+    Ascii85 decoder in front of it. Changing either invalidates the cached
+    outputs of the layer.
+    """
+    version = hashlib.sha256()
+    for name in ('ascii85', f'layer{layer}'):
+        # find the module without importing it
+        with open(importlib.util.find_spec(name).origin, 'rb') as module_file:
+            version.update(module_file.read())
+    return version.hexdigest()
+
+class BlobWriter:
+    """
+    Writes a new text into the cache, hashing it on the way.
+    The text only becomes visible in the cache once it is committed.
+    """
+    def __init__(self, cache: 'LayerCache'):
+        self.cache = cache
+        self.digest = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk: Chunk):
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> str:
+        self.file.close()
+        digest = self.digest.hexdigest()
+        os.replace(self.tmp_path, self.cache.path(digest))
+        self.cache._added(digest, self.size)
+        return digest
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+class LayerCache:
+    """
+    Content addressed cache of the texts of the layers.
+    Every text is stored once under its SHA-256 hash; an entry maps the
+    layer, the version of the code decoding it (see `code_version`) and the
+    hash of its text to the hash of the text of the next layer.
+    Texts that haven't been used for the longest time are removed once the
+    cache grows beyond `max_size` bytes.
+    The index also remembers the latest text of every layer, so a run can
+    start at any layer of the last onion that was decoded.
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.INDEX), 'r') as index_file:
+                self._index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            self._index = {'blobs': {}, 'entries': {}, 'latest': {}}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    @staticmethod
+    def key(layer: int, digest: str) -> str:
+        return f"{layer}:{code_version(layer)}:{digest}"
+
+    def _save(self):
+        tmp_path = os.path.join(self.directory, self.INDEX + '.tmp')
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.replace(tmp_path, os.path.join(self.directory, self.INDEX))
+
+    def _touch(self, digest: str):
+        self._index['blobs'][digest]['used'] = time.time()
+
+    def _added(self, digest: str, size: int):
+        with self._lock:
+            self._index['blobs'][digest] = {'size': size, 'used': time.time()}
+            self._evict(keep=digest)
+            self._save()
+
+    def _evict(self, keep: str):
+        blobs: Dict[str, dict] = self._index['blobs']
+        total = sum(blob['size'] for blob in blobs.values())
+        for digest in sorted(blobs, key=lambda digest: blobs[digest]['used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            total -= blobs.pop(digest)['size']
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+        self._index['entries'] = {key: output for key, output in self._index['entries'].items()
+                                  if output in blobs and key.rsplit(':', 1)[1] in blobs}
+        self._index['latest'] = {layer: digest for layer, digest in self._index['latest'].items()
+                                 if digest in blobs}
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def put(self, chunks: Iterable[Chunk]) -> str:
+        """
+        Store the text given as a stream of `chunks` and return its hash
+        """
+        writer = self.writer()
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def read(self, digest: str, size: int = READ_SIZE) -> Iterator[bytes]:
+        with open(self.path(digest), 'rb') as blob_file:
+            yield from iter(lambda: blob_file.read(size), b'')
+
+    def lookup(self, layer: int, digest: str) -> Optional[str]:
+        """
+        Hash of the cached text of layer `layer + 1` decoded from the text of
+        `layer` with the hash `digest`, or `None` if there is none
+        """
+        with self._lock:
+            output = self._index['entries'].get(self.key(layer, digest))
+            if output is None or not os.path.exists(self.path(output)):
+                return None
+            self._touch(output)
+            self._save()
+            return output
+
+    def add(self, layer: int, digest: str, output: str):
+        """
+        Remember that the text of `layer` with the hash `digest` decodes to
+        the text with the hash `output`
+        """
+        with self._lock:
+            self._index['entries'][self.key(layer, digest)] = output
+            self._save()
+
+    def latest(self, layer: int) -> Optional[str]:
+        """
+        Hash of the text of `layer` of the last onion that was decoded
+        """
+        return self._index['latest'].get(str(layer))
+
+    def set_latest(self, layer: int, digest: str):
+        with self._lock:
+            self._index['latest'][str(layer)] = digest
+            self._save()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+import random
+from typing import Callable, Iterator
+
+import pytest
+
+def split_randomly(data: bytes, rng: random.Random, max_size: int = 20) -> Iterator[bytes]:
+    """
+    `data` in chunks of random sizes from 1 to `max_size` bytes
+    """
+    start = 0
+    while start < len(data):
+        size = rng.randint(1, max_size)
+        yield data[start:start + size]
+        start += size
+
+@pytest.fixture
+def random_chunks() -> Callable[..., Iterator[bytes]]:
+    return split_randomly
@@ -1,39 +1,85 @@
 #!/usr/bin/env python3
 #%%
-from typing import Union
-import urllib.request
-import html
+import argparse
+import os
+from typing import List, Optional
 
-import layer0
-import layer1
-import layer2
-import layer3
-import layer4
-import layer5
-import layer6
+import artifacts as layer_artifacts
+import cache as layer_cache
+import metrics as layer_metrics
+import pipeline
+import source
 
-def extract_payload(layer: Union[str, bytes]):
+def main(argv: Optional[List[str]] = None):
     """
-    Extract the Ascii85 encoded payload from the layer description `layer`
+    Fetch the Onion and decode all of its layers.
+    Nothing happens on import, so `python -m decode` and importing this
+    module from other code are both cheap.
     """
-    return layer[layer.index(b'<~'):layer.rindex(b'~>')+2]
+    parser = argparse.ArgumentParser(description="Decode all layers of Tom's Data Onion")
+    parser.add_argument('--source', default=source.DEFAULT_URL, metavar='FILE_OR_URL',
+                        help="read the Onion from a local file (text or saved *.html page) or fetch it from a URL")
+    parser.add_argument('--timeout', type=float, default=30.0, help="timeout in seconds of every request")
+    parser.add_argument('--retries', type=int, default=3, help="number of retries of a failed request")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="reuse the outputs of layers whose input and code haven't changed, stored in DIR")
+    parser.add_argument('--cache-size', type=int, default=layer_cache.DEFAULT_MAX_SIZE >> 20, metavar='MB',
+                        help="remove the least recently used layers once the cache grows beyond this size")
+    parser.add_argument('--from-layer', type=int, choices=range(len(pipeline.LAYERS)), metavar='N',
+                        help="start at layer N of the last onion in the cache instead of fetching it")
+    parser.add_argument('--artifact-dir', default='.', metavar='DIR',
+                        help="directory of the layerN files with the text of every layer")
+    parser.add_argument('--no-artifacts', action='store_true', help="don't write the layerN files")
+    parser.add_argument('--sync-artifacts', action='store_true',
+                        help="write the layerN files in the threads of the layers instead of in the background")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="decode layers 1 and 3 in N processes (in batches, so the next layers start later)")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="save the time, throughput and size of every layer to FILE ('-' for stdout)")
+    parser.add_argument('--metrics-format', choices=layer_metrics.FORMATS, default='json',
+                        help="JSON lines or the Prometheus text format")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="also measure the peak memory of every layer with tracemalloc (slow)")
+    parser.add_argument('--profile-layers', type=int, nargs='+', default=[], metavar='N',
+                        help="run these layers under cProfile and save their statistics as layerN.pstats")
+    parser.add_argument('--profile-dir', default='.', metavar='DIR', help="directory of the .pstats files")
+    args = parser.parse_args(argv)
 
-data_onion: bytes = b''
+    cache = layer_cache.LayerCache(args.cache, args.cache_size << 20) if args.cache else None
+    metrics = None
+    if args.metrics or args.trace_memory or args.profile_layers:
+        metrics = layer_metrics.Metrics(args.trace_memory, args.profile_layers, args.profile_dir)
+    artifacts = layer_artifacts.ArtifactWriter(args.artifact_dir, enabled=not args.no_artifacts,
+                                               background=not args.sync_artifacts)
+    first_layer = 0
+    digest = None
 
-print("Fetching latest Data Onion...")
-request = urllib.request.Request('https://www.tomdalling.com/toms-data-onion/', headers={'User-Agent': 'Mozilla/5.0'})
-with urllib.request.urlopen(request) as doc:
-    data_onion = doc.read()
-    # we're only interested in the ASCII text describing and containing the onion
-    data_onion = data_onion.split(b'<pre>')[1].split(b'</pre>')[0].strip()
-    data_onion = html.unescape(data_onion.decode('utf-8')).encode('utf-8')
+    if args.from_layer is not None:
+        if cache is None:
+            parser.error("--from-layer needs a --cache")
+        first_layer = args.from_layer
+        digest = cache.latest(first_layer)
+        if digest is None:
+            parser.error(f"there is no layer {first_layer} in the cache")
+        print(f"Starting at the cached layer {first_layer}...")
+        chunks = cache.read(digest)
+    else:
+        print("Fetching latest Data Onion...")
+        # with a cache, the page is only downloaded again if it has changed
+        onion_source = source.open_source(args.source, timeout=args.timeout, retries=args.retries,
+                                          state_dir=os.path.join(args.cache, 'source') if args.cache else None)
+        chunks = onion_source.chunks()
 
-data_onion = layer0.decode(extract_payload(data_onion))
-data_onion = layer1.decode(extract_payload(data_onion))
-data_onion = layer2.decode(extract_payload(data_onion))
-data_onion = layer3.decode(extract_payload(data_onion))
-data_onion = layer4.decode(extract_payload(data_onion))
-data_onion = layer5.decode(extract_payload(data_onion))
-data_onion = layer6.decode(extract_payload(data_onion))
+    # all layers run at once, each one decoding the output of the previous one
+    # while it is being produced
+    with artifacts:
+        core = b''.join(pipeline.run(chunks, first_layer, artifacts=artifacts, cache=cache, digest=digest,
+                                     metrics=metrics, workers=args.workers))
 
-print("Done!\n", data_onion.decode('utf-8'))
+    print("Done!\n", core.decode('utf-8'))
+    if metrics is not None:
+        metrics.write(args.metrics or '-', args.metrics_format)
+
+#%%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import argparse
+import importlib
+import random
+import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import ascii85
+import pipeline
+
+Transform = Callable[[Iterable[bytes]], Iterator[bytes]]
+
+# number of bytes of the core produced at once
+CHUNK_SIZE = 1 << 16
+# sizes of the cores used to find out how much the layers add to them
+CALIBRATION_SIZES = (1 << 14, 1 << 16)
+
+WORDS = (b"the onion has layers and every layer hides the next one behind a different "
+         b"encoding so keep peeling until you reach the core of it all").split()
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def description(layer: int) -> bytes:
+    """
+    Text in front of the payload of `layer`
+    """
+    return (f"==[ Layer {layer}/6: Generated ]=====================================\n\n"
+            f"This layer was generated for testing. Decode the payload below to get\n"
+            f"to layer {layer + 1}.\n\n"
+            f"==[ Payload ]===============================================\n\n").encode('ascii')
+
+def core_text(size: int, seed: int = 0) -> Iterator[bytes]:
+    """
+    `size` bytes of random lines of words, chosen with `seed`, in chunks
+    """
+    rng = random.Random(seed)
+    remaining = size
+    while remaining > 0:
+        words = rng.choices(WORDS, k=CHUNK_SIZE // 4)
+        lines = [b' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        chunk = b'\n'.join(lines)[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+
+def layer_encoders(seed: int = 0, noise: float = 0.01, invalid: float = 0.05) -> List[Transform]:
+    """
+    The `encode_stream` of every layer, with its random choices made with
+    `seed`. `noise` is the fraction of bytes with a wrong parity bit in
+    layer 2 and `invalid` the probability of a rejected packet in layer 4.
+    """
+    # the modules are only imported here (layer 5 needs pycryptodome)
+    modules = [importlib.import_module(name) for name in pipeline.LAYERS]
+    options: Dict[int, dict] = {
+        2: {'noise': noise, 'seed': seed + 2},
+        4: {'invalid': invalid, 'seed': seed + 4},
+        5: {'seed': seed + 5},
+    }
+    return [lambda chunks, module=module, layer=layer: module.encode_stream(chunks, **options.get(layer, {}))
+            for layer, module in enumerate(modules)]
+
+def wrap_layer(layer: int, encoder: Transform, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Text of `layer`: its description followed by the Ascii85 encoded output
+    of its `encoder` for the text of the next layer given as `chunks`
+    """
+    yield description(layer)
+    yield from ascii85.iter_encode(encoder(chunks))
+
+def layer_text(layer: int, size: int, seed: int = 0, noise: float = 0.01, invalid: float = 0.05) -> bytes:
+    """
+    Text of `layer` alone, which decodes to `size` bytes of words (see
+    `core_text`) instead of the text of the next layer
+    """
+    encoder = layer_encoders(seed, noise, invalid)[layer]
+    return b''.join(wrap_layer(layer, encoder, core_text(size, seed)))
+
+def encode_layers(core: Iterable[bytes], seed: int = 0, noise: float = 0.01,
+                  invalid: float = 0.05) -> Iterator[bytes]:
+    """
+    Wrap the `core` given as a stream of chunks in all layers of an onion,
+    from the inside out, and yield the text of layer 0 in chunks.
+    Every layer encodes the text of the next one while it is produced, so
+    memory use doesn't depend on the size of the onion.
+    """
+    encoders = layer_encoders(seed, noise, invalid)
+    text: Iterable[bytes] = core
+    for layer in reversed(range(len(encoders))):
+        text = wrap_layer(layer, encoders[layer], text)
+    return iter(text)
+
+def generated_size(core_size: int, seed: int = 0, **options) -> int:
+    return sum(len(chunk) for chunk in encode_layers(core_text(core_size, seed), seed, **options))
+
+def core_size_for(size: int, seed: int = 0, **options) -> int:
+    """
+    Size of the core of an onion of about `size` bytes: the size of the
+    onion grows linearly with the size of its core, so it is measured for
+    two small cores and extrapolated
+    """
+    small, large = CALIBRATION_SIZES
+    small_size = generated_size(small, seed, **options)
+    large_size = generated_size(large, seed, **options)
+    ratio = (large_size - small_size) / (large - small)
+    return max(int((size - small_size) / ratio) + small, 1)
+
+def generate(size: int, seed: int = 0, noise: float = 0.01, invalid: float = 0.05) -> Iterator[bytes]:
+    """
+    Text of layer 0 of a complete onion of about `size` bytes, generated
+    from `seed`, in chunks. The same `seed` always gives the same onion.
+    """
+    core_size = core_size_for(size, seed, noise=noise, invalid=invalid)
+    return encode_layers(core_text(core_size, seed), seed, noise, invalid)
+
+def parse_size(text: str) -> int:
+    """
+    A number of bytes with an optional K, M or G suffix (e.g. "100M")
+    """
+    text = text.strip().upper().rstrip('B')
+    factor = SIZE_SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SIZE_SUFFIXES:
+        text = text[:-1]
+    return int(float(text) * factor)
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Write a synthetic onion of the given size, which `decode.py --source`
+    can decode like the real one
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic Data Onion for testing")
+    parser.add_argument('--size', type=parse_size, default=parse_size('1M'),
+                        help="approximate size of the onion, e.g. 500K, 100M or 2G")
+    parser.add_argument('--seed', type=int, default=0, help="the same seed always gives the same onion")
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help="fraction of bytes with a wrong parity bit in layer 2")
+    parser.add_argument('--invalid', type=float, default=0.05,
+                        help="probability of a packet that has to be dropped in layer 4")
+    parser.add_argument('-o', '--output', default='-', metavar='FILE', help="output file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    chunks = generate(args.size, args.seed, args.noise, args.invalid)
+    if args.output == '-':
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+    else:
+        with open(args.output, 'wb') as onion_file:
+            for chunk in chunks:
+                onion_file.write(chunk)
+
+#%%
+if __name__ == "__main__":
+    main()
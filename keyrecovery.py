@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+from collections import Counter
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import ascii85
+import optional
+
+Bytes = Union[bytes, bytearray, memoryview]
+
+# number of bytes from the start of the ciphertext the key length is guessed from
+KEY_LENGTH_SAMPLE = 1 << 16
+
+def _text_weights() -> List[float]:
+    """
+    Score of every byte value as a character of (English) plain text
+    """
+    weights = [-10.0] * 256
+    for byte in range(0x20, 0x7F):
+        weights[byte] = 0.5
+    for byte in b'\n\r\t':
+        weights[byte] = 1.0
+    # relative frequency of the letters in English text (in percent)
+    frequencies = {
+        'e': 12.7, 't': 9.1, 'a': 8.2, 'o': 7.5, 'i': 7.0, 'n': 6.7, 's': 6.3,
+        'h': 6.1, 'r': 6.0, 'd': 4.3, 'l': 4.0, 'c': 2.8, 'u': 2.8, 'm': 2.4,
+        'w': 2.4, 'f': 2.2, 'g': 2.0, 'y': 2.0, 'p': 1.9, 'b': 1.5, 'v': 1.0,
+        'k': 0.8, 'j': 0.2, 'x': 0.2, 'q': 0.1, 'z': 0.1,
+    }
+    for letter, frequency in frequencies.items():
+        weights[ord(letter)] = 1.0 + frequency
+        weights[ord(letter.upper())] = 1.0 + frequency / 4
+    weights[ord(' ')] = 15.0
+    return weights
+
+def _ascii85_weights() -> List[float]:
+    """
+    Score of every byte value as a character of a layer of the onion: a
+    short description followed by a long Ascii85 payload, so only whether a
+    byte can be part of it counts, not how often letters appear in English.
+    Only the whitespace that the onion uses counts as such: most Ascii85
+    characters are still Ascii85 characters if their lowest bit is flipped,
+    but the line breaks of the payload aren't.
+    """
+    weights = [-10.0] * 256
+    for byte in range(0x20, 0x7F):
+        weights[byte] = 0.5
+    for byte in ascii85.GROUP_CHARS + b' \n':
+        weights[byte] = 1.0
+    return weights
+
+TEXT_WEIGHTS = _text_weights()
+ASCII85_WEIGHTS = _ascii85_weights()
+
+def column_scores(column: Bytes, weights: Sequence[float] = TEXT_WEIGHTS) -> List[float]:
+    """
+    Score every possible key byte for the ciphertext bytes in `column` (all
+    encrypted with the same key byte) by how much the decrypted bytes look
+    like plain text, i.e. by the sum of their `weights`
+    """
+    counts = Counter(bytes(column))
+    numpy = optional.numpy()
+    if numpy is not None:
+        histogram = numpy.zeros(256)
+        histogram[list(counts.keys())] = list(counts.values())
+        candidates = numpy.arange(256)
+        table = numpy.array(weights)[candidates[:, None] ^ candidates[None, :]]
+        return list(table @ histogram)
+    return [sum(count * weights[byte ^ key_byte] for byte, count in counts.items())
+            for key_byte in range(256)]
+
+def index_of_coincidence(data: Bytes) -> float:
+    """
+    Probability that two bytes picked from `data` at random are equal
+    """
+    n = len(data)
+    if n < 2:
+        return 0.0
+    return sum(count * (count - 1) for count in Counter(bytes(data)).values()) / (n * (n - 1))
+
+def guess_key_length(ciphertext: Bytes, max_key_len: int = 64, sample_size: int = KEY_LENGTH_SAMPLE) -> int:
+    """
+    Guess the length of the repeating key: the columns of the correct length
+    (and its multiples) are single-byte XORs of plain text and therefore have
+    a much higher index of coincidence than random bytes.
+    The shortest length that comes close to the best score wins.
+    Only the first `sample_size` bytes are scored, which is plenty for that.
+    """
+    data = bytes(ciphertext[:sample_size])
+    scores = {}
+    for key_len in range(1, min(max_key_len, max(len(data) // 2, 1)) + 1):
+        columns = [data[i::key_len] for i in range(key_len)]
+        scores[key_len] = sum(index_of_coincidence(column) for column in columns) / key_len
+    best = max(scores.values())
+    return min(key_len for key_len, score in scores.items() if score >= 0.9 * best)
+
+def key_from_known_plaintext(ciphertext: Bytes, fragments: Iterable[Tuple[int, Bytes]],
+                             key_len: int) -> List[Optional[int]]:
+    """
+    Derive the key bytes that are covered by the known plaintext `fragments`,
+    given as `(offset, plaintext)` pairs.
+    Returns one entry per key byte, `None` where no fragment tells us the key.
+    """
+    key: List[Optional[int]] = [None] * key_len
+    for offset, plaintext in fragments:
+        for i, byte in enumerate(bytes(plaintext)):
+            position = offset + i
+            if position >= len(ciphertext):
+                break
+            key[position % key_len] = ciphertext[position] ^ byte
+    return key
+
+def recover_key(ciphertext: Bytes, key_len: Optional[int] = 32,
+                fragments: Sequence[Tuple[int, Bytes]] = (),
+                weights: Sequence[float] = TEXT_WEIGHTS) -> bytes:
+    """
+    Recover the repeating key of `ciphertext`.
+    Key bytes covered by the known plaintext `fragments` are taken from them,
+    all others are chosen so that their column of the decrypted text looks
+    the most like plain text (English with `TEXT_WEIGHTS`, a layer of the
+    onion with `ASCII85_WEIGHTS`). If `key_len` is `None` it is guessed.
+    """
+    data = bytes(ciphertext)
+    if key_len is None:
+        key_len = guess_key_length(data)
+    key = key_from_known_plaintext(data, fragments, key_len)
+    for i, key_byte in enumerate(key):
+        if key_byte is None:
+            scores = column_scores(data[i::key_len], weights)
+            key[i] = max(range(256), key=scores.__getitem__)
+    return bytes(key)
@@ -1,18 +1,42 @@
 #!/usr/bin/env python3
-import base64
-from typing import Union
+from typing import Iterable, Iterator, Union
 
-def decode(payload: Union[bytes, str]) -> bytes:
+import artifacts as layer_artifacts
+import ascii85
+
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]]) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`.
+    Layer 0 is nothing but Ascii85, so there is nothing left to do.
+    """
+    for chunk in chunks:
+        yield bytes(chunk)
+
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]]) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: the payload of layer 0 is the next layer as is
+    """
+    return decode_stream(chunks)
+
+def encode(text: bytes, description: bytes = b'') -> bytes:
+    """
+    Encode the text of layer 1 into the text of layer 0: `description`
+    followed by the Ascii85 encoded payload
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text])))
+
+def decode(payload: Union[bytes, str], artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 0 and write the result to the artifact "layer1"
+    """
     print("Decoding Layer 0...")
 
-    result = base64.a85decode(payload, adobe=True)
+    result = ascii85.decode(payload)
 
-    with open("layer1", "wb+") as layer_file:
-        layer_file.write(result)
+    artifacts.write("layer1", result)
 
     return result
 
 #%%
 if __name__ == "__main__":
-    with open('layer0', 'r') as payload_file:
-        decode(payload_file.read())
+    layer_artifacts.run_standalone(0, decode_stream)
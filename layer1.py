@@ -1,31 +1,92 @@
 #!/usr/bin/env python3
-import base64
-from typing import Union
+from typing import Iterable, Iterator, Optional, Union
 
-def decode(payload: Union[bytes, str]) -> bytes:
-    print("Decoding Layer 1...")
+import artifacts as layer_artifacts
+import ascii85
+import optional
+import parallel
+
+FLIP_MASK = 0b01010101
+LAST_DIGIT_MASK = 0b00000001
+
+def flip_and_rotate(byte: int) -> int:
+    """
+    Decode a single byte of layer 1
+    """
+    ## (1) Flip every second bit
+    flipped_byte = byte ^ FLIP_MASK
+    ## (2) Rotate the bits one position to the right
+    last_digit = flipped_byte & LAST_DIGIT_MASK
+    return (flipped_byte >> 1) | (last_digit << 7)
+
+# byte -> decoded byte, for use with `bytes.translate`
+DECODE_TABLE = bytes(flip_and_rotate(byte) for byte in range(256))
+# decoded byte -> byte
+ENCODE_TABLE = bytes(DECODE_TABLE.index(byte) for byte in range(256))
 
-    FLIP_MASK = 0b01010101
-    LAST_DIGIT_MASK = 0b00000001
+def transform(data: Union[bytes, bytearray, memoryview], use_numpy: bool = False) -> bytes:
+    """
+    Decode all bytes of `data` at once through the translation table.
+    `bytes.translate` is usually the fastest way to do this; set `use_numpy`
+    to do the table lookup with NumPy instead (if it is installed).
+    """
+    numpy = optional.numpy() if use_numpy else None
+    if numpy is not None:
+        table = numpy.frombuffer(DECODE_TABLE, dtype=numpy.uint8)
+        return table[numpy.frombuffer(data, dtype=numpy.uint8)].tobytes()
+    return bytes(data).translate(DECODE_TABLE)
 
-    result: bytes = b''
-    for byte in base64.a85decode(payload, adobe=True):
-        ## (1) Flip every second bit
-        flipped_byte = byte ^ FLIP_MASK
-        # print("flipped_byte:", flipped_byte)
-        ## (2) Rotate the bits one position to the right
-        last_digit = flipped_byte & LAST_DIGIT_MASK
-        rotated_byte = flipped_byte >> 1
-        rotated_byte += last_digit
-        # print("rotated_byte:", rotated_byte)
-        result += rotated_byte.to_bytes(1,'big')
+def transform_slice(data: memoryview, offset: int) -> bytes:
+    """
+    `transform` of a slice of the data for `parallel.transform_parallel`
+    (every byte is decoded on its own, so the offset doesn't matter)
+    """
+    return transform(data)
 
-    with open("layer2", "wb+") as layer_file:
-        layer_file.write(result)
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  workers: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`.
+    Every byte is decoded on its own, so this needs constant memory no
+    matter how large the payload is.
+    With more than one of `workers`, the payload is decoded in parallel in
+    large batches (see `parallel.transform_stream`).
+    """
+    if workers is not None and workers > 1:
+        yield from parallel.transform_stream(chunks, transform_slice, workers)
+        return
+    for chunk in chunks:
+        yield bytes(chunk).translate(DECODE_TABLE)
+
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]]) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: rotate the bits one position to the left and
+    flip every second bit
+    """
+    for chunk in chunks:
+        yield bytes(chunk).translate(ENCODE_TABLE)
+
+def encode(text: bytes, description: bytes = b'') -> bytes:
+    """
+    Encode the text of layer 2 into the text of layer 1
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text])))
+
+def decode(payload: Union[bytes, str], workers: Optional[int] = None,
+           artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 1. With more than one of `workers`, large payloads are
+    decoded in parallel (see `parallel.transform_parallel`).
+    The result is also written to the artifact "layer2".
+    """
+    print("Decoding Layer 1...")
 
-    return result
+    with parallel.transform_parallel(ascii85.decode(payload), transform_slice, workers or 1) as result:
+        # straight from the (shared) memory the workers wrote to
+        artifacts.write("layer2", result.view)
+        decoded = result.tobytes()
+    return decoded
 
 #%%
 if __name__ == "__main__":
-    with open('layer1', 'r') as payload_file:
-        decode(payload_file.read())
+    layer_artifacts.run_standalone(1, decode_stream)
@@ -1,41 +1,188 @@
 #!/usr/bin/env python3
-import base64
-from typing import Union
+import random
+from functools import lru_cache
+from typing import Iterable, Iterator, Tuple, Union
 
-def decode(payload: Union[bytes, str]) -> bytes:
+import artifacts as layer_artifacts
+import ascii85
+import optional
+
+def parity_ok(byte: int) -> bool:
+    """
+    Check whether the last bit of `byte` is the correct parity bit for its
+    first seven bits (i.e. whether the number of 1 bits is even)
+    """
+    return bin(byte >> 1).count('1') % 2 == byte & 0b00000001
+
+# byte -> whether its parity bit is correct
+PARITY_TABLE = bytes(parity_ok(byte) for byte in range(256))
+# all bytes with a wrong parity bit, for use with `bytes.translate`
+INVALID_BYTES = bytes(byte for byte in range(256) if not PARITY_TABLE[byte])
+# data bits (in the upper 7 bits, parity bit 0) -> byte with the correct parity bit
+PARITY_ENCODE_TABLE = bytes(byte | (not PARITY_TABLE[byte]) for byte in range(256))
+
+# number of valid bytes that are packed into output bytes at once
+PACK_SIZE = 1 << 16
+
+@lru_cache(maxsize=8)
+def _masks(size: int) -> Tuple[int, ...]:
+    """
+    Bit masks for packing `size` bytes (a multiple of 8) in `_pack`
+    """
+    def mask(lane: int) -> int:
+        return int.from_bytes(lane.to_bytes(8, 'big') * (size // 8), 'big')
+    return (mask(0x7F7F7F7F7F7F7F7F),
+            mask(0x007F007F007F007F), mask(0x7F007F007F007F00),
+            mask(0x00003FFF00003FFF), mask(0x3FFF00003FFF0000),
+            mask(0x000000000FFFFFFF), mask(0x0FFFFFFF00000000))
+
+def _pack(valid: Union[bytes, bytearray]) -> bytearray:
+    """
+    Pack the first seven bits of each of the bytes in `valid` (whose length
+    is a multiple of 8) into output bytes: 8 bytes -> 56 bits -> 7 bytes.
+    The bytes are read into a single integer and every group of 8 bytes is
+    squeezed together by shifting 7-bit, 14-bit and 28-bit fields onto each
+    other, all groups at once.
+    """
+    size = len(valid)
+    data_bits, low_7, high_7, low_14, high_14, low_28, high_28 = _masks(size)
+    bits = (int.from_bytes(valid, 'big') >> 1) & data_bits
+    bits = (bits & low_7) | ((bits & high_7) >> 1)
+    bits = (bits & low_14) | ((bits & high_14) >> 2)
+    bits = (bits & low_28) | ((bits & high_28) >> 4)
+    # every group is now 56 bits in a 64-bit lane -> drop the empty top byte
+    packed = bytearray(bits.to_bytes(size, 'big'))
+    del packed[::8]
+    return packed
+
+@lru_cache(maxsize=8)
+def _unpack_masks(size: int) -> Tuple[int, ...]:
+    """
+    Bit masks for unpacking `size` bytes (a multiple of 8) in `_unpack`
+    """
+    def mask(lane: int) -> int:
+        return int.from_bytes(lane.to_bytes(8, 'big') * (size // 8), 'big')
+    return (mask(0x000000000FFFFFFF), mask(0x00FFFFFFF0000000),
+            mask(0x00003FFF00003FFF), mask(0x0FFFC0000FFFC000),
+            mask(0x007F007F007F007F), mask(0x3F803F803F803F80))
+
+def _unpack(data: Union[bytes, bytearray]) -> bytes:
+    """
+    Inverse of `_pack`: spread every 7 bytes (56 bits) of `data` (whose
+    length is a multiple of 7) over 8 bytes of 7 bits each and add the
+    parity bits
+    """
+    num_groups = len(data) // 7
+    size = num_groups * 8
+    lanes = bytearray(size)
+    for i in range(7):
+        lanes[i + 1::8] = data[i::7]
+    low_28, high_28, low_14, high_14, low_7, high_7 = _unpack_masks(size)
+    bits = int.from_bytes(lanes, 'big')
+    bits = (bits & low_28) | ((bits & high_28) << 4)
+    bits = (bits & low_14) | ((bits & high_14) << 2)
+    bits = (bits & low_7) | ((bits & high_7) << 1)
+    return (bits << 1).to_bytes(size, 'big').translate(PARITY_ENCODE_TABLE)
+
+def _pack_numpy(valid: Union[bytes, bytearray]) -> bytes:
+    """
+    Same as `_pack` but on an array of 64-bit words
+    """
+    numpy = optional.numpy()
+    bits = numpy.frombuffer(valid, dtype='>u8').astype(numpy.uint64)
+    bits = (bits >> numpy.uint64(1)) & numpy.uint64(0x7F7F7F7F7F7F7F7F)
+    bits = (bits & numpy.uint64(0x007F007F007F007F)) | ((bits & numpy.uint64(0x7F007F007F007F00)) >> numpy.uint64(1))
+    bits = (bits & numpy.uint64(0x00003FFF00003FFF)) | ((bits & numpy.uint64(0x3FFF00003FFF0000)) >> numpy.uint64(2))
+    bits = (bits & numpy.uint64(0x000000000FFFFFFF)) | ((bits & numpy.uint64(0x0FFFFFFF00000000)) >> numpy.uint64(4))
+    return bits.astype('>u8').view(numpy.uint8).reshape(-1, 8)[:, 1:].tobytes()
+
+def transform(data: Union[bytes, bytearray], use_numpy: bool = False) -> bytearray:
+    """
+    Drop every byte of `data` with a wrong parity bit and pack the data bits
+    of the remaining bytes into the output. A trailing group of less than 8
+    valid bytes is ignored.
+    `use_numpy` does the filtering and packing with NumPy (if it is installed).
+    """
+    numpy = optional.numpy() if use_numpy else None
+    if numpy is not None:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8)
+        valid = raw[numpy.frombuffer(PARITY_TABLE, dtype=numpy.uint8)[raw].astype(bool)]
+        valid = valid[:len(valid) - len(valid) % 8]
+        return bytearray(_pack_numpy(valid.tobytes()))
+
+    valid = bytes(data).translate(None, INVALID_BYTES)
+    num_groups = len(valid) // 8
+    result = bytearray(num_groups * 7)
+    for start in range(0, num_groups * 8, PACK_SIZE):
+        end = min(start + PACK_SIZE, num_groups * 8)
+        result[start // 8 * 7:end // 8 * 7] = _pack(valid[start:end])
+    return result
+
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]]) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`.
+    Only the valid bytes of an incomplete group are kept between two chunks,
+    so arbitrarily large payloads can be decoded with constant memory.
+    """
+    pending = b''
+    for chunk in chunks:
+        valid = pending + bytes(chunk).translate(None, INVALID_BYTES)
+        complete = len(valid) - len(valid) % 8
+        for start in range(0, complete, PACK_SIZE):
+            yield bytes(_pack(valid[start:min(start + PACK_SIZE, complete)]))
+        pending = valid[complete:]
+
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  noise: float = 0.0, seed: int = 0, padding: bytes = b'\n') -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: every 7 bytes become 8 bytes of 7 data bits
+    and a parity bit each. A fraction `noise` of bytes with a wrong parity
+    bit (chosen with `seed`) is mixed in, which the decoder has to drop.
+    An incomplete last group is filled up with `padding`.
+    """
+    rng = random.Random(seed)
+    pending = b''
+
+    def with_noise(encoded: bytes) -> bytes:
+        if not noise:
+            return encoded
+        positions = sorted(rng.randrange(len(encoded) + 1) for _ in range(int(len(encoded) * noise)))
+        pieces = []
+        start = 0
+        for position in positions:
+            pieces.append(encoded[start:position])
+            pieces.append(bytes([rng.choice(INVALID_BYTES)]))
+            start = position
+        pieces.append(encoded[start:])
+        return b''.join(pieces)
+
+    for chunk in chunks:
+        data = pending + bytes(chunk)
+        complete = len(data) - len(data) % 7
+        pending = data[complete:]
+        for start in range(0, complete, PACK_SIZE // 8 * 7):
+            yield with_noise(_unpack(data[start:min(start + PACK_SIZE // 8 * 7, complete)]))
+    if pending:
+        yield with_noise(_unpack(pending + padding * (7 - len(pending))))
+
+def encode(text: bytes, description: bytes = b'', noise: float = 0.0, seed: int = 0) -> bytes:
+    """
+    Encode the text of layer 3 into the text of layer 2
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text], noise, seed)))
+
+def decode(payload: Union[bytes, str], artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 2 and write the result to the artifact "layer3"
+    """
     print("Decoding Layer 2...")
 
-    result: bytes = b''
-    data_group: str = ''
-    i = 0
-    for byte in base64.a85decode(payload, adobe=True):
-        # print("---")
-        # print("byte:",byte)
-        first_seven_bits = format(byte, '08b')[:7]
-        # print("first_seven_bits:",first_seven_bits)
-        parity_bit = byte & 0b00000001
-        # print("parity_bit:",parity_bit)
-        num_one_bits = first_seven_bits.count('1')
-        # print("num_one_bits:",num_one_bits)
-        if (num_one_bits % 2) == parity_bit:
-            data_group += first_seven_bits
-            i += 1
-            # print("i:", i)
-            if i % 8 == 0:
-                # print(data_group)
-                for j in range(7):
-                    # print("j:", j)
-                    data_byte = int(data_group[j*8:(j+1)*8],2)
-                    # print("data_group[j*8:(j+1)*8]:",data_group[j*8:(j+1)*8])
-                    result += data_byte.to_bytes(1, 'big')
-                data_group = str()
-
-    with open("layer3", "wb+") as layer_file:
-        layer_file.write(result)
+    result = bytes(transform(ascii85.decode(payload)))
+
+    artifacts.write("layer3", result)
 
     return result
 
 #%%
 if __name__ == "__main__":
-    with open('layer2', 'r') as payload_file:
-        decode(payload_file.read())
+    layer_artifacts.run_standalone(2, decode_stream)
@@ -1,31 +1,102 @@
 #!/usr/bin/env python3
 
-import base64
-from typing import Union
+import functools
+from typing import Iterable, Iterator, Optional, Union
 
-def decode(payload: Union[bytes, str]) -> bytes:
-    print("Decoding Layer 3...")
+import artifacts as layer_artifacts
+import ascii85
+import keyrecovery
+import optional
+import parallel
+
+KEY = bytes([0x6C, 0x24, 0x84, 0x8E, 0x42, 0x19, 0xA8, 0xE1,
+             0xC5, 0xDB, 0x57, 0x65, 0xB9, 0xC6, 0x14, 0x9E,
+             0xA5, 0x19, 0x35, 0x96, 0x3B, 0x39, 0x7F, 0xA5,
+             0x65, 0xD1, 0xFE, 0x01, 0x85, 0x7D, 0xD9, 0x4C])
+KEY_LEN = 32
+# start of the text of layer 4, known plaintext for recovering the key
+LAYER4_HEADER = b'==[ Layer 4/6: '
 
-    KEY = bytearray([0x6C, 0x24, 0x84, 0x8E, 0x42, 0x19, 0xA8, 0xE1,
-                    0xC5, 0xDB, 0x57, 0x65, 0xB9, 0xC6, 0x14, 0x9E,
-                    0xA5, 0x19, 0x35, 0x96, 0x3B, 0x39, 0x7F, 0xA5,
-                    0x65, 0xD1, 0xFE, 0x01, 0x85, 0x7D, 0xD9, 0x4C])
-    KEY_LEN = 32
+def xor_with_key(data: Union[bytes, bytearray, memoryview], key: bytes = KEY,
+                 phase: int = 0, use_numpy: bool = False) -> bytes:
+    """
+    XOR `data` with the repeating `key`, starting at position `phase` of the key.
+    The whole buffer is XORed at once as a single big integer (or with NumPy
+    if `use_numpy` is set and it is installed).
+    """
+    if not data:
+        return b''
+    phase %= len(key)
+    repeats = (phase + len(data)) // len(key) + 1
+    stream = (key * repeats)[phase:phase + len(data)]
+    numpy = optional.numpy() if use_numpy else None
+    if numpy is not None:
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8),
+                                 numpy.frombuffer(stream, dtype=numpy.uint8)).tobytes()
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
 
-    result = bytearray()
-    i = 0
-    for byte in base64.a85decode(payload, adobe=True):
-        # print("byte:", byte)
-        result.append(byte ^ KEY[i % KEY_LEN])
-        i += 1
+def xor_slice(data: memoryview, offset: int, key: bytes = KEY) -> bytes:
+    """
+    `xor_with_key` of a slice of the data for `parallel.transform_parallel`:
+    the slice starts at position `offset` of the repeating key
+    """
+    return xor_with_key(data, key, offset)
 
-    with open("layer4", "wb+") as layer_file:
-        layer_file.write(result)
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  key: bytes = KEY, workers: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`,
+    keeping track of where in the key each chunk starts.
+    With more than one of `workers`, the payload is decoded in parallel in
+    large batches that start at the beginning of the key (see
+    `parallel.transform_stream`).
+    """
+    if workers is not None and workers > 1:
+        yield from parallel.transform_stream(chunks, functools.partial(xor_slice, key=key), workers,
+                                             alignment=len(key) * parallel.DEFAULT_ALIGNMENT)
+        return
+    offset = 0
+    for chunk in chunks:
+        yield xor_with_key(chunk, key, offset)
+        offset += len(chunk)
 
-    return result
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  key: bytes = KEY) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`, which is the same operation: XOR with the key
+    """
+    return decode_stream(chunks, key)
+
+def encode(text: bytes, description: bytes = b'', key: bytes = KEY) -> bytes:
+    """
+    Encode the text of layer 4 into the text of layer 3
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text], key)))
+
+def decode(payload: Union[bytes, str], key: Optional[bytes] = KEY, workers: Optional[int] = None,
+           artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 3. If `key` is `None`, the key is recovered from the
+    payload itself (see `keyrecovery.recover_key`): from the known header
+    of layer 4 and, for the rest of the key, from the Ascii85 payload it
+    consists of.
+    With more than one of `workers`, large payloads are decoded in parallel
+    in slices that start at the beginning of the key (see
+    `parallel.transform_parallel`).
+    The result is also written to the artifact "layer4".
+    """
+    print("Decoding Layer 3...")
+
+    decoded = ascii85.decode(payload)
+    if key is None:
+        key = keyrecovery.recover_key(decoded, KEY_LEN, [(0, LAYER4_HEADER)], keyrecovery.ASCII85_WEIGHTS)
+    with parallel.transform_parallel(decoded, functools.partial(xor_slice, key=key), workers or 1,
+                                     alignment=len(key) * parallel.DEFAULT_ALIGNMENT) as result:
+        # straight from the (shared) memory the workers wrote to
+        artifacts.write("layer4", result.view)
+        decoded = result.tobytes()
+    return decoded
 
 #%%
 if __name__ == "__main__":
-    with open('layer3', 'r') as payload_file:
-        decode(payload_file.read())
-
+    layer_artifacts.run_standalone(3, decode_stream)
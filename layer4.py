@@ -1,7 +1,25 @@
 #!/usr/bin/env python3
 
-import base64
-from typing import Union
+import concurrent.futures
+import os
+import random
+import struct
+import sys
+from array import array
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+import artifacts as layer_artifacts
+import ascii85
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+IP_HEADER_LEN = 20
+UDP_HEADER_LEN = 8
+# IPv4 header: total length, protocol, source address, destination address
+IP_HEADER = struct.Struct('!2xH5xB2xII')
+# UDP header: source port, destination port, length, checksum
+UDP_HEADER = struct.Struct('!HHHH')
 
 def bytes_to_int(b: bytearray):
     return int.from_bytes(b, 'big')
@@ -12,95 +30,438 @@ def bytes_to_ip(b: bytearray):
         part.append(str(b[i]))
     return '.'.join(part)
 
-def verify_checksum(b: bytearray):
+def ip_to_int(ip: str) -> int:
+    """
+    Convert the dotted IP address `ip` to a 32-bit integer
+    """
+    return bytes_to_int(bytes(int(part) for part in ip.split('.')))
+
+# constraints
+SOURCE_IP = ip_to_int('10.1.1.10')
+DEST_IP = ip_to_int('10.1.1.200')
+DEST_PORT = 42069
+
+def fold(word_sum: int) -> int:
+    """
+    Add the carries of `word_sum` back into its lower 16 bits
+    """
+    while word_sum >> 16:
+        word_sum = (word_sum & 0xffff) + (word_sum >> 16)
+    return word_sum
+
+def word_sum(b: Buffer) -> int:
+    """
+    Ones' complement sum of the big-endian 16-bit words in `b` (padded with a
+    zero byte if its length is odd).
+    The words are summed in native byte order straight from the buffer; the
+    ones' complement sum is independent of the byte order up to swapping the
+    two bytes of the result (RFC 1071).
+    """
+    view = memoryview(b)
+    even_len = len(view) & ~1
+    total = fold(sum(view[:even_len].cast('H')))
+    if sys.byteorder == 'little':
+        total = ((total & 0xff) << 8) | (total >> 8)
+    if even_len != len(view):
+        total += view[-1] << 8
+    return total
+
+def verify_checksum(b: Buffer):
     assert len(b) % 2 == 0
+    return fold(word_sum(b)) == 0xffff
 
-    def add_carry_around(w: int):
-        return (w & 0xffff) + (w >> 16)
+class Packet(NamedTuple):
+    """
+    One IPv4/UDP packet of a layer 4 payload.
+    `data` is a view of the packet's UDP payload (not a copy).
+    """
+    offset: int       # start of the IP header in the payload
+    length: int       # size of the whole packet (IP + UDP header + data)
+    source_ip: int
+    dest_ip: int
+    protocol: int
+    source_port: int
+    dest_port: int
+    ip_checksum_ok: bool
+    udp_checksum_ok: bool
+    data: Buffer
 
-    word_sum = 0
-    for i in range(0, len(b), 2):
-        word_sum += bytes_to_int(b[i:i+2])
-    return add_carry_around(word_sum) == 0xffff
+def check_total_length(ip_total_len: int, offset: int):
+    """
+    Make sure the packet at `offset` is long enough to hold its headers;
+    a shorter total length would never advance to the next packet
+    """
+    if ip_total_len < IP_HEADER_LEN + UDP_HEADER_LEN:
+        raise ValueError(f"Packet at offset {offset} has an invalid total length of {ip_total_len}")
 
-def decode(payload: Union[bytes, str]) -> bytes:
-    print("Decoding Layer 4...")
+def parse_packet(view: memoryview, offset: int) -> Packet:
+    """
+    Parse the packet whose IP header starts at `offset` in `view`
+    """
+    ip_total_len, protocol, source_ip, dest_ip = IP_HEADER.unpack_from(view, offset)
+    check_total_length(ip_total_len, offset)
+    udp_offset = offset + IP_HEADER_LEN
+    source_port, dest_port, udp_total_len, _ = UDP_HEADER.unpack_from(view, udp_offset)
+    assert ip_total_len == udp_total_len + IP_HEADER_LEN
+    data_offset = udp_offset + UDP_HEADER_LEN
+    data_length = udp_total_len - UDP_HEADER_LEN
 
-    IP_HEADER_LEN = 20
-    UDP_HEADER_LEN = 8
+    ip_checksum_ok = fold(word_sum(view[offset:udp_offset])) == 0xffff
+    # RFC 768: UDP pseudo header
+    #   0      7 8     15 16    23 24    31
+    #  +--------+--------+--------+--------+
+    #  |          source address           |
+    #  +--------+--------+--------+--------+
+    #  |        destination address        |
+    #  +--------+--------+--------+--------+
+    #  |  zero  |protocol|   UDP length    |
+    #  +--------+--------+--------+--------+
+    pseudo_header_sum = (source_ip >> 16) + (source_ip & 0xffff) + \
+                        (dest_ip >> 16) + (dest_ip & 0xffff) + \
+                        protocol + udp_total_len
+    # Checksum calculation needs:
+    # pseudo header + UDP header + data + padding (to have an even number of bytes)
+    udp_checksum_ok = fold(pseudo_header_sum + word_sum(view[udp_offset:data_offset + data_length])) == 0xffff
 
-    # constraints
-    SOURCE_IP = '10.1.1.10'
-    DEST_IP = '10.1.1.200'
-    DEST_PORT = 42069
+    return Packet(offset, ip_total_len, source_ip, dest_ip, protocol, source_port, dest_port,
+                  ip_checksum_ok, udp_checksum_ok, view[data_offset:data_offset + data_length])
 
-    result = bytearray()
-    decoded = base64.a85decode(payload, adobe=True)
+def iter_packets(decoded: Buffer) -> Iterator[Packet]:
+    """
+    Iterate over all packets of the (Ascii85 decoded) payload `decoded`
+    without copying any of it
+    """
+    view = memoryview(decoded)
     offset = 0
-    while offset < len(decoded):
-        # IP header
-        ip_header = bytearray(decoded[offset:offset+IP_HEADER_LEN])
-        offset += IP_HEADER_LEN
-        #print("ip_header:", ip_header)
-
-        ip_total_len = bytes_to_int(ip_header[2:4])
-        #print("ip_total_len:", ip_total_len)
-        ip_header_checksum = bytes_to_int(ip_header[10:12])
-        #print("ip_header_checksum:", ip_header_checksum)
-        ip_header_checksum_correct = verify_checksum(ip_header)
-        #print("checksum correct:", ip_header_checksum_correct)
-        source_ip = bytes_to_ip(ip_header[12:16])
-        #print("source_ip:", source_ip)
-        dest_ip = bytes_to_ip(ip_header[16:20])
-        #print("dest_ip:", dest_ip)
-
-        # UDP header
-        udp_header = bytearray(decoded[offset:offset+UDP_HEADER_LEN])
-        offset += UDP_HEADER_LEN
-        #print("udp_header:", udp_header)
-
-        dest_port = bytes_to_int(udp_header[2:4])
-        #print("dest_port:", dest_port)
-        udp_total_len = bytes_to_int(udp_header[4:6])
-        #print("udp_total_len:", udp_total_len)
-        assert ip_total_len == udp_total_len + IP_HEADER_LEN
-        data_length = udp_total_len - UDP_HEADER_LEN
-        #print("data_length:", data_length)
-        data = bytearray(decoded[offset:offset+data_length])
-        offset += data_length
-        #print("data:", data)
-        udp_checksum = bytes_to_int(udp_header[6:8])
-        #print("udp_checksum:", udp_checksum)
-        # RFC 768: UDP pseudo header
-        #   0      7 8     15 16    23 24    31
-        #  +--------+--------+--------+--------+
-        #  |          source address           |
-        #  +--------+--------+--------+--------+
-        #  |        destination address        |
-        #  +--------+--------+--------+--------+
-        #  |  zero  |protocol|   UDP length    |
-        #  +--------+--------+--------+--------+
-        pseudo_header = ip_header[12:20] + bytes(1) + ip_header[9:10] + udp_header[4:6]
-        #print("pseudo_header:", format(bytes_to_int(pseudo_header), '096b'))
-        # Checksum calculation needs:
-        # pseudo header + UDP header + data + padding (to have an even number of bytes)
-        udp_checksum_correct = verify_checksum(pseudo_header + udp_header + data + bytes(data_length % 2))
-        #print("checksum correct:", udp_checksum_correct)
-
-        # verify packet properties and correct checksums
-        if source_ip == SOURCE_IP and \
-            dest_ip == DEST_IP and \
-            dest_port == DEST_PORT and \
-            ip_header_checksum_correct and \
-            udp_checksum_correct:
-            result += data
-
-    with open("layer5", "wb+") as layer_file:
-        layer_file.write(result)
+    while offset + IP_HEADER_LEN + UDP_HEADER_LEN <= len(view):
+        packet = parse_packet(view, offset)
+        yield packet
+        offset += packet.length
+
+def stream_packets(chunks: Iterable[Buffer]) -> Iterator[Packet]:
+    """
+    Iterate over the packets of a payload that is given as a stream of
+    `chunks`, keeping only the incomplete packet at the end of a chunk.
+    The offsets of the packets are relative to the start of the stream.
+    """
+    pending = b''
+    stream_offset = 0 # position of `pending` in the stream
+    for chunk in chunks:
+        buffer = pending + bytes(chunk)
+        view = memoryview(buffer)
+        offset = 0
+        while offset + IP_HEADER_LEN + UDP_HEADER_LEN <= len(view):
+            ip_total_len = IP_HEADER.unpack_from(view, offset)[0]
+            check_total_length(ip_total_len, stream_offset + offset)
+            if offset + ip_total_len > len(view):
+                break
+            packet = parse_packet(view, offset)
+            yield packet._replace(offset=stream_offset + offset)
+            offset += ip_total_len
+        pending = buffer[offset:]
+        stream_offset += offset
+    if len(pending) >= IP_HEADER_LEN + UDP_HEADER_LEN:
+        # a packet with truncated data at the end of the stream
+        yield parse_packet(memoryview(pending), 0)._replace(offset=stream_offset)
+
+def is_accepted(packet: Packet) -> bool:
+    """
+    Verify packet properties and correct checksums
+    """
+    return packet.source_ip == SOURCE_IP and \
+        packet.dest_ip == DEST_IP and \
+        packet.dest_port == DEST_PORT and \
+        packet.ip_checksum_ok and \
+        packet.udp_checksum_ok
+
+# (source IP, destination IP, protocol, destination port)
+FlowKey = Tuple[int, int, int, int]
+
+class FlowStats(NamedTuple):
+    packets: int
+    bytes: int
+    valid_packets: int  # packets with correct IP and UDP checksums
+    valid_bytes: int
+
+class Flow:
+    """
+    The packets of one flow in a capture: where they are and whether their
+    checksums are correct
+    """
+    IP_CHECKSUM_OK = 0b01
+    UDP_CHECKSUM_OK = 0b10
+    VALID = IP_CHECKSUM_OK | UDP_CHECKSUM_OK
+
+    def __init__(self):
+        self.offsets = array('Q')      # offset of each packet in the capture
+        self.data_lengths = array('I') # size of each packet's UDP payload
+        self.checksums = bytearray()   # `IP_CHECKSUM_OK`/`UDP_CHECKSUM_OK` bits
+
+    def add(self, packet: Packet):
+        self.offsets.append(packet.offset)
+        self.data_lengths.append(len(packet.data))
+        self.checksums.append(packet.ip_checksum_ok * self.IP_CHECKSUM_OK |
+                              packet.udp_checksum_ok * self.UDP_CHECKSUM_OK)
+
+    def stats(self) -> FlowStats:
+        valid_lengths = [length for length, checksums in zip(self.data_lengths, self.checksums)
+                         if checksums == self.VALID]
+        return FlowStats(len(self.offsets), sum(self.data_lengths),
+                         len(valid_lengths), sum(valid_lengths))
+
+class FlowIndex:
+    """
+    Index of all flows of a layer 4 capture, built in a single pass.
+    Once built, the payload of any flow can be extracted by only touching the
+    packets of that flow. The index can be saved to and loaded from disk.
+    """
+    MAGIC = b'L4FI\x01'
+
+    def __init__(self, capture_size: int = 0):
+        self.capture_size = capture_size
+        self.flows: Dict[FlowKey, Flow] = {}
+
+    @classmethod
+    def build(cls, decoded: Buffer) -> 'FlowIndex':
+        """
+        Index the (Ascii85 decoded) payload `decoded`
+        """
+        index = cls(len(decoded))
+        flows = index.flows
+        for packet in iter_packets(decoded):
+            key = (packet.source_ip, packet.dest_ip, packet.protocol, packet.dest_port)
+            flow = flows.get(key)
+            if flow is None:
+                flow = flows[key] = Flow()
+            flow.add(packet)
+        return index
+
+    def stats(self) -> Dict[FlowKey, FlowStats]:
+        """
+        Packet and byte counts of every flow
+        """
+        return {key: flow.stats() for key, flow in self.flows.items()}
+
+    def extract(self, decoded: Buffer, key: FlowKey, valid_only: bool = True) -> bytes:
+        """
+        Reassemble the payload of the flow `key` from the capture `decoded`
+        (which must be the one that was indexed).
+        Unless `valid_only` is `False`, packets with a wrong checksum are skipped.
+        """
+        if len(decoded) != self.capture_size:
+            raise ValueError("The capture does not match the index")
+        flow = self.flows.get(key)
+        if flow is None:
+            return b''
+        view = memoryview(decoded)
+        header_len = IP_HEADER_LEN + UDP_HEADER_LEN
+        return b''.join(view[offset + header_len:offset + header_len + length]
+                        for offset, length, checksums in zip(flow.offsets, flow.data_lengths, flow.checksums)
+                        if not valid_only or checksums == Flow.VALID)
+
+    def save(self, path: str):
+        """
+        Write the index to the file `path`
+        """
+        with open(path, 'wb') as index_file:
+            index_file.write(self.MAGIC)
+            index_file.write(struct.pack('<QI', self.capture_size, len(self.flows)))
+            for key, flow in self.flows.items():
+                index_file.write(struct.pack('<IIBHQ', *key, len(flow.offsets)))
+                for values in (flow.offsets, flow.data_lengths):
+                    if sys.byteorder == 'big':
+                        values = array(values.typecode, values)
+                        values.byteswap()
+                    values.tofile(index_file)
+                index_file.write(flow.checksums)
+
+    @classmethod
+    def load(cls, path: str) -> 'FlowIndex':
+        """
+        Read an index written by `save`
+        """
+        with open(path, 'rb') as index_file:
+            if index_file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a layer 4 flow index")
+            capture_size, num_flows = struct.unpack('<QI', index_file.read(12))
+            index = cls(capture_size)
+            for _ in range(num_flows):
+                *key, num_packets = struct.unpack('<IIBHQ', index_file.read(19))
+                flow = Flow()
+                for values in (flow.offsets, flow.data_lengths):
+                    values.fromfile(index_file, num_packets)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                flow.checksums = bytearray(index_file.read(num_packets))
+                index.flows[tuple(key)] = flow
+        return index
+
+def scan_boundaries(decoded: Buffer) -> array:
+    """
+    Find the offsets of all packets in `decoded` by only reading the total
+    length of every IP header (no checksums, no copies)
+    """
+    view = memoryview(decoded)
+    offsets = array('Q')
+    offset = 0
+    while offset + IP_HEADER_LEN + UDP_HEADER_LEN <= len(view):
+        offsets.append(offset)
+        ip_total_len = IP_HEADER.unpack_from(view, offset)[0]
+        check_total_length(ip_total_len, offset)
+        offset += ip_total_len
+    return offsets
+
+def _accept_shard(shm_name: str, size: int, offsets: bytes) -> bytes:
+    """
+    Check the packets at `offsets` (a packed `array('Q')`) of the capture in
+    the shared memory block `shm_name`.
+    Returns one byte per packet: 1 if it is accepted, 0 if not.
+    """
+    shm = shared_memory.SharedMemory(shm_name)
+    try:
+        view = shm.buf[:size]
+        try:
+            return bytes(is_accepted(parse_packet(view, offset)) for offset in array('Q', offsets))
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+def decode_parallel(decoded: Buffer, workers: Optional[int] = None, shards_per_worker: int = 4) -> bytes:
+    """
+    Same as the sequential decoding of the packets in `decoded` but the
+    (expensive) checksum verification is spread over a pool of `workers`
+    processes. The capture is put into shared memory once, so the workers
+    only receive the packet offsets of their shard.
+    """
+    workers = workers or os.cpu_count() or 1
+    offsets = scan_boundaries(decoded)
+    if not offsets:
+        return b''
+    shard_size = -(-len(offsets) // (workers * shards_per_worker))
+    shards = [offsets[i:i + shard_size] for i in range(0, len(offsets), shard_size)]
+
+    shm = shared_memory.SharedMemory(create=True, size=len(decoded))
+    try:
+        shm.buf[:len(decoded)] = decoded
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            accepted = executor.map(_accept_shard, [shm.name] * len(shards), [len(decoded)] * len(shards),
+                                    [shard.tobytes() for shard in shards])
+            accepted = b''.join(accepted)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    view = memoryview(decoded)
+    header_len = IP_HEADER_LEN + UDP_HEADER_LEN
+    result = bytearray()
+    for offset, ok in zip(offsets, accepted):
+        if ok:
+            data_length = UDP_HEADER.unpack_from(view, offset + IP_HEADER_LEN)[2] - UDP_HEADER_LEN
+            result += view[offset + header_len:offset + header_len + data_length]
+    return bytes(result)
+
+def decode_stream(chunks: Iterable[Buffer]) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`
+    """
+    for packet in stream_packets(chunks):
+        if is_accepted(packet):
+            yield bytes(packet.data)
+
+def checksum(word_sum_: int) -> int:
+    """
+    Checksum field that makes the ones' complement sum of a header come out
+    as 0xffff
+    """
+    return ~fold(word_sum_) & 0xffff
+
+def build_packet(data: Buffer, source_ip: int = SOURCE_IP, dest_ip: int = DEST_IP,
+                 source_port: int = 12345, dest_port: int = DEST_PORT,
+                 ip_checksum_ok: bool = True, udp_checksum_ok: bool = True) -> bytes:
+    """
+    Build an IPv4/UDP packet carrying `data`, with correct checksums unless
+    told otherwise
+    """
+    udp_total_len = UDP_HEADER_LEN + len(data)
+    # version 4, header length 5 words, TTL 64, protocol 17 (UDP)
+    ip_header = bytearray(struct.pack('!BBHHHBBHII', 0x45, 0, IP_HEADER_LEN + udp_total_len, 0, 0,
+                                      64, 17, 0, source_ip, dest_ip))
+    ip_checksum = checksum(word_sum(ip_header)) ^ (0 if ip_checksum_ok else 1)
+    struct.pack_into('!H', ip_header, 10, ip_checksum)
+
+    udp_header = bytearray(UDP_HEADER.pack(source_port, dest_port, udp_total_len, 0))
+    pseudo_header_sum = (source_ip >> 16) + (source_ip & 0xffff) + \
+                        (dest_ip >> 16) + (dest_ip & 0xffff) + \
+                        17 + udp_total_len
+    udp_checksum = checksum(pseudo_header_sum + word_sum(bytes(udp_header) + bytes(data)))
+    struct.pack_into('!H', udp_header, 6, udp_checksum ^ (0 if udp_checksum_ok else 1))
+    return bytes(ip_header + udp_header) + bytes(data)
+
+def build_rejected_packet(rng: random.Random) -> bytes:
+    """
+    Build a packet with random data that has to be dropped by the decoder:
+    wrong addresses, wrong port or a wrong checksum
+    """
+    data = rng.randbytes(rng.randrange(64))
+    kind = rng.randrange(5)
+    if kind == 0:
+        return build_packet(data, source_ip=SOURCE_IP + 1)
+    if kind == 1:
+        return build_packet(data, dest_ip=DEST_IP + 1)
+    if kind == 2:
+        return build_packet(data, dest_port=DEST_PORT + 1)
+    return build_packet(data, ip_checksum_ok=kind != 3, udp_checksum_ok=kind != 4)
+
+def encode_stream(chunks: Iterable[Buffer], invalid: float = 0.0, seed: int = 0,
+                  max_data_len: int = 1 << 12) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: pack the data into packets of at most
+    `max_data_len` bytes of random size. Before each of them, a rejected
+    packet (see `build_rejected_packet`) is added with the probability
+    `invalid`. All random choices are made with `seed`.
+    """
+    rng = random.Random(seed)
+    for chunk in chunks:
+        view = memoryview(chunk)
+        packets = []
+        start = 0
+        while start < len(view):
+            if rng.random() < invalid:
+                packets.append(build_rejected_packet(rng))
+            end = min(start + rng.randrange(1, max_data_len + 1), len(view))
+            packets.append(build_packet(view[start:end]))
+            start = end
+        yield b''.join(packets)
+
+def encode(text: bytes, description: bytes = b'', invalid: float = 0.0, seed: int = 0) -> bytes:
+    """
+    Encode the text of layer 5 into the text of layer 4
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text], invalid, seed)))
+
+def decode(payload: Union[bytes, str], workers: Optional[int] = None,
+           artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 4. With more than one of `workers` the checksums are
+    verified in parallel (see `decode_parallel`).
+    The result is also written to the artifact "layer5".
+    """
+    print("Decoding Layer 4...")
+
+    result = bytearray()
+    decoded = ascii85.decode(payload)
+    if workers is not None and workers > 1:
+        result = decode_parallel(decoded, workers)
+    else:
+        for packet in iter_packets(decoded):
+            if is_accepted(packet):
+                result += packet.data
+
+    artifacts.write("layer5", result)
 
     return result
 
 #%%
 if __name__ == "__main__":
-    with open('layer4', 'r') as payload_file:
-        decode(payload_file.read())
+    layer_artifacts.run_standalone(4, decode_stream)
@@ -1,38 +1,36 @@
 #!/usr/bin/env python3
 
-import base64
-from typing import Union
-try:
-    from Crypto.Cipher import AES
-    from Crypto.Util.Padding import pad
-except ImportError:
-    print("Please install pycryptdome:")
-    print("\t`pip install pycryptdome'")
+import random
+import struct
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Union
 
-def bytes_to_int(b: bytearray):
-    return int.from_bytes(b, 'big')
+import artifacts as layer_artifacts
+import ascii85
 
-def byte_xor(b: bytes, i: int) -> bytes:
+def aes():
     """
-    Calculate 'b XOR i'
+    The AES module of pycryptodome, imported on first use
     """
-    return int(bytes_to_int(b) ^ i).to_bytes(len(b), 'big')
-
-def bytes_to_wordlist(bytes: bytes, bytes_per_word: int) -> list:
-    res = []
-    for i in range(0, len(bytes), bytes_per_word):
-        res.append(bytes_to_int(bytes[i:i + bytes_per_word]))
-    return res
+    try:
+        from Crypto.Cipher import AES
+    except ImportError:
+        print("Please install pycryptdome:")
+        print("\t`pip install pycryptdome'")
+        raise
+    return AES
+
+# size of the header (KEK, wrapped key IV, wrapped key, payload IV)
+HEADER_LEN = 96
+# number of bytes that are decrypted at once
+CHUNK_SIZE = 1 << 20
+
+# a single 64-bit word of RFC 3394 and a block of `A | R[i]`
+WORD = struct.Struct('>Q')
+BLOCK = struct.Struct('>Q8s')
 
 def word_to_bytes(word: int, bytes_per_word: int = 1) -> bytes:
     return word.to_bytes(bytes_per_word, 'big')
 
-def wordlist_to_bytes(words: list, bytes_per_word: int) -> bytes:
-    res = bytes()
-    for word in words:
-        res += word_to_bytes(word, bytes_per_word)
-    return res
-
 def aes_key_unwrap(wrapped_key: bytes, kek: bytes, kek_iv: bytes):
     """
     Unwrap the given key according to RFC 3394 using the given KEK and initialization vector
@@ -40,64 +38,190 @@ def aes_key_unwrap(wrapped_key: bytes, kek: bytes, kek_iv: bytes):
     # RFC 3394:
     # (1) Initialize variables.
     word_len = 8 # [bytes] (= 64 bit)
-    words = bytes_to_wordlist(wrapped_key, word_len)
-    # print("words:", words)
-    # words[0] = initial value (the `A` in RFC 3394 sec 2.2.2)
-    key_len = len(words) - 1 # [bytes]
-    cipher = AES.new(kek, AES.MODE_ECB)
+    key_len = len(wrapped_key) // word_len - 1 # [words]
+    # initial value (the `A` in RFC 3394 sec 2.2.2) as an int, so that XORing
+    # `t` into it is a single operation
+    a = WORD.unpack_from(wrapped_key)[0]
+    # words[1:] = R[1]..R[n]; words[0] is never used
+    words = [bytes(wrapped_key[i:i + word_len]) for i in range(0, len(wrapped_key), word_len)]
+    AES = aes()
+    decrypt = AES.new(kek, AES.MODE_ECB).decrypt
     # (2) Compute intermediate values.
     for j in range(5, -1, -1):
         for i in range(key_len, 0, -1):
             t = key_len * j + i
-            # temporarily save the value from the XOR in words[0]
-            # this will get overwritten later on anyway
-            words[0] = words[0] ^ t
-            b = cipher.decrypt(wordlist_to_bytes([words[0], words[i]], word_len))
-            [words[0], words[i]] = bytes_to_wordlist(b, word_len)
+            a, words[i] = BLOCK.unpack(decrypt(BLOCK.pack(a ^ t, words[i])))
 
     # (3) Output results.
-    if word_to_bytes(words[0], word_len) == kek_iv:
-        return wordlist_to_bytes(words[1:], word_len)
+    if word_to_bytes(a, word_len) == kek_iv:
+        return b''.join(words[1:])
     else:
         raise Exception("IV doesn't match up")
 
+def aes_key_wrap(key: bytes, kek: bytes, kek_iv: bytes) -> bytes:
+    """
+    Wrap `key` according to RFC 3394 (2.2.1) with the given KEK and
+    initialization vector: the inverse of `aes_key_unwrap`
+    """
+    word_len = 8
+    key_len = len(key) // word_len
+    a = WORD.unpack(kek_iv)[0]
+    words = [None] + [key[i:i + word_len] for i in range(0, len(key), word_len)]
+    AES = aes()
+    encrypt = AES.new(kek, AES.MODE_ECB).encrypt
+    for j in range(6):
+        for i in range(1, key_len + 1):
+            a, words[i] = BLOCK.unpack(encrypt(BLOCK.pack(a, words[i])))
+            a ^= key_len * j + i
+    return WORD.pack(a) + b''.join(words[1:])
+
+def aes_key_unwrap_batch(wrapped_keys: Sequence[bytes], kek: bytes, kek_iv: bytes) -> List[Optional[bytes]]:
+    """
+    Unwrap many keys that were wrapped with the same KEK and IV (see
+    `aes_key_unwrap`). Returns the unwrapped keys in the same order, `None`
+    for every key whose IV doesn't match up.
 
-def decode(payload: Union[bytes, str]) -> bytes:
-    print("Decoding Layer 5...")
-
-    result: bytes = b''
-    decoded = base64.a85decode(payload, adobe=True)
-
+    The keys are unwrapped side by side: all keys of the same length go
+    through step (j, i) of RFC 3394 together, so that every step is a
+    single `decrypt` call of one ECB cipher over the blocks of all keys.
+    """
+    word_len = 8
+    AES = aes()
+    cipher = AES.new(kek, AES.MODE_ECB)
+    results: List[Optional[bytes]] = [None] * len(wrapped_keys)
+
+    groups: Dict[int, List[int]] = {}
+    for index, wrapped_key in enumerate(wrapped_keys):
+        groups.setdefault(len(wrapped_key) // word_len - 1, []).append(index)
+
+    for key_len, indices in groups.items():
+        num_keys = len(indices)
+        # all words of all keys; seen as 64-bit units, word i of key k is at
+        # k * (key_len + 1) + i
+        words = bytearray(b''.join(wrapped_keys[index] for index in indices))
+        words_q = memoryview(words).cast('Q')
+        a = words_q[0::key_len + 1].tobytes() # A of every key
+        # the blocks of all keys: A ^ t | R[i]
+        blocks = bytearray(2 * word_len * num_keys)
+        blocks_q = memoryview(blocks).cast('Q')
+        for j in range(5, -1, -1):
+            for i in range(key_len, 0, -1):
+                t = key_len * j + i
+                # XOR t into the A of every key at once
+                a_xor_t = int.from_bytes(a, 'big') ^ int.from_bytes(t.to_bytes(word_len, 'big') * num_keys, 'big')
+                blocks_q[0::2] = memoryview(a_xor_t.to_bytes(len(a), 'big')).cast('Q')
+                blocks_q[1::2] = words_q[i::key_len + 1]
+                cipher.decrypt(blocks, output=blocks)
+                a = blocks_q[0::2].tobytes()
+                words_q[i::key_len + 1] = blocks_q[1::2]
+
+        for k, index in enumerate(indices):
+            if a[k*word_len:(k+1)*word_len] == kek_iv:
+                start = k * (key_len + 1) * word_len
+                results[index] = bytes(words[start + word_len:start + (key_len + 1) * word_len])
+    return results
+
+
+def payload_cipher(header: bytes):
+    """
+    Create the AES-CTR cipher for the encrypted payload from the 96-byte
+    `header` at the start of the layer 5 payload
+    """
     # As per instruction:
     # First 32 bytes: The 256-bit key encrypting key (KEK).
-    key_encryption_key = decoded[0:32]
+    key_encryption_key = header[0:32]
     # Next 8 bytes: The 64-bit initialization vector (IV) for
     # the wrapped key.
-    wrapped_key_init_vector = decoded[32:40]
+    wrapped_key_init_vector = header[32:40]
     # Next 40 bytes: The wrapped (encrypted) key. When
     # decrypted, this will become the 256-bit encryption key.
-    wrapped_key = decoded[40:80]
+    wrapped_key = header[40:80]
     # Next 16 bytes: The 128-bit initialization vector (IV) for
     # the encrypted payload.
-    init_vector = decoded[80:96]
-    # All remaining bytes: The encrypted payload.
-    encrypted = decoded[96:]
+    init_vector = header[80:96]
 
     # The first step is to use the KEK and the 64-bit IV to unwrap the wrapped key.
     key = aes_key_unwrap(wrapped_key, key_encryption_key, wrapped_key_init_vector)
     # print("key:", key)
 
     # The second step is to use the unwrapped key and the 128-bit IV to decrypt the rest of the payload.
-    cipher = AES.new(key, AES.MODE_CTR, nonce=b'',initial_value=init_vector)
-    result = cipher.decrypt(pad(encrypted, AES.block_size))
+    AES = aes()
+    return AES.new(key, AES.MODE_CTR, nonce=b'', initial_value=init_vector)
+
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`.
+    Only the 96-byte header is buffered; all remaining bytes (the encrypted
+    payload) are pushed through a single CTR cipher in pieces of at most
+    `chunk_size` bytes, so memory use doesn't depend on the payload size.
+    """
+    header = b''
+    cipher = None
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if cipher is None:
+            missing = HEADER_LEN - len(header)
+            header += bytes(view[:missing])
+            view = view[missing:]
+            if len(header) < HEADER_LEN:
+                continue
+            cipher = payload_cipher(header)
+        for start in range(0, len(view), chunk_size):
+            yield cipher.decrypt(view[start:start + chunk_size])
+
+def decrypt_file(in_file: BinaryIO, out_file: BinaryIO, chunk_size: int = CHUNK_SIZE):
+    """
+    Decrypt the (already Ascii85 decoded) payload in `in_file` into `out_file`
+    reading `chunk_size` bytes at a time
+    """
+    chunks = iter(lambda: in_file.read(chunk_size), b'')
+    for chunk in decode_stream(chunks, chunk_size):
+        out_file.write(chunk)
+
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  seed: int = 0) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: the header with a KEK, a key wrapped with it
+    and the IVs (all chosen with `seed`), followed by the data encrypted with
+    AES-CTR
+    """
+    rng = random.Random(seed)
+    key_encryption_key = rng.randbytes(32)
+    wrapped_key_init_vector = rng.randbytes(8)
+    key = rng.randbytes(32)
+    init_vector = rng.randbytes(16)
+    header = key_encryption_key + wrapped_key_init_vector + \
+        aes_key_wrap(key, key_encryption_key, wrapped_key_init_vector) + init_vector
+    yield header
+    # CTR is symmetric: the cipher of the decoder encrypts as well
+    cipher = payload_cipher(header)
+    for chunk in chunks:
+        yield cipher.encrypt(chunk)
+
+def encode(text: bytes, description: bytes = b'', seed: int = 0) -> bytes:
+    """
+    Encode the text of layer 6 into the text of layer 5
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text], seed)))
+
+def decode(payload: Union[bytes, str], artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Decode layer 5 and write the result to the artifact "layer6"
+    """
+    print("Decoding Layer 5...")
+
+    result = bytearray()
+    decoded = ascii85.decode(payload)
 
+    # CTR is a stream cipher: no padding, so no garbage at the end of the result
+    for chunk in decode_stream([decoded]):
+        result += chunk
 
-    with open("layer6", "wb+") as layer_file:
-        layer_file.write(result)
+    artifacts.write("layer6", result)
 
-    return result
+    return bytes(result)
 
 #%%
 if __name__ == "__main__":
-    with open('layer5', 'r') as payload_file:
-        decode(payload_file.read())
+    layer_artifacts.run_standalone(5, decode_stream)
@@ -1,121 +1,1048 @@
 #!/usr/bin/env python3
 #%%
-from TomsDataOnion.decode import UserError
-import base64
-from typing import Union, Iterable, List
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from types import CodeType
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import artifacts as layer_artifacts
+import ascii85
+
+class UserError(Exception):
+    """ Raised when the VM runs into something it cannot execute """
+
+class BudgetExceeded(UserError):
+    """ Raised when a program does not halt within its step or time budget """
+
+class Cancelled(Exception):
+    """ Raised in a VM whose output isn't read anymore (see `TomtelCorei69.iter_output`) """
+
+# op code -> mnemonic of every instruction the Tomtel Core i69 understands
+OP_CODES: Dict[int, str] = {
+    0x01: 'HALT',
+    0x02: 'OUT',
+
+    0x21: 'JEZ',
+    0x22: 'JNZ',
+
+    0xC1: 'CMP',
+    0xC2: 'ADD',
+    0xC3: 'SUB',
+    0xC4: 'XOR',
+
+    0xE1: 'APTR'
+}
+OP_CODES.update(dict(
+    [(n, 'MV') for n in range(0x49, 0x7F)] +
+    [(n, 'MVI') for n in range(0x48, 0x7F, 8)] +
+    [(n, 'MV32') for n in range(0x89, 0xBF) if (n & 0b00000111) != 7]+
+    [(n, 'MVI32') for n in range(0x88, 0xBF, 8)]
+))
+
+# indices of the registers in `Registers.values`: the 8-bit registers are
+# addressed by the 3-bit register field of the op code, the 32-bit registers
+# by that field + `REG_32_BIT`
+A, B, C, D, E, F = range(1, 7)
+REG_32_BIT = 8
+LA, LB, LC, LD, PTR, PC = range(REG_32_BIT + 1, REG_32_BIT + 7)
+MASK_8_BIT = 0xFF
+MASK_32_BIT = 0xFFFFFFFF
+
+# step limit of a VM that should run until it halts
+UNLIMITED_STEPS = 1 << 62
+
+# snapshot format: magic (with the format version), then zlib compressed
+# header + memory + output
+# header: SHA-256 hash of the original code, steps, halted, 8-bit registers
+#         a..f, 32-bit registers la..pc, memory size, output size
+SNAPSHOT_MAGIC = b'i69\x02'
+SNAPSHOT_HEADER = '<32sQ?6B6III'
+
+# number of instructions between two checkpoints (see `run_checkpointed`)
+CHECKPOINT_STEPS = 10_000_000
+
+# number of instructions between two checks of the time budget of a program
+TIME_CHECK_STEPS = 100_000
+
+# the available execution engines of `TomtelCorei69.run`
+ENGINES = ('interp', 'compiled')
+
+# mnemonic -> size of the instruction (op code + operands) in bytes
+OP_SIZES: Dict[str, int] = {
+    'HALT': 1, 'OUT': 1, 'CMP': 1, 'ADD': 1, 'SUB': 1, 'XOR': 1, 'MV': 1, 'MV32': 1,
+    'APTR': 2, 'MVI': 2,
+    'JEZ': 5, 'JNZ': 5, 'MVI32': 5,
+}
+
+# number of output bytes that are collected before they are passed on
+DEFAULT_CHUNK_SIZE = 1 << 16
+# number of instructions `decode_stream` runs before passing on the output
+STREAM_STEPS = 1 << 20
+# seconds between two checks whether the consumer of `iter_output` is gone
+POLL_INTERVAL = 0.1
+
+# number of code objects of compiled basic blocks kept for other VMs
+BLOCK_CODE_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=BLOCK_CODE_CACHE_SIZE)
+def _compile_block(source: str, pc: int) -> CodeType:
+    """
+    Code object of the source of a compiled basic block, shared by all VMs
+    (e.g. the ones running the same program in a `run_batch` worker)
+    """
+    return compile(source, f"<i69 block {pc}>", 'exec')
 
 def log(*msg):
     """ Prints msg to stdout """
     print(*msg)
     return
 
+class BufferSink:
+    """
+    Collects the output of the VM in a `bytearray`
+    """
+    def __init__(self, buffer: Optional[bytearray] = None):
+        self.buffer: bytearray = bytearray() if buffer is None else buffer
+        self.emit: Callable[[int], Any] = self.buffer.append
+
+    def flush(self):
+        pass
+
+class OutputSink(BufferSink):
+    """
+    Collects the output of the VM and passes it on to `write` in chunks of
+    (at least) `chunk_size` bytes
+    """
+    def __init__(self, write: Callable[[bytes], Any], chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__()
+        self.write = write
+        self.chunk_size = chunk_size
+        self.emit = self._emit
+
+    def _emit(self, value: int):
+        buffer = self.buffer
+        buffer.append(value)
+        if len(buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write(bytes(self.buffer))
+            self.buffer.clear()
+
+Output = Union[None, bytearray, BinaryIO, Callable[[bytes], Any], BufferSink]
+
+def make_sink(output: Output) -> BufferSink:
+    """
+    Create the sink for the output of the VM:
+      * `None` or a `bytearray`: the output is appended to a buffer
+      * a writable file object: the output is written to the file in chunks
+      * a callable: the output is passed to it in chunks
+      * a sink: used as is
+    """
+    if isinstance(output, BufferSink):
+        return output
+    if output is None or isinstance(output, bytearray):
+        return BufferSink(output)
+    if hasattr(output, 'write'):
+        return OutputSink(output.write)
+    if callable(output):
+        return OutputSink(output)
+    raise UserError(f"Cannot write the output of the VM to {output!r}")
+
+
 class TomtelCorei69:
-    def __init__(self, code: Union[bytes, Iterable[int]]):
+    def __init__(self, code: Union[bytes, Iterable[int]], engine: str = 'interp',
+                 output: Output = None):
         """
         Initialize the Tomtel Core i69 VM with the given bytecode.
+        `engine` selects how `run` executes the code (see `ENGINES`).
+        `output` is where the bytes from 'OUT' go (see `make_sink`); by default
+        they are collected in `out_stream`.
         """
+        if engine not in ENGINES:
+            raise UserError(f"Unknown engine '{engine}', expected one of {ENGINES}")
+        self.engine = engine
 
         self.registers = Registers()
-        self.memory: List[bytearray] = bytearray(code)
-        self.out_stream: bytes = b""
+        self.memory: bytearray = bytearray(code)
+        # identifies the program even after it modified itself
+        self.code_digest: bytes = hashlib.sha256(self.memory).digest()
+        self.sink = make_sink(output)
+        self._emit = self.sink.emit
+        self.halted = False
+        # [instructions executed so far, instruction count at which to pause]
+        self._counter: List[int] = [0, UNLIMITED_STEPS]
 
         self._MV_DEST_MASK = 0b00111000
         self._MV_SRC_MASK = 0b00000111
 
+        # opcode-indexed handler array and the per-PC table of decoded
+        # instructions (filled lazily as `run` reaches each pc)
+        self._handlers: List[Optional[Callable]] = self._build_handlers()
+        self._decoded: List[Optional[tuple]] = [None] * len(self.memory)
+
+        # state of the 'compiled' engine: block start pc -> compiled block
+        # (or `False` if the code at pc has to be interpreted), the memory
+        # range of every block and which bytes belong to compiled code
+        self._blocks: Dict[int, Union[Callable[[], int], bool]] = {}
+        self._block_ranges: Dict[int, range] = {}
+        self._compiled_code = bytearray(len(self.memory))
+        self._volatile_code = bytearray(len(self.memory))
+
+    @property
+    def out_stream(self) -> bytes:
+        """
+        Everything the VM has output so far.
+        Only available if the output is collected in a buffer.
+        """
+        if isinstance(self.sink, OutputSink):
+            raise UserError("The output of this VM is passed on to its sink")
+        return bytes(self.sink.buffer)
+
+    def set_sink(self, sink: 'BufferSink'):
+        """
+        Send all further output to `sink`
+        """
+        self.sink = sink
+        self._emit = sink.emit
+        # compiled blocks have the old sink baked in
+        self._blocks.clear()
+        self._block_ranges.clear()
+
+    def snapshot(self) -> bytes:
+        """
+        Serialize the state of the VM (registers, memory, the output collected
+        in its buffer and the number of executed steps) into a compact binary
+        snapshot that `from_snapshot` can resume from
+        """
+        output = b'' if isinstance(self.sink, OutputSink) else self.sink.buffer
+        values = self.registers.values
+        header = struct.pack(SNAPSHOT_HEADER, self.code_digest, self.steps, self.halted,
+                             *values[A:F+1], *values[LA:PC+1], len(self.memory), len(output))
+        return SNAPSHOT_MAGIC + zlib.compress(header + self.memory + output)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: bytes, engine: str = 'interp',
+                      output: Output = None) -> 'TomtelCorei69':
+        """
+        Create a VM that continues where the VM that took `snapshot` stopped.
+        The output stored in the snapshot is passed on to `output` first.
+        """
+        if not snapshot.startswith(SNAPSHOT_MAGIC[:-1]):
+            raise UserError("Not a Tomtel Core i69 snapshot")
+        if not snapshot.startswith(SNAPSHOT_MAGIC):
+            raise UserError(f"Unsupported version {snapshot[len(SNAPSHOT_MAGIC) - 1]} of the snapshot format")
+        state = zlib.decompress(snapshot[len(SNAPSHOT_MAGIC):])
+        header_size = struct.calcsize(SNAPSHOT_HEADER)
+        code_digest, steps, halted, *registers, memory_size, output_size = \
+            struct.unpack_from(SNAPSHOT_HEADER, state)
+        memory = state[header_size:header_size + memory_size]
+        saved_output = state[header_size + memory_size:header_size + memory_size + output_size]
+
+        VM = cls(memory, engine, output)
+        VM.code_digest = code_digest
+        VM.registers.values[A:F+1] = registers[:6]
+        VM.registers.values[LA:PC+1] = registers[6:]
+        VM._counter[0] = steps
+        VM.halted = bool(halted)
+        if saved_output:
+            if isinstance(VM.sink, OutputSink):
+                VM.sink.write(saved_output)
+            else:
+                VM.sink.buffer += saved_output
+        return VM
+
     def write_to_memory(self, value: int):
         """
         Write the value `value` to the memory location where the memory cursor
         (i.e. ptr+c) is currently at
         """
-        self.memory[self.registers.ptr + self.registers.c] = value
+        values = self.registers.values
+        self.store(values[PTR] + values[C], value)
+
+    def store(self, address: int, value: int) -> bool:
+        """
+        Write the value `value` to the memory location `address` and throw away
+        everything that was decoded or compiled from the old value.
+        Returns `True` if `address` was part of a compiled block.
+        """
+        self.memory[address] = value
+        # an instruction starting up to 4 bytes before `address` may have
+        # `address` as one of its operands -> forget how we decoded it
+        self._decoded[max(0, address - 4):address + 1] = [None] * (min(address, 4) + 1)
+        if not self._compiled_code[address]:
+            return False
+        # self-modifying code: from now on this byte is only ever interpreted
+        self._volatile_code[address] = 1
+        for start, block_range in list(self._block_ranges.items()):
+            if address in block_range:
+                del self._blocks[start]
+                del self._block_ranges[start]
+        return True
 
     def read_from_memory(self) -> int:
         """
         Get the value that is located at the memory location where the memory cursor
         (i.e. ptr+c) is currently at
         """
-        return self.memory[self.registers.ptr + self.registers.c]
+        values = self.registers.values
+        return self.memory[values[PTR] + values[C]]
+
+    def decode_at(self, pc: int) -> tuple:
+        """
+        Decode the instruction at `pc` into a `(handler, size, arg)` tuple and
+        store it in the per-PC table so that it is only decoded once.
+        `arg` is the pre-decoded immediate value of the instruction.
+        """
+        op_code = self.memory[pc]
+        handler = self._handlers[op_code]
+        if handler is None:
+            raise UserError(f"Unknown instruction 0x{op_code:02x} at pc {pc}")
+        size = OP_SIZES[OP_CODES[op_code]]
+        arg = int.from_bytes(self.memory[pc+1:pc+size], 'little')
+        entry = (handler, size, arg)
+        self._decoded[pc] = entry
+        return entry
 
-    def run(self):
+    def step(self) -> bool:
+        """
+        Execute the single instruction at pc.
+        Returns `True` if that instruction was 'HALT'.
+        """
+        values = self.registers.values
+        pc = values[PC]
+        handler, size, arg = self._decoded[pc] or self.decode_at(pc)
+        values[PC] = pc + size
+        self._counter[0] += 1
+        return bool(handler(arg))
+
+    @property
+    def steps(self) -> int:
+        """
+        Number of instructions executed so far
+        """
+        return self._counter[0]
+
+    def run(self, profile: Optional['Profile'] = None, max_steps: Optional[int] = None) -> bool:
         """
         Run the Tomtel Core i69 VM with its code.
         Stops upon reading the 'HALT' instruction.
+        If `profile` is given, the code is run by the (slower) profiling
+        interpreter which records its statistics into `profile`.
+        If `max_steps` is given, the VM pauses after executing that many
+        instructions (the compiled engine only pauses between two blocks, so it
+        may execute a few more). Calling `run` again resumes the execution.
+        Returns `True` if the VM halted and `False` if it was paused.
+        """
+        if self.halted:
+            return True
+        self._counter[1] = UNLIMITED_STEPS if max_steps is None else self.steps + max_steps
+        try:
+            if profile is not None:
+                self.halted = self._run_profiled(profile)
+            elif self.engine == 'compiled':
+                self.halted = self._run_compiled()
+            else:
+                self.halted = self._run_interpreted()
+        finally:
+            self.sink.flush()
+        return self.halted
+
+    def iter_output(self, chunk_size: int = DEFAULT_CHUNK_SIZE, max_pending: int = 16) -> Iterator[bytes]:
+        """
+        Run the VM in a background thread and yield its output in chunks of
+        `chunk_size` bytes while it is still running.
+        At most `max_pending` chunks are buffered if the consumer is slower
+        than the VM. If the consumer stops early (i.e. closes the generator),
+        the VM stops as well, at the latest after `STREAM_STEPS` instructions.
+        The sink of the VM is restored once its thread ends.
+        """
+        chunks: queue.Queue = queue.Queue(max_pending)
+        cancelled = threading.Event()
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    chunks.put(item, timeout=POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+            raise Cancelled("The output of the VM isn't read anymore")
+
+        previous_sink = self.sink
+        self.set_sink(OutputSink(put, chunk_size))
+
+        def run():
+            end = None
+            try:
+                while not self.run(max_steps=STREAM_STEPS) and not cancelled.is_set():
+                    pass
+            except Cancelled:
+                pass
+            except BaseException as error:
+                end = error
+            finally:
+                self.set_sink(previous_sink)
+            try:
+                put(end)
+            except Cancelled:
+                pass
+
+        threading.Thread(target=run, name="i69", daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            cancelled.set()
+
+    def _run_interpreted(self) -> bool:
+        """
+        Run the code by dispatching every instruction through the handler array
+        """
+        values = self.registers.values
+        decoded = self._decoded
+        counter = self._counter
+        steps, max_steps = counter
+        try:
+            while steps < max_steps:
+                # 1. Read the next instruction (decoding it if we haven't seen it yet)
+                pc = values[PC]
+                entry = decoded[pc] or self.decode_at(pc)
+                handler, size, arg = entry
+                # 2. Increment pc register by the size of the current instruction
+                values[PC] = pc + size
+                steps += 1
+                # 3. Execute the instruction; only HALT returns `True`
+                if handler(arg):
+                    return True
+            return False
+        finally:
+            counter[0] = steps
+
+    def _run_profiled(self, profile: 'Profile') -> bool:
+        """
+        Same as `_run_interpreted` but counts how often every pc and op code
+        is executed and how often the instruction at a pc jumped
+        """
+        values = self.registers.values
+        decoded = self._decoded
+        memory = self.memory
+        profile.resize(len(memory))
+        op_code_hits = profile.op_code_hits
+        pc_hits = profile.pc_hits
+        jumps = profile.jumps
+        code = profile.code
+        counter = self._counter
+        steps, max_steps = counter
+        start = time.perf_counter()
+        try:
+            while steps < max_steps:
+                pc = values[PC]
+                handler, size, arg = decoded[pc] or self.decode_at(pc)
+                op_code_hits[memory[pc]] += 1
+                if not pc_hits[pc]:
+                    code[pc] = bytes(memory[pc:pc + size])
+                pc_hits[pc] += 1
+                values[PC] = pc + size
+                steps += 1
+                if handler(arg):
+                    return True
+                if values[PC] != pc + size:
+                    jumps[pc] += 1
+            return False
+        finally:
+            counter[0] = steps
+            profile.seconds += time.perf_counter() - start
+            profile.memory = bytes(memory)
+
+    def _run_compiled(self) -> bool:
+        """
+        Run the code as compiled basic blocks.
+        Every block returns the pc of the block to continue with (or -1 after
+        'HALT'). Code that cannot be compiled is interpreted one instruction
+        at a time until we reach the start of a block again.
+        """
+        blocks = self._blocks
+        values = self.registers.values
+        counter = self._counter
+        pc = values[PC]
+        while pc >= 0:
+            if counter[0] >= counter[1]:
+                return False
+            block = blocks.get(pc)
+            if block is None:
+                block = self.compile_block(pc)
+            if block is False:
+                pc = -1 if self.step() else values[PC]
+            else:
+                pc = block()
+        return True
+
+    def compile_block(self, pc: int) -> Union[Callable[[], int], bool]:
+        """
+        Compile the basic block starting at `pc` and remember it for later runs.
+        Returns `False` if the instruction at `pc` has to be interpreted instead.
+        """
+        block_source = BlockCompiler(self.memory, self._volatile_code).compile(pc)
+        if block_source is None:
+            self._blocks[pc] = False
+            return False
+        source, end = block_source
+        code = _compile_block(source, pc)
+        namespace: Dict[str, Callable] = {}
+        exec(code, namespace)
+        block = namespace['make_block'](self.registers.values, self.memory, self.store,
+                                        self._emit, self._counter)
+        self._blocks[pc] = block
+        self._block_ranges[pc] = range(pc, end)
+        self._compiled_code[pc:end] = b'\x01' * (end - pc)
+        return block
+
+    def _build_handlers(self) -> List[Optional[Callable]]:
+        """
+        Build the opcode-indexed handler array.
+        Every handler takes the decoded immediate value of its instruction.
+        The register indices of MV(I)(32) are baked into their handlers here so
+        that `run` does not need to look at the op code again.
+        """
+        values = self.registers.values
+
+        ## ADD a <- b
+        def add(_):
+            values[A] = (values[A] + values[B]) & MASK_8_BIT
+
+        ## APTR imm8
+        def aptr(imm_value: int):
+            values[PTR] = (values[PTR] + imm_value) & MASK_32_BIT # overflow is undefined
+
+        ## CMP
+        def cmp(_):
+            values[F] = int(values[A] != values[B])
+
+        ## HALT
+        def halt(_) -> bool:
+            return True
+
+        ## JEZ imm32
+        def jez(imm_value: int):
+            if values[F] == 0:
+                values[PC] = imm_value
+
+        ## JNZ imm32
+        def jnz(imm_value: int):
+            if values[F] != 0:
+                values[PC] = imm_value
+
+        ## OUT a
+        def out(_):
+            self._emit(values[A])
+
+        ## SUB a <- b
+        def sub(_):
+            values[A] = (values[A] - values[B]) & MASK_8_BIT
+
+        ## XOR a <- b
+        def xor(_):
+            values[A] ^= values[B]
+
+        simple_ops = {
+            'HALT': halt,
+            'OUT': out,
+            'JEZ': jez,
+            'JNZ': jnz,
+            'CMP': cmp,
+            'ADD': add,
+            'SUB': sub,
+            'XOR': xor,
+            'APTR': aptr,
+        }
+        handlers: List[Optional[Callable]] = [None] * 256
+        for op_code, op_name in OP_CODES.items():
+            dest = (op_code & self._MV_DEST_MASK) >> 3
+            src = op_code & self._MV_SRC_MASK
+            is_32_bit = op_name in ('MV32', 'MVI32')
+            if op_name in simple_ops:
+                handlers[op_code] = simple_ops[op_name]
+            elif op_name in ('MV', 'MV32'):
+                handlers[op_code] = self._make_mv(dest, src, is_32_bit)
+            else:
+                handlers[op_code] = self._make_mvi(dest, is_32_bit)
+        return handlers
+
+    def _make_mv(self, dest: int, src: int, is_32_bit: bool) -> Callable:
+        """
+        Create the handler for MV(32) {dest} <- {src}
+        """
+        values = self.registers.values
+        offset = REG_32_BIT if is_32_bit else 0
+        if dest == 7:
+            def mv_to_memory(_):
+                self.store(values[PTR] + values[C], values[src + offset])
+            return mv_to_memory
+        if src == 7:
+            memory = self.memory
+            def mv_from_memory(_):
+                values[dest] = memory[values[PTR] + values[C]]
+            return mv_from_memory
+        def mv(_):
+            values[dest + offset] = values[src + offset]
+        return mv
+
+    def _make_mvi(self, dest: int, is_32_bit: bool) -> Callable:
         """
-        inst = Instruction(self.memory[0], self.memory[1:])
+        Create the handler for MVI(32) {dest} <- imm
+        """
+        values = self.registers.values
+        if dest == 7:
+            return self.write_to_memory
+        index = dest + REG_32_BIT if is_32_bit else dest
+        def mvi(imm_value: int):
+            values[index] = imm_value
+        return mvi
+
+
+class BlockCompiler:
+    """
+    Translates a basic block of i69 bytecode into Python source.
+
+    A block starts at a jump target (or the instruction after a jump) and ends
+    with the first instruction that changes control flow ('JEZ', 'JNZ', 'HALT'
+    or a write to pc). Registers are kept in local variables for the whole
+    block. A block that jumps back to its own start is turned into a `while`
+    loop so that tight loops never leave the generated function (unless the
+    VM has to pause after a number of steps).
+    Every block adds the number of instructions it executed to `counter[0]`.
+    """
+
+    REG_NAMES_8 = (None, 'a', 'b', 'c', 'd', 'e', 'f')
+    REG_NAMES_32 = (None, 'la', 'lb', 'lc', 'ld', 'ptr', 'pc')
+
+    def __init__(self, memory: bytearray, volatile_code: bytearray):
+        self.memory = memory
+        self.volatile_code = volatile_code
+        self.used_regs: List[str] = []
+
+    def reg(self, index: int, is_32_bit: bool) -> str:
+        """
+        Get the local variable name of the register `index`
+        """
+        name = (self.REG_NAMES_32 if is_32_bit else self.REG_NAMES_8)[index]
+        if name != 'pc' and name not in self.used_regs:
+            self.used_regs.append(name)
+        return name
+
+    def decode(self, pc: int) -> Optional[Tuple[int, str, int, int]]:
+        """
+        Decode the instruction at `pc` into `(op_code, op_name, size, imm_value)`
+        or return `None` if it must not be compiled (unknown, truncated or
+        overwritten at runtime)
+        """
+        if pc >= len(self.memory) or self.memory[pc] not in OP_CODES:
+            return None
+        op_code = self.memory[pc]
+        op_name = OP_CODES[op_code]
+        size = OP_SIZES[op_name]
+        if pc + size > len(self.memory) or any(self.volatile_code[pc:pc+size]):
+            return None
+        return op_code, op_name, size, int.from_bytes(self.memory[pc+1:pc+size], 'little')
+
+    def compile(self, start: int) -> Optional[Tuple[str, int]]:
+        """
+        Generate the source of the block starting at `start`.
+        Returns the source and the end (exclusive) of the block in memory or
+        `None` if the first instruction cannot be compiled.
+        """
+        body: List[str] = []
+        pc = end = start
+        loop = False
+        exit_pc: Optional[str] = None
+        count = 0 # number of instructions up to (including) the current one
         while True:
-            # log('Reading instruction', self.registers.pc)
-            # 1. Read the next instruction
-            inst = Instruction(self.memory[self.registers.pc], self.memory[self.registers.pc+1:])
-            # 2. Increment pc register by the size of the current instruction
-            self.registers.pc += inst.size
-            # 3. Execute the instruction
-            ## ADD a <- b
-            if inst.op_name == 'ADD':
-                self.registers.a = (self.registers.a + self.registers.b) % 256
-
-            ## APTR imm8
-            elif inst.op_name == 'APTR':
-                self.registers.ptr += inst.operands[0] # overflow is undefined
-
-            ## CMP
-            elif inst.op_name == 'CMP':
-                self.registers.f = int(self.registers.a != self.registers.b)
-
-            ## HALT
-            elif inst.op_name == 'HALT':
+            inst = self.decode(pc)
+            if inst is None:
+                if pc == start:
+                    return None
+                exit_pc = str(pc)
                 break
-
-            ## JEZ imm32
-            elif inst.op_name == 'JEZ':
-                if self.registers.f == 0:
-                    self.registers.pc = inst.operands_to_int()
-
-            ## JNZ imm32
-            elif inst.op_name == 'JNZ':
-                if self.registers.f != 0:
-                    self.registers.pc = inst.operands_to_int()
-
-            ## MV(32) {dest} <- {src}
-            elif inst.op_name in ('MV', 'MV32'):
-                dest = (inst.op_code & self._MV_DEST_MASK) >> 3
-                src = inst.op_code & self._MV_SRC_MASK
-                # log(f"{inst.op_name} from {src} to {dest}")
-                if 7 not in (dest, src):
-                    self.registers.move_by_index(dest, src, inst.op_name == 'MV32')
+            op_code, op_name, size, imm_value = inst
+            next_pc = end = pc + size
+            count += 1
+            dest = (op_code & 0b00111000) >> 3
+            src = op_code & 0b00000111
+            if op_name == 'ADD':
+                body.append(f"{self.reg(1, False)} = (a + {self.reg(2, False)}) % 256")
+            elif op_name == 'SUB':
+                body.append(f"{self.reg(1, False)} = (a - {self.reg(2, False)} + 256) % 256")
+            elif op_name == 'XOR':
+                body.append(f"{self.reg(1, False)} ^= {self.reg(2, False)}")
+            elif op_name == 'CMP':
+                body.append(f"{self.reg(6, False)} = int({self.reg(1, False)} != {self.reg(2, False)})")
+            elif op_name == 'APTR':
+                body.append(f"{self.reg(5, True)} = ({self.reg(5, True)} + {imm_value}) & {MASK_32_BIT}")
+            elif op_name == 'OUT':
+                body.append(f"emit({self.reg(1, False)})")
+            elif op_name == 'HALT':
+                exit_pc = '-1'
+                body.append(f"values[{PC}] = {next_pc}")
+                break
+            elif op_name in ('JEZ', 'JNZ'):
+                condition = f"{self.reg(6, False)} {'==' if op_name == 'JEZ' else '!='} 0"
+                if imm_value == start:
+                    loop = True
+                    body.append(f"steps += {count}")
+                    body.append(f"if {condition}:")
+                    body.append(f"    if steps < max_steps: continue")
+                    body.extend('    ' + line for line in self.exit_lines(str(start), "steps"))
+                    exit_pc = str(next_pc)
+                else:
+                    exit_pc = f"{imm_value} if {condition} else {next_pc}"
+                break
+            elif op_name in ('MV', 'MV32', 'MVI', 'MVI32'):
+                is_32_bit = op_name in ('MV32', 'MVI32')
+                if op_name in ('MVI', 'MVI32'):
+                    value = str(imm_value)
+                elif src == 7:
+                    value = f"memory[{self.reg(5, True)} + {self.reg(3, False)}]"
+                elif is_32_bit and src == 6:
+                    value = str(next_pc)
                 else:
-                    if dest == 7:
-                        self.write_to_memory(self.registers.from_index(src, inst.op_name == 'MV32'))
-                    elif src == 7:
-                        self.registers.write_word_by_index(dest, self.read_from_memory())
-                    else:
-                        raise UserError("Something's wrong here...")
-
-            ## MVI(32) {dest} <- {src}
-            elif inst.op_name in ('MVI', 'MVI32'):
-                dest = (inst.op_code & self._MV_DEST_MASK) >> 3
-                imm_value = inst.operands_to_int()
-                if dest != 7:
-                    self.registers.move_imm_by_index(dest, imm_value, inst.op_name == 'MVI32')
+                    value = self.reg(src, is_32_bit)
+                if dest == 7:
+                    # a write into compiled code ends the block right away
+                    body.append(f"if store({self.reg(5, True)} + {self.reg(3, False)}, {value}):")
+                    body.extend('    ' + line for line in self.exit_lines(
+                        str(next_pc), f"steps + {count}" if loop else str(count)))
+                elif is_32_bit and dest == 6:
+                    exit_pc = value
+                    break
                 else:
-                    self.write_to_memory(imm_value)
+                    body.append(f"{self.reg(dest, is_32_bit)} = {value}")
+            pc = next_pc
+
+        lines = ["def make_block(values, memory, store, emit, counter):",
+                 "    def block():"]
+        lines.extend(f"        {name} = values[{Registers.INDEX[name]}]" for name in self.used_regs)
+        indent = "        "
+        if loop:
+            lines.append(indent + "steps = 0")
+            lines.append(indent + "max_steps = counter[1] - counter[0]")
+            lines.append(indent + "while True:")
+            indent += "    "
+        lines.extend(indent + line for line in body)
+        if loop:
+            lines.append(indent + "break")
+        lines.extend("        " + line for line in self.exit_lines(exit_pc, "steps" if loop else str(count)))
+        lines.append("    return block")
+        return "\n".join(lines) + "\n", end
 
-            ## OUT a
-            elif inst.op_name == 'OUT':
-                self.out_stream += bytes([self.registers.a])
+    def exit_lines(self, exit_pc: str, steps: str) -> List[str]:
+        """
+        Lines that write the locals back to the registers, count the `steps`
+        executed instructions and leave the block
+        """
+        lines = [f"values[{Registers.INDEX[name]}] = {name}" for name in self.used_regs]
+        lines.append(f"counter[0] += {steps}")
+        if exit_pc == '-1':
+            return lines + ["return -1"]
+        return lines + [f"values[{PC}] = pc = {exit_pc}", "return pc"]
 
-            ## SUB a <- b
-            elif inst.op_name == 'SUB':
-                self.registers.a = (self.registers.a - self.registers.b + 256) % 256
 
-            ## XOR a <- b
-            elif inst.op_name == 'XOR':
-                self.registers.a ^= self.registers.b
+class Profile:
+    """
+    Execution statistics of a profiled VM run (see `TomtelCorei69.run`)
+    """
+    def __init__(self):
+        self.op_code_hits: List[int] = [0] * 256
+        self.pc_hits: List[int] = []
+        self.jumps: List[int] = []
+        self.seconds: float = 0.0
+        self.memory: bytes = b''
+        # pc -> bytes of the instruction first executed there (the code may
+        # modify itself, so `memory` can hold something else by the end)
+        self.code: Dict[int, bytes] = {}
 
-            else:
-                raise UserError(f"Unknown instruction {inst}")
+    def resize(self, memory_size: int):
+        """
+        Make room for the per-pc counters of a memory with `memory_size` bytes
+        """
+        missing = memory_size - len(self.pc_hits)
+        if missing > 0:
+            self.pc_hits += [0] * missing
+            self.jumps += [0] * missing
+
+    @property
+    def instructions(self) -> int:
+        return sum(self.op_code_hits)
+
+    @property
+    def instructions_per_second(self) -> float:
+        return self.instructions / self.seconds if self.seconds else 0.0
+
+    def op_counts(self) -> Dict[str, int]:
+        """
+        Number of executed instructions per mnemonic
+        """
+        counts: Dict[str, int] = {}
+        for op_code, hits in enumerate(self.op_code_hits):
+            if hits:
+                op_name = OP_CODES[op_code]
+                counts[op_name] = counts.get(op_name, 0) + hits
+        return counts
+
+    def memory_accesses(self) -> Tuple[int, int]:
+        """
+        Number of memory reads and writes, i.e. of MV(I)(32) with (ptr+c) as
+        source or destination
+        """
+        reads = writes = 0
+        for op_code, hits in enumerate(self.op_code_hits):
+            if hits and OP_CODES[op_code].startswith('MV'):
+                if (op_code & 0b00111000) >> 3 == 7:
+                    writes += hits
+                elif OP_CODES[op_code] in ('MV', 'MV32') and op_code & 0b00000111 == 7:
+                    reads += hits
+        return reads, writes
+
+    def branches(self) -> Dict[int, Dict[str, Any]]:
+        """
+        Taken/not-taken statistics of every executed JEZ/JNZ by pc
+        """
+        branches = {}
+        for pc, hits in enumerate(self.pc_hits):
+            op_name = OP_CODES[self.code[pc][0]] if hits else None
+            if op_name in ('JEZ', 'JNZ'):
+                taken = self.jumps[pc]
+                branches[pc] = {
+                    'op': op_name,
+                    'taken': taken,
+                    'not_taken': hits - taken,
+                    'taken_ratio': taken / hits,
+                }
+        return branches
+
+    def to_dict(self) -> Dict[str, Any]:
+        reads, writes = self.memory_accesses()
+        return {
+            'instructions': self.instructions,
+            'seconds': self.seconds,
+            'instructions_per_second': self.instructions_per_second,
+            'op_counts': self.op_counts(),
+            'pc_hits': {pc: hits for pc, hits in enumerate(self.pc_hits) if hits},
+            'branches': self.branches(),
+            'memory_reads': reads,
+            'memory_writes': writes,
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def report(self, top: int = 20) -> str:
+        """
+        Flat report of the `top` most executed instructions
+        """
+        total = self.instructions or 1
+        reads, writes = self.memory_accesses()
+        lines = [
+            f"{self.instructions} instructions in {self.seconds:.3f}s "
+            f"({self.instructions_per_second:,.0f} instructions/s), "
+            f"{reads} memory reads, {writes} memory writes",
+            f"{'pc':>10} {'hits':>12} {'%':>6}  instruction",
+        ]
+        hot_spots = sorted((hits, pc) for pc, hits in enumerate(self.pc_hits) if hits)
+        for hits, pc in hot_spots[::-1][:top]:
+            inst = Instruction(self.code[pc][0], self.code[pc][1:])
+            line = f"{pc:>10} {hits:>12} {100 * hits / total:>6.2f}  {inst.op_name}"
+            if inst.operands:
+                line += f" 0x{inst.operands_to_int():x}"
+            if inst.op_name in ('JEZ', 'JNZ'):
+                line += f" (taken {100 * self.jumps[pc] / hits:.1f}%)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class RunCache:
+    """
+    Outputs of finished VM runs keyed by the SHA-256 hash of their bytecode.
+    The outputs are kept in memory and, if `directory` is given, on disk so
+    that other processes can reuse them as well.
+    """
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._outputs: Dict[str, bytes] = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
 
-            # log(self.registers)
+    @staticmethod
+    def key(code: bytes) -> str:
+        return hashlib.sha256(code).hexdigest()
 
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.out')
+
+    def get(self, code: bytes) -> Optional[bytes]:
+        """
+        Get the output of `code` if it has been run before
+        """
+        key = self.key(code)
+        output = self._outputs.get(key)
+        if output is None and self.directory is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as output_file:
+                output = self._outputs[key] = output_file.read()
+        return output
+
+    def put(self, code: bytes, output: bytes):
+        """
+        Remember `output` as the output of `code`
+        """
+        key = self.key(code)
+        self._outputs[key] = output
+        if self.directory is not None:
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as output_file:
+                output_file.write(output)
+            os.replace(tmp_path, self._path(key))
+
+    def run(self, code: bytes, engine: str = 'interp') -> bytes:
+        """
+        Get the output of `code`, running it only if it is not cached yet
+        """
+        output = self.get(code)
+        if output is None:
+            VM = TomtelCorei69(code, engine)
+            VM.run()
+            output = VM.out_stream
+            self.put(code, output)
+        return output
+
+def run_checkpointed(code: bytes, checkpoint: str, engine: str = 'interp',
+                     checkpoint_steps: int = CHECKPOINT_STEPS) -> 'TomtelCorei69':
+    """
+    Run `code` to completion and save a snapshot of the VM to the file
+    `checkpoint` every `checkpoint_steps` instructions.
+    If `checkpoint` already exists, the run resumes from that snapshot,
+    unless it was taken of another program or in another snapshot format;
+    then it starts over.
+    The checkpoint is removed once the VM halted.
+    """
+    VM = None
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as checkpoint_file:
+            snapshot = checkpoint_file.read()
+        try:
+            VM = TomtelCorei69.from_snapshot(snapshot, engine)
+        except UserError as error:
+            print(f"Ignoring the checkpoint {checkpoint}: {error}")
+        else:
+            if VM.code_digest != hashlib.sha256(code).digest():
+                print(f"Ignoring the checkpoint {checkpoint}: it was taken of another program")
+                VM = None
+    if VM is None:
+        VM = TomtelCorei69(code, engine)
+    while not VM.run(max_steps=checkpoint_steps):
+        with open(checkpoint + '.tmp', 'wb') as checkpoint_file:
+            checkpoint_file.write(VM.snapshot())
+        os.replace(checkpoint + '.tmp', checkpoint)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return VM
+
+
+class BatchResult(NamedTuple):
+    """
+    Outcome of one program of a batch run (see `run_batch`)
+    """
+    output: Optional[bytes]  # `None` if the program failed
+    error: Optional[str]     # why the program failed
+    steps: int
+    seconds: float
+
+# bytes of plain text that may come before an Ascii85 payload (no control
+# characters except whitespace) and bytes the payload itself consists of
+TEXT_BYTES = ascii85.WHITESPACE + bytes(range(0x20, 0x7F))
+PAYLOAD_BYTES = ascii85.WHITESPACE + ascii85.GROUP_CHARS + b'z'
+
+def is_ascii85_payload(program: bytes) -> bool:
+    """
+    Whether `program` is an Ascii85 encoded payload (`<~ ... ~>` with only
+    plain text before it) rather than bytecode, which may well contain the
+    bytes of '<~' and '~>' as well
+    """
+    start = program.find(b'<~')
+    end = program.find(b'~>', start + 2)
+    return start >= 0 and end >= 0 and \
+        not program[:start].translate(None, TEXT_BYTES) and \
+        not program[start + 2:end].translate(None, PAYLOAD_BYTES)
+
+def run_program(program: bytes, engine: str = 'interp', max_steps: Optional[int] = None,
+                max_seconds: Optional[float] = None, encoded: Optional[bool] = None) -> BatchResult:
+    """
+    Run a single program of a batch. `program` is either bytecode or (with
+    `encoded`) an Ascii85 encoded payload (`<~ ... ~>`, possibly with text
+    around it). If `encoded` is `None`, this is guessed with
+    `is_ascii85_payload`.
+    Errors are reported in the result instead of being raised.
+    """
+    start = time.perf_counter()
+    VM: Optional[TomtelCorei69] = None
+    try:
+        if encoded is None:
+            encoded = is_ascii85_payload(program)
+        if encoded:
+            program = ascii85.decode(program)
+        VM = TomtelCorei69(program, engine)
+        if max_seconds is None:
+            if not VM.run(max_steps=max_steps):
+                raise BudgetExceeded(f"Did not halt within {max_steps} steps")
+        else:
+            steps_left = UNLIMITED_STEPS if max_steps is None else max_steps
+            while not VM.run(max_steps=min(TIME_CHECK_STEPS, steps_left)):
+                steps_left = (UNLIMITED_STEPS if max_steps is None else max_steps) - VM.steps
+                if steps_left <= 0:
+                    raise BudgetExceeded(f"Did not halt within {max_steps} steps")
+                if time.perf_counter() - start > max_seconds:
+                    raise BudgetExceeded(f"Did not halt within {max_seconds}s")
+        return BatchResult(VM.out_stream, None, VM.steps, time.perf_counter() - start)
+    except Exception as error:
+        steps = VM.steps if VM is not None else 0
+        return BatchResult(None, f"{type(error).__name__}: {error}", steps, time.perf_counter() - start)
+
+def run_batch(programs: Iterable[bytes], workers: Optional[int] = None, engine: str = 'interp',
+              max_steps: Optional[int] = None, max_seconds: Optional[float] = None,
+              encoded: Optional[bool] = None) -> List[BatchResult]:
+    """
+    Run many independent programs (bytecode or Ascii85 payloads, see
+    `run_program` for `encoded`) on a pool of `workers` processes (default:
+    one per CPU) and return their results in the order of `programs`.
+    A program that fails or exceeds `max_steps`/`max_seconds` only fails its
+    own result.
+    """
+    programs = [bytes(program) for program in programs]
+    if workers == 1 or len(programs) <= 1:
+        return [run_program(program, engine, max_steps, max_seconds, encoded) for program in programs]
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(programs) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(run_program, programs,
+                                 [engine] * len(programs),
+                                 [max_steps] * len(programs),
+                                 [max_seconds] * len(programs),
+                                 [encoded] * len(programs),
+                                 chunksize=chunksize))
 
 class Instruction:
     def __init__(self, op_code: int, code: Union[bytes, Iterable[int]]):
@@ -124,41 +1051,13 @@ class Instruction:
         operands given in `code`. Takes only as many operands from `code` as the
         Instruction expects.
         """
-        self.possible_op_codes = {
-            0x01: 'HALT',
-            0x02: 'OUT',
-
-            0x21: 'JEZ',
-            0x22: 'JNZ',
-
-            0xC1: 'CMP',
-            0xC2: 'ADD',
-            0xC3: 'SUB',
-            0xC4: 'XOR',
-
-            0xE1: 'APTR'
-        }
-        self.possible_op_codes.update(dict(
-            [(n, 'MV') for n in range(0x49, 0x7F)] +
-            [(n, 'MVI') for n in range(0x48, 0x7F, 8)] +
-            [(n, 'MV32') for n in range(0x89, 0xBF) if (n & 0b00000111) != 7]+
-            [(n, 'MVI32') for n in range(0x88, 0xBF, 8)]
-        ))
+        self.possible_op_codes = OP_CODES
 
         self.op_code: int = op_code
         self.op_name: str = self.possible_op_codes[op_code]
-        self.size: int # size = size(op_code) + size(operands); to be filled later
+        self.size: int = OP_SIZES[self.op_name] # size = size(op_code) + size(operands)
         self.operands: List[int] # to be filled later
 
-        # log(['0x'+format(i, '02x')+':'+n for (i,n) in self.possible_op_codes.items()])
-
-        if self.op_name in ('JEZ', 'JNZ', 'MVI32'):
-            self.size = 5
-        elif self.op_name in ('APTR', 'MVI'):
-            self.size = 2
-        else:
-            self.size = 1
-
         # log(f"Instruction with code 0x{op_code:02x} expects {self.size-1} operands")
 
         self.operands = code[:self.size-1]
@@ -185,36 +1084,63 @@ class Instruction:
         return res
 
 class Registers:
+    """
+    Register file of the Tomtel Core i69.
+
+    All registers live in the list `values`, indexed by the 3-bit register
+    field of the op codes (`A`..`F`) for the 8-bit registers and by that field
+    plus `REG_32_BIT` (`LA`..`PC`) for the 32-bit ones.
+    """
+    __slots__ = ('values',)
+
+    # register name -> index in `values`
+    INDEX = {
+        'a': A, 'b': B, 'c': C, 'd': D, 'e': E, 'f': F,
+        'la': LA, 'lb': LB, 'lc': LC, 'ld': LD, 'ptr': PTR, 'pc': PC,
+    }
+
+    word_index_attr_map = {
+        1:  'a',
+        2:  'b',
+        3:  'c',
+        4:  'd',
+        5:  'e',
+        6:  'f',
+        7:  'la',
+        8:  'lb',
+        9:  'lc',
+        10: 'ld',
+        11: 'ptr',
+        12: 'pc'
+    }
+
     def __init__(self):
-        # 8-bit registers
-        self.a: int = 0   # accumulation reg
-        self.b: int = 0   # operand reg
-        self.c: int = 0   # count/offset reg
-        self.d: int = 0   # general purpose reg
-        self.e: int = 0   # general purpose reg
-        self.f: int = 0   # flags reg
-        # 32-bit registers
-        self.la:  int = 0 # general purpose reg
-        self.lb:  int = 0 # general purpose reg
-        self.lc:  int = 0 # general purpose reg
-        self.ld:  int = 0 # general purpose reg
-        self.ptr: int = 0 # pointer to memory
-        self.pc:  int = 0 # program counter
-
-        self.word_index_attr_map = {
-            1:  'a',
-            2:  'b',
-            3:  'c',
-            4:  'd',
-            5:  'e',
-            6:  'f',
-            7:  'la',
-            8:  'lb',
-            9:  'lc',
-            10: 'ld',
-            11: 'ptr',
-            12: 'pc'
-        }
+        self.values: List[int] = [0] * 16
+
+    def _register(index: int) -> property:
+        mask = MASK_32_BIT if index >= REG_32_BIT else MASK_8_BIT
+        def get(self) -> int:
+            return self.values[index]
+        def set(self, value: int):
+            self.values[index] = value & mask
+        return property(get, set)
+
+    # 8-bit registers
+    a = _register(A)    # accumulation reg
+    b = _register(B)    # operand reg
+    c = _register(C)    # count/offset reg
+    d = _register(D)    # general purpose reg
+    e = _register(E)    # general purpose reg
+    f = _register(F)    # flags reg
+    # 32-bit registers
+    la = _register(LA)  # general purpose reg
+    lb = _register(LB)  # general purpose reg
+    lc = _register(LC)  # general purpose reg
+    ld = _register(LD)  # general purpose reg
+    ptr = _register(PTR) # pointer to memory
+    pc = _register(PC)  # program counter
+
+    del _register
 
     def __repr__(self):
         return f"""Registers(a: {self.a}, b: {self.b}, c: {self.c}, d: {self.d}, e: {self.e}, f: {self.f},
@@ -229,8 +1155,7 @@ class Registers:
         If `is_32_bit` is `True` this function operates on the 32-bit registers
         instead of the 8_bit ones
         """
-        offset = 6 if is_32_bit else 0
-        return getattr(self, self.word_index_attr_map[index+offset])
+        return self.values[index + REG_32_BIT if is_32_bit else index]
 
     def move_by_index(self, dest_index: int, src_index: int, is_32_bit: bool):
         """
@@ -239,9 +1164,8 @@ class Registers:
         If `is_32_bit` is `True` this function operates on the 32-bit registers
         instead of the 8_bit ones
         """
-        offset = 6 if is_32_bit else 0
-        src = getattr(self, self.word_index_attr_map[src_index+offset])
-        setattr(self, self.word_index_attr_map[dest_index+offset], src)
+        offset = REG_32_BIT if is_32_bit else 0
+        self.values[dest_index + offset] = self.values[src_index + offset]
 
     def move_imm_by_index(self, dest_index: int, imm_value: int, is_32_bit: bool):
         """
@@ -250,8 +1174,10 @@ class Registers:
         If `is_32_bit` is `True` this function operates on the 32-bit registers
         instead of the 8_bit ones
         """
-        offset = 6 if is_32_bit else 0
-        setattr(self, self.word_index_attr_map[dest_index+offset], imm_value)
+        if is_32_bit:
+            self.values[dest_index + REG_32_BIT] = imm_value & MASK_32_BIT
+        else:
+            self.values[dest_index] = imm_value & MASK_8_BIT
 
     def write_word_by_index(self, dest_index: int, word: int):
         """
@@ -272,22 +1198,167 @@ def test():
     VM.run()
     exit(0)
 
-def decode(payload: Union[bytes, str]) -> bytes:
-    print("Decoding Layer 6...")
-    # test()
+def _op(op_name: str, imm: bytes = b'') -> bytes:
+    """
+    Assemble the instruction `op_name` (one without register fields)
+    """
+    return bytes([next(op_code for op_code, name in OP_CODES.items() if name == op_name)]) + imm
 
-    result: bytes = b''
-    decoded = base64.a85decode(payload, adobe=True)
-    VM = TomtelCorei69(decoded)
-    VM.run()
-    result = VM.out_stream
+def _mv(dest: int, src: int) -> bytes:
+    return bytes([0b01000000 | dest << 3 | src])
+
+def _mvi(dest: int, value: int) -> bytes:
+    return bytes([0b01000000 | dest << 3, value])
+
+def _mvi32(dest: int, value: int) -> bytes:
+    return bytes([0b10000000 | (dest - REG_32_BIT) << 3]) + struct.pack('<I', value)
 
-    with open("layer7", "wb+") as layer_file:
-        layer_file.write(result)
+def printer_program(key: int) -> bytes:
+    """
+    Code of an i69 program that prints the data stored right after it as
+    (flag, value XOR `key`) pairs until a flag of 0:
+          MVI32 ptr <- end of the code
+    loop: MVI c <- 0; MV a <- (ptr+c); MVI b <- 0; CMP; JEZ done
+          MVI c <- 1; MV a <- (ptr+c); MVI b <- key; XOR; OUT a
+          APTR 2; JNZ loop    (f is still 1 from the CMP)
+    done: HALT
+    """
+    def assemble(loop: int, done: int, data: int) -> bytes:
+        return _mvi32(PTR, data) + \
+            _mvi(C, 0) + _mv(A, 7) + _mvi(B, 0) + _op('CMP') + _op('JEZ', struct.pack('<I', done)) + \
+            _mvi(C, 1) + _mv(A, 7) + _mvi(B, key) + _op('XOR') + _op('OUT') + \
+            _op('APTR', b'\x02') + _op('JNZ', struct.pack('<I', loop)) + \
+            _op('HALT')
+    # all instructions have a fixed size: assemble once to find the addresses
+    size = len(assemble(0, 0, 0))
+    loop = len(_mvi32(PTR, 0))
+    return assemble(loop, size - 1, size)
 
-    return result
+def encode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  key: int = 0x5A) -> Iterator[bytes]:
+    """
+    Inverse of `decode_stream`: an i69 program (see `printer_program`)
+    that prints the data
+    """
+    yield printer_program(key)
+    table = bytes(byte ^ key for byte in range(256))
+    for chunk in chunks:
+        data = bytes(chunk)
+        pairs = bytearray(2 * len(data))
+        pairs[0::2] = b'\x01' * len(data)
+        pairs[1::2] = data.translate(table)
+        yield bytes(pairs)
+    yield b'\x00'
+
+def encode(text: bytes, description: bytes = b'', key: int = 0x5A) -> bytes:
+    """
+    Encode the text of layer 7 (the core) into the text of layer 6
+    """
+    return description + ascii85.encode(b''.join(encode_stream([text], key)))
+
+def decode_stream(chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                  engine: str = 'interp') -> Iterator[bytes]:
+    """
+    Decode the already Ascii85 decoded payload given as a stream of `chunks`.
+    The core needs the whole bytecode before it can start, but its output is
+    streamed while it is still running: it runs in slices of `STREAM_STEPS`
+    instructions in the calling thread (so it is measured and profiled with
+    the caller) and the output of every slice is yielded right after it.
+    """
+    output = bytearray()
+    VM = TomtelCorei69(b''.join(chunks), engine, output)
+    while True:
+        halted = VM.run(max_steps=STREAM_STEPS)
+        if output:
+            yield bytes(output)
+            output.clear()
+        if halted:
+            return
+
+def run_decoded(decoded: bytes, engine: str = 'interp',
+                profile: Optional[Profile] = None, cache: Optional[RunCache] = None,
+                checkpoint: Optional[str] = None,
+                artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    """
+    Run the already Ascii85 decoded bytecode `decoded` and write its output
+    to the artifact "layer7"
+    """
+    result = bytearray()
+    cached = cache.get(decoded) if cache is not None and profile is None else None
+    if cached is not None:
+        result = bytearray(cached)
+        artifacts.write("layer7", result)
+    elif checkpoint is not None:
+        # the output has to stay in the VM to be part of the checkpoints
+        result = bytearray(run_checkpointed(decoded, checkpoint, engine).out_stream)
+        artifacts.write("layer7", result)
+    else:
+        # stream the output of the core to disk while it is still running
+        with artifacts.open("layer7") as layer_file:
+            def write(chunk: bytes):
+                layer_file.write(chunk)
+                result.extend(chunk)
+            VM = TomtelCorei69(decoded, engine, write)
+            VM.run(profile)
+
+    if cache is not None and cached is None:
+        cache.put(decoded, bytes(result))
+
+    return bytes(result)
+
+def decode(payload: Union[bytes, str], engine: str = 'interp',
+           profile: Optional[Profile] = None, cache: Optional[RunCache] = None,
+           checkpoint: Optional[str] = None,
+           artifacts: layer_artifacts.ArtifactWriter = layer_artifacts.DEFAULT) -> bytes:
+    print("Decoding Layer 6...")
+    # test()
+
+    return run_decoded(ascii85.decode(payload), engine, profile, cache, checkpoint, artifacts)
 
 #%%
 if __name__ == "__main__":
-    with open('layer6', 'r') as payload_file:
-        decode(payload_file.read())
+    parser = argparse.ArgumentParser(description="Decode layer 6 of Tom's Data Onion")
+    parser.add_argument('--engine', choices=ENGINES, default='interp',
+                        help="execute the i69 code with the interpreter or as compiled basic blocks")
+    parser.add_argument('--profile', metavar='JSON_FILE',
+                        help="profile the execution, print a hot spot report and save the statistics as JSON")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="reuse the output of earlier runs of the same bytecode stored in DIR")
+    parser.add_argument('--checkpoint', metavar='SNAPSHOT_FILE',
+                        help=f"save a snapshot of the VM every {CHECKPOINT_STEPS} instructions "
+                             "and resume from it if it exists")
+    parser.add_argument('--batch', metavar='FILE', nargs='+',
+                        help="run many programs (bytecode or Ascii85 payloads) in parallel; "
+                             "the output of FILE is written to FILE.out")
+    parser.add_argument('--workers', type=int, help="number of worker processes for --batch")
+    parser.add_argument('--max-steps', type=int, help="step budget of every program of --batch")
+    parser.add_argument('--timeout', type=float, help="time budget in seconds of every program of --batch")
+    parser.add_argument('--encoding', choices=('auto', 'bytecode', 'ascii85'), default='auto',
+                        help="whether the programs of --batch are bytecode or Ascii85 payloads "
+                             "(by default this is guessed for every program)")
+    args = parser.parse_args()
+    if args.batch:
+        programs = []
+        for path in args.batch:
+            with open(path, 'rb') as program_file:
+                programs.append(program_file.read())
+        encoded = {'auto': None, 'bytecode': False, 'ascii85': True}[args.encoding]
+        results = run_batch(programs, args.workers, args.engine, args.max_steps, args.timeout, encoded)
+        for path, result in zip(args.batch, results):
+            if result.error is None:
+                with open(path + '.out', 'wb') as output_file:
+                    output_file.write(result.output)
+                print(f"{path}: {len(result.output)} bytes, {result.steps} steps, {result.seconds:.3f}s")
+            else:
+                print(f"{path}: FAILED after {result.steps} steps: {result.error}")
+        exit(0 if all(result.error is None for result in results) else 1)
+    profile = Profile() if args.profile else None
+    cache = RunCache(args.cache) if args.cache else None
+    print("Decoding Layer 6...")
+    decoded = b''.join(ascii85.iter_decode(layer_artifacts.map_chunks('layer6')))
+    with layer_artifacts.ArtifactWriter(background=True) as artifacts:
+        run_decoded(decoded, args.engine, profile, cache, args.checkpoint, artifacts)
+    if profile is not None:
+        print(profile.report())
+        with open(args.profile, 'w') as profile_file:
+            profile_file.write(profile.to_json(indent=2))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+Chunk = Union[bytes, bytearray, memoryview]
+Transform = Callable[[Iterable[Chunk]], Iterator[bytes]]
+
+FORMATS = ('json', 'prometheus')
+
+class LayerMetrics:
+    """
+    Measurements of a single run of a layer.
+    `cpu_seconds` is the CPU time of the thread that decoded the layer.
+    `wait_seconds` is the part of the wall time a streamed layer spent
+    waiting for its input or for the consumer of its output (e.g. the other
+    stages of the pipeline), which `busy_seconds` leaves out.
+    `peak_memory` is the peak of the memory traced by `tracemalloc` while the
+    layer was running (`None` without memory tracing); if other layers ran at
+    the same time, their allocations are included.
+    """
+    def __init__(self, layer: int):
+        self.layer = layer
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.peak_memory: Optional[int] = None
+
+    @property
+    def busy_seconds(self) -> float:
+        return self.wall_seconds - self.wait_seconds
+
+    @property
+    def throughput(self) -> float:
+        """
+        Input bytes decoded per second of the layer's own work, in MB/s
+        """
+        return self.input_bytes / self.busy_seconds / 1e6 if self.busy_seconds > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'layer': self.layer,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'wait_seconds': self.wait_seconds,
+            'busy_seconds': self.busy_seconds,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'throughput_mb_per_second': self.throughput,
+            'peak_memory_bytes': self.peak_memory,
+        }
+
+# metric name -> (help text, attribute of `LayerMetrics`)
+PROMETHEUS_METRICS = {
+    'onion_layer_wall_seconds': ("Wall clock time spent decoding the layer", 'wall_seconds'),
+    'onion_layer_cpu_seconds': ("CPU time spent decoding the layer", 'cpu_seconds'),
+    'onion_layer_wait_seconds': ("Time the layer spent waiting for its input or its consumer", 'wait_seconds'),
+    'onion_layer_busy_seconds': ("Wall clock time spent decoding the layer without waiting", 'busy_seconds'),
+    'onion_layer_input_bytes': ("Size of the decoded payload of the layer", 'input_bytes'),
+    'onion_layer_output_bytes': ("Size of the output of the layer", 'output_bytes'),
+    'onion_layer_throughput_mb_per_second': ("Input decoded per second", 'throughput'),
+    'onion_layer_peak_memory_bytes': ("Peak of the traced memory while decoding the layer", 'peak_memory'),
+}
+
+class Metrics:
+    """
+    Collects a `LayerMetrics` for every layer that is run through `measure`,
+    `wrap` or `call`.
+    With `trace_memory` the peak memory is traced with `tracemalloc` (which
+    slows everything down considerably). Every layer in `profile_layers` is
+    run under `cProfile` and its statistics are saved as
+    "layerN.pstats" in `profile_dir`.
+    """
+    def __init__(self, trace_memory: bool = False, profile_layers: Sequence[int] = (),
+                 profile_dir: str = '.'):
+        self.trace_memory = trace_memory
+        self.profile_layers = set(profile_layers)
+        self.profile_dir = profile_dir
+        self.layers: List[LayerMetrics] = []
+        self._lock = threading.Lock()
+        self._active = 0
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def measure(self, layer: int) -> Iterator[LayerMetrics]:
+        """
+        Measure the time it takes to run the body of the `with` statement in
+        the current thread. The byte counts have to be filled in by the caller.
+        """
+        metrics = LayerMetrics(layer)
+        with self._lock:
+            # only start over if no other layer is being measured right now
+            if self.trace_memory and self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+        profiler = cProfile.Profile() if layer in self.profile_layers else None
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield metrics
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            metrics.cpu_seconds = time.thread_time() - cpu_start
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            with self._lock:
+                self._active -= 1
+                if self.trace_memory:
+                    metrics.peak_memory = tracemalloc.get_traced_memory()[1]
+                self.layers.append(metrics)
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"layer{layer}.pstats"))
+
+    def wrap(self, layer: int, transform: Transform) -> Transform:
+        """
+        Wrap the `decode_stream`-like `transform` of `layer` so every run of
+        it is measured, from its first to its last chunk. The time spent
+        getting the next input chunk and handing out an output chunk counts
+        as waiting, so the throughput is that of `transform` alone even if
+        it runs in a pipeline.
+        """
+        def measured(chunks: Iterable[Chunk]) -> Iterator[bytes]:
+            with self.measure(layer) as metrics:
+                def counted() -> Iterator[Chunk]:
+                    iterator = iter(chunks)
+                    while True:
+                        start = time.perf_counter()
+                        chunk = next(iterator, None)
+                        metrics.wait_seconds += time.perf_counter() - start
+                        if chunk is None:
+                            return
+                        metrics.input_bytes += len(chunk)
+                        yield chunk
+                for chunk in transform(counted()):
+                    metrics.output_bytes += len(chunk)
+                    start = time.perf_counter()
+                    yield chunk
+                    metrics.wait_seconds += time.perf_counter() - start
+        return measured
+
+    def call(self, layer: int, decode: Callable[..., bytes], payload: Union[bytes, str], *args, **kwargs) -> bytes:
+        """
+        Run (and measure) `decode(payload, *args, **kwargs)`, e.g. a
+        `layerN.decode`. The input is counted as the size of the encoded `payload`.
+        """
+        with self.measure(layer) as metrics:
+            result = decode(payload, *args, **kwargs)
+            metrics.input_bytes = len(payload)
+            metrics.output_bytes = len(result)
+        return result
+
+    def to_json_lines(self) -> str:
+        return ''.join(json.dumps(metrics.to_dict()) + '\n' for metrics in self.layers)
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, (description, attribute) in PROMETHEUS_METRICS.items():
+            samples = [(metrics.layer, getattr(metrics, attribute)) for metrics in self.layers
+                       if getattr(metrics, attribute) is not None]
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines += [f'{name}{{layer="{layer}"}} {value}' for layer, value in samples]
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path: str, format: str = 'json'):
+        """
+        Write the metrics to the file `path` ('-' for stdout) in `format`
+        (one of `FORMATS`)
+        """
+        text = self.to_prometheus() if format == 'prometheus' else self.to_json_lines()
+        if path == '-':
+            print(text, end='')
+        else:
+            with open(path, 'w') as metrics_file:
+                metrics_file.write(text)
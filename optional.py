@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def numpy():
+    """
+    NumPy (or `None` if it isn't installed), imported on first use: it takes
+    longer to import than all layers together and most inputs don't need it
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
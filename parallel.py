@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+# position independent transform: (slice of the data, offset of the slice) -> transformed slice
+SliceTransform = Callable[[memoryview, int], Buffer]
+
+# inputs smaller than this are transformed in the current process: starting
+# the workers and copying into shared memory would take longer
+PARALLEL_THRESHOLD = 8 << 20
+# slices start at multiples of this many bytes
+DEFAULT_ALIGNMENT = 1 << 12
+# number of bytes of a stream that are transformed in parallel at once
+BATCH_SIZE = 4 * PARALLEL_THRESHOLD
+
+class TransformResult:
+    """
+    Result of `transform_parallel`. `view` is a read-only view of the
+    transformed bytes; if the work was done by other processes, it points
+    straight into the shared memory block the workers wrote to, so nothing
+    is copied. Close the result (or use it as a context manager) once the
+    view isn't needed anymore.
+    """
+    def __init__(self, data: Buffer, shm: Optional[shared_memory.SharedMemory] = None):
+        self._shm = shm
+        self._data = memoryview(data)
+        self.view = self._data.toreadonly()
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def tobytes(self) -> bytes:
+        return self.view.tobytes()
+
+    def close(self):
+        self.view.release()
+        self._data.release()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def __enter__(self) -> 'TransformResult':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _transform_slice(shm_name: str, transform: SliceTransform, start: int, end: int):
+    """
+    Transform the bytes `start:end` of the shared memory block `shm_name` in place
+    """
+    shm = shared_memory.SharedMemory(shm_name)
+    try:
+        view = shm.buf[start:end]
+        try:
+            view[:] = transform(view, start)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+def transform_parallel(data: Buffer, transform: SliceTransform, workers: Optional[int] = None,
+                       alignment: int = DEFAULT_ALIGNMENT, slices_per_worker: int = 4,
+                       threshold: int = PARALLEL_THRESHOLD) -> TransformResult:
+    """
+    Apply the position independent `transform` (a picklable function of a
+    slice and its offset, returning a slice of the same length) to all of
+    `data`, split into disjoint slices that a pool of `workers` processes
+    transforms in place in shared memory. Every slice starts at a multiple
+    of `alignment` (e.g. the key length of a repeating key).
+    Inputs smaller than `threshold` are transformed in the current process.
+    """
+    workers = workers or os.cpu_count() or 1
+    size = len(data)
+    if workers < 2 or size < threshold:
+        return TransformResult(transform(memoryview(data), 0))
+
+    slice_size = -(-size // (workers * slices_per_worker))
+    slice_size = -(-slice_size // alignment) * alignment
+    starts = range(0, size, slice_size)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shm.buf[:size] = data
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            list(executor.map(_transform_slice, [shm.name] * len(starts), [transform] * len(starts),
+                              starts, [min(start + slice_size, size) for start in starts]))
+    except BaseException:
+        shm.close()
+        raise
+    finally:
+        # the mapping stays valid after the name is gone
+        shm.unlink()
+    return TransformResult(shm.buf[:size], shm)
+
+def transform_stream(chunks: Iterable[Buffer], transform: SliceTransform, workers: Optional[int] = None,
+                     alignment: int = DEFAULT_ALIGNMENT, batch_size: int = BATCH_SIZE,
+                     threshold: int = PARALLEL_THRESHOLD) -> Iterator[bytes]:
+    """
+    `transform_parallel` for data given as a stream of `chunks`: the data is
+    collected into batches of about `batch_size` bytes which are transformed
+    one after the other, each one by all `workers`. Every batch starts at a
+    multiple of `alignment`, so the offsets `transform` is called with are
+    those within the batch.
+    """
+    batch_size = -(-batch_size // alignment) * alignment
+    batch = bytearray()
+
+    def flush(size: int) -> bytes:
+        with transform_parallel(memoryview(batch)[:size], transform, workers, alignment,
+                                threshold=threshold) as result:
+            transformed = result.tobytes()
+        del batch[:size]
+        return transformed
+
+    for chunk in chunks:
+        batch += chunk
+        if len(batch) >= batch_size:
+            yield flush(len(batch) - len(batch) % batch_size)
+    if batch:
+        yield flush(len(batch))
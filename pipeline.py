@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import importlib
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional, Union
+
+import artifacts as layer_artifacts
+import ascii85
+import cache as layer_cache
+import metrics as layer_metrics
+
+Chunk = Union[bytes, bytearray, memoryview]
+Transform = Callable[[Iterable[Chunk]], Iterator[bytes]]
+
+# layer -> module decoding it
+LAYERS: List[str] = [f"layer{layer}" for layer in range(7)]
+# layers whose `decode_stream` can use several worker processes
+PARALLEL_LAYERS = (1, 3)
+
+# number of bytes a stage collects before handing them to the next stage
+CHUNK_SIZE = 1 << 16
+# number of chunks that may wait between two stages
+MAX_PENDING = 16
+# seconds between two checks whether a blocked stage has been cancelled
+POLL_INTERVAL = 0.1
+
+def layer_transform(layer: int, **options) -> Transform:
+    """
+    The `decode_stream` of `layer` (called with `options`). The module of the
+    layer is only imported once the transform is called for the first time,
+    so layers that never run (e.g. because they are cached) cost nothing.
+    """
+    def transform(chunks: Iterable[Chunk]) -> Iterator[bytes]:
+        module = importlib.import_module(LAYERS[layer])
+        return module.decode_stream(chunks, **options)
+    return transform
+
+class Cancelled(Exception):
+    """ Raised in a stage whose consumer has gone away """
+
+class Stage:
+    """
+    A single layer of the pipeline, running in its own thread.
+    It reads the text of its layer from `chunks`, skips everything around
+    the Ascii85 payload, decodes the payload and puts the result (the text
+    of the next layer) into a bounded queue in chunks of about `chunk_size`
+    bytes. Iterating over the stage yields these chunks.
+    The output is written to the artifact "layer{N+1}" of `artifacts`
+    (if any). With a `cache` it is stored in the cache as well.
+    `input_digest` is the hash of the text of the layer if it is already
+    known; otherwise `chunks` has to be the previous stage, which stores
+    (and hashes) it.
+    """
+    def __init__(self, layer: int, chunks: Iterable[Chunk], transform: Optional[Transform] = None,
+                 chunk_size: int = CHUNK_SIZE, max_pending: int = MAX_PENDING,
+                 artifacts: Optional[layer_artifacts.ArtifactWriter] = None,
+                 cache: Optional[layer_cache.LayerCache] = None,
+                 input_digest: Optional[str] = None):
+        self.layer = layer
+        self.chunks = chunks
+        self.transform = transform if transform is not None else layer_transform(layer)
+        self.chunk_size = chunk_size
+        self.artifacts = artifacts
+        self.cache = cache
+        self.input_digest = input_digest
+        self.output_digest: Optional[str] = None
+        self._queue: queue.Queue = queue.Queue(max_pending)
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"layer{layer}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """
+        Stop the stage (and through it all stages before it) at the next
+        chunk it produces
+        """
+        self._cancelled.set()
+
+    def _put(self, item):
+        while True:
+            if self._cancelled.is_set():
+                raise Cancelled(f"Layer {self.layer} was cancelled")
+            try:
+                self._queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _finish(self, item):
+        """
+        Put the end marker (`None`) or an error into the queue unless nobody
+        is going to read it anymore
+        """
+        try:
+            self._put(item)
+        except Cancelled:
+            pass
+
+    def _run(self):
+        artifact = self.artifacts.open(f"layer{self.layer + 1}") if self.artifacts is not None else None
+        writer = self.cache.writer() if self.cache is not None else None
+        try:
+            chunks = iter(self.chunks)
+            pending = bytearray()
+            for chunk in self.transform(ascii85.iter_decode(chunks)):
+                if artifact is not None:
+                    artifact.write(chunk)
+                if writer is not None:
+                    writer.write(chunk)
+                pending += chunk
+                if len(pending) >= self.chunk_size:
+                    self._put(bytes(pending))
+                    pending.clear()
+            if pending:
+                self._put(bytes(pending))
+            # read the text after the payload as well, so the stage before
+            # this one gets to finish its artifact and its cache entry
+            for _ in chunks:
+                pass
+            if writer is not None:
+                self._store(writer)
+                writer = None
+            if artifact is not None:
+                artifact.close()
+                artifact = None
+        except Cancelled:
+            self._cancel_input()
+        except BaseException as error:
+            self._cancel_input()
+            self._finish(error)
+        else:
+            self._finish(None)
+        finally:
+            if artifact is not None:
+                artifact.abort()
+            if writer is not None:
+                writer.abort()
+
+    def _cancel_input(self):
+        """
+        Don't leave the stages before this one blocked on a full queue
+        """
+        if isinstance(self.chunks, Stage):
+            self.chunks.cancel()
+
+    def _store(self, writer: layer_cache.BlobWriter):
+        """
+        Commit the output to the cache and add the entry for this layer
+        (once the whole input has been read: it is hashed by the previous
+        stage)
+        """
+        if self.input_digest is None and isinstance(self.chunks, Stage):
+            self.input_digest = self.chunks.output_digest
+        self.output_digest = writer.commit()
+        if self.input_digest is not None:
+            self.cache.add(self.layer, self.input_digest, self.output_digest)
+        self.cache.set_latest(self.layer + 1, self.output_digest)
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            self.cancel()
+
+def run(chunks: Iterable[Chunk], first: int = 0, last: int = len(LAYERS) - 1,
+        engine: str = 'interp', artifacts: Optional[layer_artifacts.ArtifactWriter] = layer_artifacts.DEFAULT,
+        chunk_size: int = CHUNK_SIZE, max_pending: int = MAX_PENDING,
+        cache: Optional[layer_cache.LayerCache] = None, digest: Optional[str] = None,
+        metrics: Optional[layer_metrics.Metrics] = None, workers: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Decode the text of layer `first` given as a stream of `chunks` through
+    all layers up to `last` and yield the output of the last one.
+    All layers run at the same time, connected by queues of at most
+    `max_pending` chunks of about `chunk_size` bytes, so the next layer
+    starts as soon as the previous one produces its first bytes and memory
+    use doesn't depend on the size of the onion.
+    The output of layer N is also streamed to the artifact "layer{N+1}" of
+    `artifacts` (if any).
+    With a `cache`, the layers whose text has been decoded before by the
+    same code are skipped and their cached output is used instead; the
+    first layer that is not in the cache and all layers after it run as
+    usual and store their output in the cache. The artifacts of the cached
+    layers are copied from the cache. `digest` is the hash of the text of
+    layer `first` if it is already in the cache.
+    Every layer that runs is measured if `metrics` are given.
+    With more than one of `workers`, the `PARALLEL_LAYERS` are decoded by
+    that many processes (in large batches, see `parallel.transform_stream`).
+    """
+    if cache is not None:
+        if digest is None:
+            digest = cache.put(chunks)
+        cache.set_latest(first, digest)
+        while first <= last:
+            output = cache.lookup(first, digest)
+            if output is None:
+                break
+            print(f"Layer {first}: cached")
+            if artifacts is not None:
+                artifacts.copy(f"layer{first + 1}", cache.path(output))
+            first, digest = first + 1, output
+            cache.set_latest(first, digest)
+        chunks = cache.read(digest)
+        if first > last:
+            yield from chunks
+            return
+
+    stream: Iterable[Chunk] = chunks
+    stages = []
+    for layer in range(first, last + 1):
+        options = {}
+        if layer == 6:
+            options['engine'] = engine
+        if layer in PARALLEL_LAYERS and workers is not None and workers > 1:
+            options['workers'] = workers
+        transform = layer_transform(layer, **options)
+        if metrics is not None:
+            transform = metrics.wrap(layer, transform)
+        stream = Stage(layer, stream, transform, chunk_size, max_pending, artifacts, cache,
+                       digest if layer == first else None)
+        stages.append(stream)
+    for stage in stages:
+        print(f"Decoding Layer {stage.layer}...")
+        stage.start()
+    yield from stream
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import codecs
+import html
+import http.client
+import json
+import os
+import time
+import urllib.parse
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+DEFAULT_URL = 'https://www.tomdalling.com/toms-data-onion/'
+USER_AGENT = 'Mozilla/5.0'
+# number of bytes read at once
+READ_SIZE = 1 << 16
+# statuses of responses that redirect to their Location
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# number of redirects followed before giving up
+MAX_REDIRECTS = 5
+
+class FetchError(Exception):
+    """ Raised when the Onion cannot be fetched """
+
+class PreExtractor:
+    """
+    Incrementally extracts the text of the first `<pre>` element of an HTML
+    page fed to it in chunks, with all HTML entities resolved.
+    Leading and trailing whitespace of the text is dropped.
+    """
+    START = '<pre>'
+    END = '</pre>'
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._pending = ''    # text that may still be part of a tag, an entity or trailing whitespace
+        self.started = False
+        self.finished = False
+        self._text_seen = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.finished:
+            return b''
+        text = self._pending + self._decoder.decode(chunk)
+        self._pending = ''
+        if not self.started:
+            start = text.find(self.START)
+            if start < 0:
+                # keep what could be the beginning of '<pre>'
+                self._pending = text[-(len(self.START) - 1):]
+                return b''
+            text = text[start + len(self.START):]
+            self.started = True
+        if not self._text_seen:
+            text = text.lstrip()
+            self._text_seen = bool(text)
+
+        end = text.find(self.END)
+        if end >= 0:
+            self.finished = True
+            return html.unescape(text[:end].rstrip()).encode('utf-8')
+
+        # hold back a possibly incomplete '</pre>' or entity and trailing whitespace
+        keep = len(text) - len(text.rstrip())
+        for marker in ('<', '&'):
+            position = text.rfind(marker, max(len(text) - 12, 0))
+            if position >= 0 and (marker == '<' or ';' not in text[position:]):
+                if marker == '<':
+                    # the whitespace in front of a '</pre>' is trailing whitespace
+                    position = len(text[:position].rstrip())
+                keep = max(keep, len(text) - position)
+        if keep:
+            text, self._pending = text[:-keep], text[-keep:]
+        return html.unescape(text).encode('utf-8')
+
+    def close(self) -> bytes:
+        if not self.finished:
+            raise FetchError("The page contains no complete <pre> element")
+        return b''
+
+def extract_pre(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Extract the text of the first `<pre>` element of the HTML page given as
+    a stream of `chunks`
+    """
+    extractor = PreExtractor()
+    for chunk in chunks:
+        text = extractor.feed(chunk)
+        if text:
+            yield text
+        if extractor.finished:
+            return
+    extractor.close()
+
+class FileSource:
+    """
+    Reads the Onion from a local file: either the text of the Onion itself
+    or (with `is_html`, by default for *.html files) a saved copy of the page
+    """
+    def __init__(self, path: str, is_html: Optional[bool] = None):
+        self.path = path
+        self.is_html = path.endswith(('.html', '.htm')) if is_html is None else is_html
+
+    def chunks(self) -> Iterator[bytes]:
+        def read() -> Iterator[bytes]:
+            with open(self.path, 'rb') as onion_file:
+                yield from iter(lambda: onion_file.read(READ_SIZE), b'')
+        return extract_pre(read()) if self.is_html else read()
+
+class UrlSource:
+    """
+    Fetches the Onion from the page at `url` over HTTP(S).
+    The connection is kept open and reused for all fetches of this source.
+    With a `state_dir` the last extracted Onion is kept along with the ETag
+    and the modification date of the page; later fetches are conditional
+    and use the stored copy if the page hasn't changed.
+    Failed requests are retried up to `retries` times, waiting `backoff`
+    seconds (doubled after every attempt) in between.
+    """
+    STATE = 'source.json'
+
+    def __init__(self, url: str = DEFAULT_URL, timeout: float = 30.0, retries: int = 3,
+                 backoff: float = 1.0, state_dir: Optional[str] = None):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.state_dir = state_dir
+        self._connection: Optional[http.client.HTTPConnection] = None
+        self._connection_key: Optional[Tuple[str, str]] = None
+        if state_dir is not None:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        if self._connection is None or self._connection_key != (scheme, netloc):
+            self.close()
+            connection_type = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            self._connection = connection_type(netloc, timeout=self.timeout)
+            self._connection_key = (scheme, netloc)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _load_state(self) -> Dict[str, Dict[str, str]]:
+        if self.state_dir is None:
+            return {}
+        try:
+            with open(os.path.join(self.state_dir, self.STATE), 'r') as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self, state: Dict[str, Dict[str, str]]):
+        tmp_path = os.path.join(self.state_dir, self.STATE + '.tmp')
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, os.path.join(self.state_dir, self.STATE))
+
+    def _onion_path(self, url: str) -> str:
+        return os.path.join(self.state_dir, urllib.parse.quote(url, safe='') + '.onion')
+
+    def _request(self, url: str, headers: Dict[str, str]) -> http.client.HTTPResponse:
+        """
+        Send a GET request for `url`, retrying on connection problems and
+        server errors
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._connect(parts.scheme, parts.netloc)
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                if response.status < 500:
+                    return response
+                response.read()
+                error: Exception = FetchError(f"{url}: {response.status} {response.reason}")
+            except (OSError, http.client.HTTPException) as exception:
+                # the server may have closed the kept alive connection
+                self.close()
+                error = exception
+            if attempt < self.retries:
+                print(f"Fetching {url} failed ({error}), retrying in {delay:g}s...")
+                time.sleep(delay)
+                delay *= 2
+        raise FetchError(f"Could not fetch {url}: {error}")
+
+    def _follow(self, url: str, headers: Dict[str, str]) -> http.client.HTTPResponse:
+        """
+        Send a GET request for `url` (see `_request`) and follow up to
+        `MAX_REDIRECTS` redirects, like `urllib.request.urlopen` does
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers)
+            if response.status not in REDIRECT_STATUSES:
+                return response
+            response.read()
+            location = response.getheader('Location')
+            if not location:
+                raise FetchError(f"{url}: {response.status} {response.reason} without a Location")
+            # relative to the redirecting URL; `_connect` reconnects if the host changes
+            url = urllib.parse.urljoin(url, location)
+        raise FetchError(f"{url}: more than {MAX_REDIRECTS} redirects")
+
+    def _extract(self, body: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Extract the Onion from the response `body` and read the rest of it,
+        so the connection can be reused
+        """
+        complete = False
+        try:
+            yield from extract_pre(body)
+            for _ in body:
+                pass
+            complete = True
+        finally:
+            if not complete:
+                self.close()
+
+    def chunks(self, url: Optional[str] = None) -> Iterator[bytes]:
+        """
+        Fetch the Onion from `url` (by default the URL of this source) and
+        yield its text while the page is still being received
+        """
+        url = url if url is not None else self.url
+        state = self._load_state()
+        known: Dict[str, str] = {}
+        if self.state_dir is not None and os.path.exists(self._onion_path(url)):
+            known = state.get(url, {})
+        headers = {'User-Agent': USER_AGENT}
+        if 'etag' in known:
+            headers['If-None-Match'] = known['etag']
+        if 'last_modified' in known:
+            headers['If-Modified-Since'] = known['last_modified']
+
+        response = self._follow(url, headers)
+        if response.status == 304:
+            response.read()
+            print("The Data Onion hasn't changed, using the stored copy...")
+            yield from FileSource(self._onion_path(url), is_html=False).chunks()
+            return
+        if response.status != 200:
+            response.read()
+            raise FetchError(f"{url}: {response.status} {response.reason}")
+
+        body = iter(lambda: response.read(READ_SIZE), b'')
+        if self.state_dir is None:
+            yield from self._extract(body)
+            return
+
+        tmp_path = self._onion_path(url) + '.tmp'
+        with open(tmp_path, 'wb') as onion_file:
+            for chunk in self._extract(body):
+                onion_file.write(chunk)
+                yield chunk
+        os.replace(tmp_path, self._onion_path(url))
+        entry = {}
+        if response.getheader('ETag'):
+            entry['etag'] = response.getheader('ETag')
+        if response.getheader('Last-Modified'):
+            entry['last_modified'] = response.getheader('Last-Modified')
+        state[url] = entry
+        self._save_state(state)
+
+def open_source(location: str, **kwargs) -> Union[FileSource, UrlSource]:
+    """
+    Source for `location`: a URL (http:// or https://) or a local file
+    """
+    if urllib.parse.urlsplit(location).scheme in ('http', 'https'):
+        return UrlSource(location, **kwargs)
+    return FileSource(location)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+import os
+import threading
+
+import artifacts
+
+def test_background_writer_stops_its_thread(tmp_path):
+    threads = threading.active_count()
+    for i in range(5):
+        with artifacts.ArtifactWriter(str(tmp_path), background=True) as writer:
+            with writer.open(f'layer{i}') as artifact:
+                artifact.write(b'onion ')
+                artifact.write(bytearray(b'core'))
+    assert threading.active_count() == threads
+    assert sorted(os.listdir(tmp_path)) == [f'layer{i}' for i in range(5)]
+    assert (tmp_path / 'layer4').read_bytes() == b'onion core'
+
+def test_artifacts_get_the_default_permissions(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        artifacts.ArtifactWriter(str(tmp_path)).write('layer1', b'onion')
+    finally:
+        os.umask(umask)
+    assert (tmp_path / 'layer1').stat().st_mode & 0o777 == 0o644
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import base64
+import random
+import struct
+
+import pytest
+
+import ascii85
+
+def test_decode_payload_starting_with_greater_than():
+    # the first digit of the first group is 29 ('>'), so the text starts with '<~>'
+    raw = struct.pack('>I', 29 * 85**4) * 3 + b'onion'
+    encoded = base64.a85encode(raw, adobe=True)
+    assert encoded.startswith(b'<~>')
+    assert ascii85.decode(encoded) == raw
+    assert ascii85.decode(b'==[ Layer ]==\n\n' + encoded) == raw
+
+def test_decode_without_delimiter_at_start():
+    raw = b'Tom\'s Data Onion'
+    assert ascii85.decode(b'  \n' + base64.a85encode(raw) + b'~>') == raw
+
+def test_decode_matches_base64():
+    rng = random.Random(1)
+    for size in (0, 1, 3, 4, 5, 70000):
+        raw = rng.randbytes(size)
+        assert ascii85.decode(base64.a85encode(raw, adobe=True, wrapcol=60)) == raw
+
+def test_decode_numpy_blocks():
+    raw = random.Random(2).randbytes(4 * ascii85.NUMPY_BLOCK_GROUPS + 4 * 1000 + 3)
+    encoded = base64.a85encode(raw, adobe=True)
+    assert ascii85.decode(encoded) == raw
+
+def test_iter_decode_random_chunks(random_chunks):
+    rng = random.Random(3)
+    raw = rng.randbytes(5000) + bytes(12)  # ends with 'z' groups
+    text = b'==[ Payload ]==\n\n' + base64.a85encode(raw, adobe=True, wrapcol=60) + b'\ntrailer'
+    for _ in range(20):
+        assert b''.join(ascii85.iter_decode(random_chunks(text, rng))) == raw
+
+def test_encode_round_trip(random_chunks):
+    rng = random.Random(4)
+    for size in (0, 1, 2, 3, 4, 1000, 100000):
+        raw = rng.randbytes(size)
+        encoded = ascii85.encode(raw)
+        assert base64.a85decode(encoded, adobe=True) == raw
+        assert b''.join(ascii85.iter_encode(random_chunks(raw, rng, 100))) == encoded
+
+def test_encode_keeps_end_delimiter_on_one_line():
+    rng = random.Random(5)
+    for size in range(200):
+        raw = rng.randbytes(size)
+        encoded = ascii85.encode(raw)
+        assert encoded == base64.a85encode(raw, adobe=True, wrapcol=ascii85.WRAP_COLUMNS)
+        assert ascii85.decode(encoded) == raw
+        assert base64.a85decode(encoded, adobe=True) == raw
+
+def test_z_only_between_groups():
+    assert ascii85.decode(b'<~z!!!!!z~>') == bytes(12)
+    text = b'<~' + base64.a85encode(b'onio') + b'\nz ' + base64.a85encode(b'n') + b'~>'
+    for size in range(1, len(text) + 1):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert b''.join(ascii85.iter_decode(chunks)) == b'onio' + bytes(4) + b'n'
+    for bad in (b'<~!!z!!~>', b'<~!!!!!!z~>', b'<~!z~>'):
+        for size in range(1, len(bad) + 1):
+            chunks = [bad[i:i + size] for i in range(0, len(bad), size)]
+            with pytest.raises(ValueError):
+                b''.join(ascii85.iter_decode(chunks))
+
+def test_whitespace_inside_end_delimiter_fails_for_every_chunk_size():
+    for bad in (b'<~abc~ >', b'<~abcde~\n>', b'<~~ >'):
+        for size in range(1, len(bad) + 1):
+            chunks = [bad[i:i + size] for i in range(0, len(bad), size)]
+            with pytest.raises(ValueError):
+                b''.join(ascii85.iter_decode(chunks))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import os
+
+import cache as layer_cache
+
+def test_put_read_and_lookup(tmp_path):
+    cache = layer_cache.LayerCache(str(tmp_path))
+    text = cache.put([b'layer ', b'one'])
+    decoded = cache.put([b'layer two'])
+    assert b''.join(cache.read(text)) == b'layer one'
+    assert cache.lookup(1, text) is None
+    cache.add(1, text, decoded)
+    cache.set_latest(2, decoded)
+    assert cache.lookup(1, text) == decoded
+    # the entries belong to the layer
+    assert cache.lookup(2, text) is None
+    # and they are kept on disk
+    reopened = layer_cache.LayerCache(str(tmp_path))
+    assert reopened.lookup(1, text) == decoded
+    assert reopened.latest(2) == decoded
+
+def test_entry_without_blob_is_a_miss(tmp_path):
+    cache = layer_cache.LayerCache(str(tmp_path))
+    text = cache.put([b'layer one'])
+    decoded = cache.put([b'layer two'])
+    cache.add(1, text, decoded)
+    os.remove(cache.path(decoded))
+    assert cache.lookup(1, text) is None
+
+def test_least_recently_used_texts_are_evicted(tmp_path):
+    cache = layer_cache.LayerCache(str(tmp_path), max_size=25)
+    first = cache.put([b'a' * 10])
+    second = cache.put([b'b' * 10])
+    cache.add(0, first, second)
+    third = cache.put([b'c' * 10])
+    assert not os.path.exists(cache.path(first))
+    assert os.path.exists(cache.path(second)) and os.path.exists(cache.path(third))
+    # the entry went with the text it was decoded from
+    assert cache.lookup(0, first) is None
+
+def test_failed_put_leaves_nothing_behind(tmp_path):
+    cache = layer_cache.LayerCache(str(tmp_path))
+
+    def chunks():
+        yield b'partial'
+        raise OSError("connection lost")
+
+    try:
+        cache.put(chunks())
+    except OSError:
+        pass
+    assert os.listdir(tmp_path) == []
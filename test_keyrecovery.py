@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import random
+import time
+
+import artifacts as layer_artifacts
+import generate
+import keyrecovery
+import layer3
+
+WORDS = b"the quick brown fox jumps over a lazy dog while the onion keeps its secret".split()
+
+def plain_text(size: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    return b' '.join(rng.choices(WORDS, k=size // 4))[:size]
+
+def test_recover_key_with_known_length():
+    ciphertext = layer3.xor_with_key(plain_text(20000))
+    assert keyrecovery.recover_key(ciphertext, layer3.KEY_LEN) == layer3.KEY
+
+def test_recover_key_of_large_ciphertext_quickly():
+    ciphertext = layer3.xor_with_key(plain_text(2 << 20))
+    start = time.perf_counter()
+    assert keyrecovery.recover_key(ciphertext, None) == layer3.KEY
+    # the key length is only guessed from a sample of the ciphertext
+    assert time.perf_counter() - start < 5
+
+def test_recover_key_of_layer_text():
+    # like the real layer 4: a short description and a long Ascii85 payload
+    text = generate.layer_text(4, 20000)
+    assert text.startswith(layer3.LAYER4_HEADER)
+    ciphertext = layer3.xor_with_key(text)
+    assert keyrecovery.recover_key(ciphertext, layer3.KEY_LEN, weights=keyrecovery.ASCII85_WEIGHTS) == layer3.KEY
+    payload = layer3.encode(text, b'==[ Layer 3/6 ]==\n\n')
+    assert layer3.decode(payload, key=None, artifacts=layer_artifacts.DISABLED) == text
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import random
+
+import pytest
+
+import layer4
+
+def test_zero_total_length_fails_on_every_path():
+    packet = bytearray(layer4.build_packet(b'onion'))
+    capture = layer4.build_packet(b'core') + bytes(packet[:2]) + b'\0\0' + bytes(packet[4:])
+    with pytest.raises(ValueError):
+        list(layer4.iter_packets(capture))
+    with pytest.raises(ValueError):
+        list(layer4.stream_packets([capture]))
+    with pytest.raises(ValueError):
+        layer4.scan_boundaries(capture)
+    with pytest.raises(ValueError):
+        layer4.decode_parallel(capture, workers=2)
+
+def capture(rng: random.Random, packets: int = 200) -> bytes:
+    """
+    Accepted packets with a counter as data, mixed with rejected ones
+    """
+    return b''.join(layer4.build_packet(b'%d,' % number) if rng.random() < 0.7 else
+                    layer4.build_rejected_packet(rng) for number in range(packets))
+
+def sequential(decoded: bytes) -> bytes:
+    return b''.join(bytes(packet.data) for packet in layer4.iter_packets(decoded) if layer4.is_accepted(packet))
+
+def test_decode_parallel_matches_sequential():
+    decoded = capture(random.Random(1))
+    assert layer4.decode_parallel(decoded, workers=2) == sequential(decoded)
+    assert b''.join(layer4.decode_stream([decoded])) == sequential(decoded)
+
+def test_flow_index(tmp_path):
+    decoded = capture(random.Random(2))
+    index = layer4.FlowIndex.build(decoded)
+    key = (layer4.SOURCE_IP, layer4.DEST_IP, 17, layer4.DEST_PORT)
+    packets = list(layer4.iter_packets(decoded))
+    stats = index.stats()
+    assert sum(flow.packets for flow in stats.values()) == len(packets)
+    assert stats[key].valid_bytes == len(index.extract(decoded, key))
+    # the valid packets of the flow are exactly the accepted ones
+    assert index.extract(decoded, key) == sequential(decoded)
+    assert index.extract(decoded, (0, 0, 17, 0)) == b''
+
+    path = str(tmp_path / 'capture.index')
+    index.save(path)
+    loaded = layer4.FlowIndex.load(path)
+    assert loaded.stats() == stats
+    assert loaded.extract(decoded, key, valid_only=False) == index.extract(decoded, key, valid_only=False)
+    with pytest.raises(ValueError):
+        loaded.extract(decoded + b'\0', key)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+import random
+
+import layer5
+
+def test_unwrap_batch_matches_unwrap():
+    rng = random.Random(1)
+    kek = rng.randbytes(32)
+    iv = rng.randbytes(8)
+    keys = [rng.randbytes(rng.choice((16, 24, 32))) for _ in range(20)]
+    wrapped = [layer5.aes_key_wrap(key, kek, iv) for key in keys]
+    # wrapped with another IV, which doesn't match up
+    wrapped.append(layer5.aes_key_wrap(keys[0], kek, bytes(8)))
+    assert [layer5.aes_key_unwrap(key, kek, iv) for key in wrapped[:-1]] == keys
+    assert layer5.aes_key_unwrap_batch(wrapped, kek, iv) == keys + [None]
+    assert layer5.aes_key_unwrap_batch([], kek, iv) == []
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import threading
+import zlib
+
+import pytest
+
+import ascii85
+import layer6
+
+def test_bytecode_with_delimiter_bytes_is_not_ascii85():
+    # MVI a <- '<'; MV (ptr+c) <- f; MVI32 la <- '~>\0\0'; OUT a; HALT
+    program = bytes([0x48, 0x3C, 0x7E, 0x88, 0x7E, 0x3E, 0x00, 0x00, 0x02, 0x01])
+    assert b'<~' in program and b'~>' in program
+    assert not layer6.is_ascii85_payload(program)
+    result = layer6.run_program(program)
+    assert result.error is None and result.output == b'<'
+    assert layer6.run_program(program, encoded=True).error is not None
+
+def test_ascii85_payload_with_description():
+    program = bytes([0x48, ord('!'), 0x02, 0x01])
+    payload = b'==[ Layer 6/6 ]==\n\n' + ascii85.encode(program)
+    assert layer6.is_ascii85_payload(payload)
+    assert layer6.run_program(payload).output == b'!'
+
+def test_profile_of_overwritten_code():
+    # JEZ 7; (skipped); MVI a <- 0; MV (ptr+c) <- a, i.e. overwrite the JEZ; OUT a; HALT
+    program = bytes([0x21, 0x07, 0x00, 0x00, 0x00, 0x01, 0x01, 0x48, 0x00, 0x79, 0x02, 0x01])
+    profile = layer6.Profile()
+    output = bytearray()
+    assert layer6.TomtelCorei69(program, 'interp', output.extend).run(profile=profile)
+    assert output == b'\x00' and profile.memory[0] == 0x00
+    assert profile.branches() == {0: {'op': 'JEZ', 'taken': 1, 'not_taken': 0, 'taken_ratio': 1.0}}
+    assert '         0            1  20.00  JEZ 0x7 (taken 100.0%)' in profile.report()
+
+def take_checkpoint(path, code: bytes, steps: int):
+    VM = layer6.TomtelCorei69(code)
+    assert not VM.run(max_steps=steps)
+    with open(path, 'wb') as checkpoint_file:
+        checkpoint_file.write(VM.snapshot())
+
+def test_checkpoint_resumes_the_same_program(tmp_path):
+    code = b''.join(layer6.encode_stream([b'onion' * 100]))
+    checkpoint = str(tmp_path / 'checkpoint')
+    take_checkpoint(checkpoint, code, 500)
+    VM = layer6.run_checkpointed(code, checkpoint, checkpoint_steps=100)
+    assert VM.out_stream == b'onion' * 100
+    assert VM.steps == layer6.run_program(code).steps
+    assert not os.path.exists(checkpoint)
+
+def test_checkpoint_of_another_program_is_ignored(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    take_checkpoint(checkpoint, b''.join(layer6.encode_stream([b'stale' * 100])), 500)
+    code = b''.join(layer6.encode_stream([b'fresh' * 100]))
+    assert layer6.run_checkpointed(code, checkpoint).out_stream == b'fresh' * 100
+    # as is one in an older format
+    with open(checkpoint, 'wb') as checkpoint_file:
+        checkpoint_file.write(b'i69\x01' + zlib.compress(bytes(64)))
+    assert layer6.run_checkpointed(code, checkpoint).out_stream == b'fresh' * 100
+
+def test_closing_iter_output_stops_the_vm():
+    # MVI a <- 'x'; OUT a; JEZ 0, i.e. output 'x' forever
+    VM = layer6.TomtelCorei69(bytes([0x48, 0x78, 0x02, 0x21, 0x00, 0x00, 0x00, 0x00]))
+    sink = VM.sink
+    output = VM.iter_output(chunk_size=10, max_pending=1)
+    assert next(output) == b'x' * 10
+    (thread,) = [thread for thread in threading.enumerate() if thread.name == 'i69']
+    output.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert VM.sink is sink and not VM.halted
+
+def test_iter_output_of_halting_vm():
+    VM = layer6.TomtelCorei69(b''.join(layer6.encode_stream([b'onion' * 1000])))
+    assert b''.join(VM.iter_output(chunk_size=100)) == b'onion' * 1000
+    assert VM.halted
+
+def test_block_code_cache_is_bounded():
+    layer6._compile_block.cache_clear()
+    for key in range(20):
+        code = b''.join(layer6.encode_stream([b'onion'], key))
+        VM = layer6.TomtelCorei69(code, 'compiled')
+        assert VM.run() and VM.out_stream == b'onion'
+    info = layer6._compile_block.cache_info()
+    assert info.hits and 0 < info.currsize <= layer6.BLOCK_CODE_CACHE_SIZE == info.maxsize
+
+def test_snapshot_resumes_where_it_stopped():
+    code = b''.join(layer6.encode_stream([b'onion' * 100]))
+    expected = layer6.run_program(code)
+    for engine in layer6.ENGINES:
+        VM = layer6.TomtelCorei69(code, engine)
+        assert not VM.run(max_steps=700)
+        resumed = layer6.TomtelCorei69.from_snapshot(VM.snapshot(), engine)
+        assert resumed.steps == VM.steps and resumed.out_stream == VM.out_stream
+        assert resumed.run()
+        assert resumed.out_stream == expected.output and resumed.steps == expected.steps
+        assert resumed.code_digest == VM.code_digest
+    with pytest.raises(layer6.UserError):
+        layer6.TomtelCorei69.from_snapshot(b'not a snapshot')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import random
+
+import artifacts as layer_artifacts
+import layer0
+import layer1
+import layer2
+import layer3
+import layer4
+import layer5
+import layer6
+
+LAYERS = [layer0, layer1, layer2, layer3, layer4, layer5, layer6]
+
+def test_encode_decode_round_trip():
+    rng = random.Random(1)
+    # layer 2 pads its last group of 7 bytes, so the sizes are multiples of 7
+    for size in (0, 7, 700, 7000):
+        text = rng.randbytes(size)
+        for number, layer in enumerate(LAYERS):
+            payload = layer.encode(text, b'==[ Layer ]==\n\n')
+            assert layer.decode(payload, artifacts=layer_artifacts.DISABLED) == text, number
+
+def test_encode_decode_stream_in_random_chunks(random_chunks):
+    rng = random.Random(2)
+    text = rng.randbytes(7 * 1000)
+    for number, layer in enumerate(LAYERS):
+        encoded = b''.join(layer.encode_stream(random_chunks(text, rng, 100)))
+        for _ in range(5):
+            assert b''.join(layer.decode_stream(random_chunks(encoded, rng, 100))) == text, number
+
+def test_layer2_drops_noise():
+    text = random.Random(3).randbytes(7 * 1000)
+    encoded = b''.join(layer2.encode_stream([text], noise=0.1, seed=3))
+    assert b''.join(layer2.decode_stream([encoded])) == text
+
+def test_layer4_drops_rejected_packets():
+    text = random.Random(4).randbytes(10000)
+    encoded = b''.join(layer4.encode_stream([text], invalid=0.5, seed=4))
+    assert b''.join(layer4.decode_stream([encoded])) == text
+
+def run_engine(code: bytes, engine: str) -> bytes:
+    output = bytearray()
+    VM = layer6.TomtelCorei69(code, engine, output.extend)
+    assert VM.run()
+    return bytes(output)
+
+def test_engines_agree():
+    code = b''.join(layer6.encode_stream([b'Tom\'s Data Onion' * 100]))
+    outputs = {engine: run_engine(code, engine) for engine in layer6.ENGINES}
+    assert set(outputs.values()) == {b'Tom\'s Data Onion' * 100}
+
+def test_engines_agree_on_self_modifying_loop():
+    # the loop increments the immediate of its own 'MVI a', which prints 'A' to 'E'
+    code = bytes([
+        0x58, 0x05,                     # 0: MVI c <- 5 (the immediate at 5)
+        0x60, 0x05,                     # 2: MVI d <- 5 (the loop counter)
+        0x48, 0x41,                     # 4: MVI a <- 'A'
+        0x02,                           # 6: OUT a
+        0x4F,                           # 7: MV a <- (ptr+c)
+        0x50, 0x01,                     # 8: MVI b <- 1
+        0xC2,                           # 10: ADD a <- a + b
+        0x79,                           # 11: MV (ptr+c) <- a
+        0x4C,                           # 12: MV a <- d
+        0xC3,                           # 13: SUB a <- a - b
+        0x61,                           # 14: MV d <- a
+        0x71,                           # 15: MV f <- a
+        0x22, 0x04, 0x00, 0x00, 0x00,   # 16: JNZ 4
+        0x01,                           # 21: HALT
+    ])
+    for engine in layer6.ENGINES:
+        assert run_engine(code, engine) == b'ABCDE', engine
+
+def test_aes_key_wrap_rfc3394_vector():
+    # RFC 3394 section 4.6: wrap 256 bits of key data with a 256-bit KEK
+    kek = bytes(range(32))
+    key = bytes.fromhex('00112233445566778899AABBCCDDEEFF000102030405060708090A0B0C0D0E0F')
+    iv = b'\xa6' * 8
+    wrapped = bytes.fromhex('28C9F404C4B810F4CBCCB35CFB87F8263F5786E2D80ED326'
+                            'CBC7F0E71A99F43BFB988B9B7A02DD21')
+    assert layer5.aes_key_wrap(key, kek, iv) == wrapped
+    assert layer5.aes_key_unwrap(wrapped, kek, iv) == key
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import time
+
+import metrics as layer_metrics
+
+def slow_input(count: int, delay: float):
+    for _ in range(count):
+        time.sleep(delay)
+        yield b'x' * 1000
+
+def test_wrap_leaves_out_the_time_spent_waiting():
+    metrics = layer_metrics.Metrics()
+    transform = metrics.wrap(3, lambda chunks: (bytes(chunk) for chunk in chunks))
+    output = []
+    for chunk in transform(slow_input(5, 0.02)):
+        # a slow consumer, e.g. the next stage of the pipeline
+        time.sleep(0.02)
+        output.append(chunk)
+    assert b''.join(output) == b'x' * 5000
+    layer = metrics.layers[0]
+    assert layer.input_bytes == layer.output_bytes == 5000
+    assert layer.wall_seconds >= 0.2
+    assert layer.wait_seconds >= 0.2
+    assert layer.busy_seconds < 0.05
+    assert layer.throughput > 5000 / layer.wall_seconds / 1e6
+
+def test_call_measures_the_whole_call():
+    metrics = layer_metrics.Metrics()
+    assert metrics.call(0, lambda payload: payload.upper(), b'onion') == b'ONION'
+    layer = metrics.layers[0]
+    assert layer.wait_seconds == 0.0 and layer.busy_seconds == layer.wall_seconds
+    assert '"wait_seconds": 0.0' in metrics.to_json_lines()
+    assert 'onion_layer_busy_seconds{layer="0"}' in metrics.to_prometheus()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import functools
+import random
+
+import artifacts as layer_artifacts
+import layer1
+import layer3
+import parallel
+
+XOR_SLICE = functools.partial(layer3.xor_slice, key=layer3.KEY)
+XOR_ALIGNMENT = layer3.KEY_LEN * 16
+
+def test_transform_parallel_matches_sequential():
+    data = random.Random(1).randbytes(100003)
+    with parallel.transform_parallel(data, XOR_SLICE, 2, XOR_ALIGNMENT, threshold=0) as result:
+        assert result.view.readonly
+        assert result.tobytes() == layer3.xor_with_key(data)
+    with parallel.transform_parallel(data, layer1.transform_slice, 2, threshold=0) as result:
+        assert result.tobytes() == layer1.transform(data)
+
+def test_transform_stream_in_batches(random_chunks):
+    rng = random.Random(2)
+    data = rng.randbytes(50000)
+    for batch_size in (1, 1000, 100000):
+        chunks = random_chunks(data, rng, 3000)
+        output = list(parallel.transform_stream(chunks, XOR_SLICE, 2, XOR_ALIGNMENT, batch_size, threshold=0))
+        assert b''.join(output) == layer3.xor_with_key(data)
+        # every batch but the last one is a multiple of the alignment
+        assert all(len(chunk) % XOR_ALIGNMENT == 0 for chunk in output[:-1])
+
+def test_decode_with_workers(tmp_path):
+    text = random.Random(3).randbytes(5000)
+    artifacts = layer_artifacts.ArtifactWriter(str(tmp_path))
+    assert layer1.decode(layer1.encode(text), workers=2, artifacts=artifacts) == text
+    assert layer3.decode(layer3.encode(text), workers=2, artifacts=artifacts) == text
+    assert (tmp_path / 'layer2').read_bytes() == (tmp_path / 'layer4').read_bytes() == text
+    assert b''.join(layer1.decode_stream(layer1.encode_stream([text]), workers=2)) == text
+    assert b''.join(layer3.decode_stream(layer3.encode_stream([text]), workers=2)) == text
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import importlib
+import os
+
+import artifacts as layer_artifacts
+import ascii85
+import cache as layer_cache
+import generate
+import layer1
+import pipeline
+
+def layer_texts(core_size: int):
+    """
+    The text of every layer of a generated onion, each one decoded on its own
+    """
+    texts = [b''.join(generate.encode_layers(generate.core_text(core_size, 1), 1))]
+    for name in pipeline.LAYERS:
+        module = importlib.import_module(name)
+        texts.append(module.decode(texts[-1], artifacts=layer_artifacts.DISABLED))
+    return texts
+
+def read_layers(directory):
+    layers = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as layer_file:
+            layers[name] = layer_file.read()
+    return layers
+
+def test_small_chunks_write_every_layer_file(tmp_path):
+    texts = layer_texts(2000)
+    with layer_artifacts.ArtifactWriter(str(tmp_path), background=True) as artifacts:
+        core = b''.join(pipeline.run([texts[0]], artifacts=artifacts, chunk_size=1, max_pending=2))
+    assert core == texts[-1]
+    assert read_layers(tmp_path) == {f"layer{layer}": texts[layer] for layer in range(1, len(texts))}
+
+def test_text_after_payload_is_kept(tmp_path):
+    # layer 1 goes on long after its payload, which layer 1 doesn't need
+    text = layer1.encode(b'layer 2', b'==[ Layer 1 ]==\n\n') + b'\n' * 1000
+    layer0 = ascii85.encode(text)
+    chunks = [layer0[i:i + 5] for i in range(0, len(layer0), 5)]
+    artifacts = layer_artifacts.ArtifactWriter(str(tmp_path))
+    output = b''.join(pipeline.run(chunks, 0, 1, artifacts=artifacts, chunk_size=1, max_pending=1))
+    assert output == b'layer 2'
+    assert read_layers(tmp_path) == {'layer1': text, 'layer2': b'layer 2'}
+
+def test_warm_cache_writes_every_layer_file(tmp_path, capsys):
+    texts = layer_texts(2000)
+    cache = layer_cache.LayerCache(str(tmp_path / 'cache'))
+    for run in ('cold', 'warm'):
+        artifacts = layer_artifacts.ArtifactWriter(str(tmp_path / run))
+        assert b''.join(pipeline.run([texts[0]], artifacts=artifacts, cache=cache)) == texts[-1]
+    # the second run took every layer from the cache
+    assert capsys.readouterr().out.count(": cached") == len(pipeline.LAYERS)
+    expected = {f"layer{layer}": texts[layer] for layer in range(1, len(texts))}
+    assert read_layers(tmp_path / 'cold') == read_layers(tmp_path / 'warm') == expected
+
+def test_parallel_layers(tmp_path):
+    texts = layer_texts(2000)
+    artifacts = layer_artifacts.ArtifactWriter(str(tmp_path))
+    assert b''.join(pipeline.run([texts[0]], artifacts=artifacts, workers=2)) == texts[-1]
+    assert read_layers(tmp_path) == {f"layer{layer}": texts[layer] for layer in range(1, len(texts))}
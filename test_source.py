@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import html
+import http.server
+import random
+import threading
+
+import pytest
+
+import source
+
+PAGE = ("<html><head><title>Tom's Data Onion</title></head><body>\n<pre>\n\n"
+        "==[ Layer 0/6: ASCII85 ]=====\n\nCafé &amp; &lt;onion&gt; — &#x27;peel&#39; it\n\n"
+        "&lt;~87cURD]i,\"Ebo80~&gt;  \n \n\t</pre>\n<p>&lt;pre&gt;</p><pre>second</pre></body></html>").encode('utf-8')
+
+def split_extract(page: bytes) -> bytes:
+    """
+    How the Onion was extracted from the whole page before it was streamed
+    """
+    text = page.split(b'<pre>')[1].split(b'</pre>')[0].strip()
+    return html.unescape(text.decode('utf-8')).encode('utf-8')
+
+def test_extract_pre_in_random_chunks(random_chunks):
+    rng = random.Random(1)
+    expected = split_extract(PAGE)
+    assert expected.endswith(b'~>')
+    for _ in range(200):
+        assert b''.join(source.extract_pre(random_chunks(PAGE, rng))) == expected
+
+class RedirectingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/page':
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+            return
+        # '/moved' -> '/moved/again' (relative) -> '/page' (absolute); '/loop' -> '/loop'
+        location = {'/moved': 'moved/again', '/moved/again': f'http://{self.headers["Host"]}/page'}.get(self.path, '/loop')
+        self.send_response(301 if self.path == '/moved' else 307)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def test_url_source_follows_redirects():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RedirectingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        assert b''.join(source.UrlSource(base + '/moved', retries=0).chunks()) == split_extract(PAGE)
+        with pytest.raises(source.FetchError):
+            b''.join(source.UrlSource(base + '/loop', retries=0).chunks())
+    finally:
+        server.shutdown()
+        server.server_close()